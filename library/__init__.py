@@ -34,6 +34,27 @@ class GPIODriverActiveDirection:
     LOW = "LOW"
 
 
+class ControllerStates:
+    CREATED = "created"
+    STARTING = "starting"
+    RUNNING = "running"
+    STOPPING = "stopping"
+    STOPPED = "stopped"
+    FAILED = "failed"
+
+
+class Runtimes:
+    THREADED = "threaded"
+    ASYNCIO = "asyncio"
+
+
+class OverflowPolicies:
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    REJECT = "reject"
+    ALL = [DROP_OLDEST, COALESCE, REJECT]
+
+
 def setup_logging(logger, logging_level=False, log_path=None) -> logging.Logger:
     """
     Set up logging stream and file handlers
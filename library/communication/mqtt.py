@@ -5,9 +5,18 @@ Author: Charles "Chip" Wood
         github.com/imchipwood
 """
 import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
 
-from paho.mqtt import publish
-from paho.mqtt.client import Client, MQTTv311
+from paho.mqtt.client import Client, MQTTv311, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+from library.communication.outbox import Outbox
+from library.communication.router import TopicRouter
+
+_CONNECTIONS = {}  # type: Dict[Tuple[str, int], MQTTConnection]
+_CONNECTIONS_LOCK = threading.Lock()
 
 
 class MQTTError(Exception):
@@ -35,6 +44,348 @@ def get_mqtt_error_message(rc):
     return message
 
 
+class MQTTConnection:
+    """
+    Long-lived session to a single broker, shared by every controller in
+    the process. paho's network thread keeps the session alive and
+    reconnects on its own, so publishing doesn't pay for a TCP + CONNECT
+    handshake every message.
+
+    Controllers register message handlers with subscribe(). The session
+    subscribes to the union of all their topics and each incoming message
+    is routed through a TopicRouter to the handlers whose subscriptions
+    match it.
+
+    With an Outbox attached, messages that can't be delivered are stored
+    on disk instead of raising, and drained at drain_rate messages/sec
+    once the broker is back. Delivery is then at-least-once
+    """
+
+    MAX_INFLIGHT = 20
+    MAX_QUEUED = 100
+    SUBSCRIBE_QOS = 2
+    CONNECT_TIMEOUT = 5.0
+    PUBLISH_TIMEOUT = 10.0
+    MIN_RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 120
+    DRAIN_BATCH = 20
+
+    def __init__(
+            self,
+            broker: str,
+            port: int = 1883,
+            keepalive: int = 60,
+            outbox: Outbox or None = None,
+            drain_rate: float = 20.0
+    ):
+        """
+        @param broker: hostname or IP address of the broker
+        @type broker: str
+        @param port: broker port
+        @type port: int
+        @param keepalive: seconds between keepalive pings
+        @type keepalive: int
+        @param outbox: (Optional) store for messages which couldn't be delivered
+        @type outbox: Outbox or None
+        @param drain_rate: max messages/sec to send from the outbox after reconnecting
+        @type drain_rate: float
+        """
+        super()
+        self.broker = broker
+        self.port = port
+        self.keepalive = keepalive
+        self.outbox = outbox
+        self.drain_rate = drain_rate
+        self.router = TopicRouter()
+
+        self._connected = threading.Event()
+        self._drain = threading.Event()
+        self._closed = threading.Event()
+        self._drain_thread = None  # type: threading.Thread or None
+        self._lock = threading.Lock()
+        self._started = False
+
+        # Empty client ID lets the broker assign one - with a clean session
+        # subscriptions are renewed in on_connect every time
+        self.client = Client(client_id="", clean_session=True)
+        self.client.max_inflight_messages_set(self.MAX_INFLIGHT)
+        self.client.max_queued_messages_set(self.MAX_QUEUED)
+        self.client.reconnect_delay_set(self.MIN_RECONNECT_DELAY, self.MAX_RECONNECT_DELAY)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+
+    @property
+    def connected(self) -> bool:
+        """
+        Check if the session to the broker is up
+        @rtype: bool
+        """
+        return self._connected.is_set()
+
+    def start(self, network_thread: bool = True):
+        """
+        Start paho's network thread (no-op if it's already running). The
+        thread keeps retrying the connection until close() is called
+        @param network_thread: False if the caller drives the network loop
+        and connection itself (e.g. from an asyncio event loop)
+        @type network_thread: bool
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._closed.clear()
+            if network_thread:
+                self.client.connect_async(self.broker, self.port, self.keepalive)
+                self.client.loop_start()
+            self._drain_thread = threading.Thread(target=self.drain_loop, name=f"outbox {self}")
+            self._drain_thread.daemon = True
+            self._drain_thread.start()
+            self._started = True
+
+    def connect(self):
+        """
+        Connect to the broker, blocking until the socket is open - only
+        needed when start() was called without the network thread
+        """
+        self.client.connect(self.broker, self.port, self.keepalive)
+
+    def close(self):
+        """
+        Disconnect and stop paho's network thread
+        """
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        self._closed.set()
+        self._drain.set()
+        self._drain_thread.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+        self._connected.clear()
+
+    def on_connect(self, client, userdata, flags, rc):
+        """
+        Connection callback - run from paho's network thread
+        """
+        if rc != MQTT_ERR_SUCCESS:
+            logging.error(f"MQTTConnection: {self} refused connection - {get_mqtt_error_message(rc)}")
+            return
+        self._connected.set()
+        self._drain.set()
+
+        subscriptions = self.router.subscriptions
+        if subscriptions:
+            self.client.subscribe([(topic, self.SUBSCRIBE_QOS) for topic in subscriptions])
+
+    def on_disconnect(self, client, userdata, rc):
+        """
+        Disconnection callback - paho reconnects on its own
+        """
+        self._connected.clear()
+
+    def on_message(self, client, userdata, msg):
+        """
+        Route an incoming message to every handler subscribed to its topic
+        """
+        for handler in self.router.match(msg.topic):
+            try:
+                handler(client, userdata, msg)
+            except:
+                logging.exception(f"MQTTConnection: exception handling message on {msg.topic}")
+
+    def subscribe(self, topics: List[str], handler: Callable):
+        """
+        Route messages on topics to a handler, subscribing the session to
+        any topics it isn't subscribed to yet
+        @param topics: topic filters, wildcards allowed
+        @type topics: list[str]
+        @param handler: paho-style on_message(client, userdata, msg) method
+        @type handler: method
+        """
+        new_topics = [topic for topic in topics if self.router.add(topic, handler)]
+        self.start()
+        if new_topics and self.connected:
+            self.client.subscribe([(topic, self.SUBSCRIBE_QOS) for topic in new_topics])
+
+    def unsubscribe(self, topics: List[str], handler: Callable):
+        """
+        Stop routing messages on topics to a handler, unsubscribing the
+        session from topics nothing else is interested in
+        @param topics: topic filters passed to subscribe()
+        @type topics: list[str]
+        @param handler: handler passed to subscribe()
+        @type handler: method
+        """
+        unused_topics = [topic for topic in topics if self.router.remove(topic, handler)]
+        if unused_topics and self.connected:
+            self.client.unsubscribe(unused_topics)
+
+    def publish(self, topic: str, payload=None, qos: int = 2, retain: bool = True, timeout: float or None = None):
+        """
+        Publish a message and wait until the broker acknowledges it
+        @param topic: topic to publish to
+        @type topic: str
+        @param payload: message payload - dicts are sent as JSON
+        @type payload: str or dict or None
+        @param qos: quality of service level
+        @type qos: int
+        @param retain: whether the broker should retain the message
+        @type retain: bool
+        @param timeout: max seconds to wait for the connection and the acknowledgement
+        @type timeout: float or None
+        """
+        self.publish_many([(topic, payload, qos, retain)], timeout=timeout)
+
+    def publish_many(self, messages: List[Tuple[str, object, int, bool]], timeout: float or None = None):
+        """
+        Send a batch of messages back to back over the session, then wait
+        for the broker to acknowledge all of them
+        @param messages: (topic, payload, qos, retain) for each message - dict payloads are sent as JSON
+        @type messages: list[tuple]
+        @param timeout: max seconds to wait for the connection and all acknowledgements
+        @type timeout: float or None
+        """
+        self.start()
+
+        # Queue behind any backlog so messages are delivered in order
+        if self.outbox is not None and len(self.outbox):
+            self.outbox.put(messages)
+            self._drain.set()
+            return
+
+        try:
+            self.send(messages, timeout)
+        except MQTTError:
+            if self.outbox is None:
+                raise
+            logging.warning(
+                f"MQTTConnection: {self} unavailable - storing {len(messages)} message(s) in {self.outbox}"
+            )
+            self.outbox.put(messages)
+
+    def send(self, messages: List[Tuple[str, object, int, bool]], timeout: float or None = None):
+        """
+        Send messages over the session and wait for all acknowledgements
+        @param messages: (topic, payload, qos, retain) for each message
+        @type messages: list[tuple]
+        @param timeout: max seconds to wait for the connection and all acknowledgements
+        @type timeout: float or None
+        """
+        timeout = self.PUBLISH_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        if not self._connected.wait(min(timeout, self.CONNECT_TIMEOUT)):
+            raise MQTTError(f"Not connected to {self}")
+
+        pending = []
+        for topic, payload, qos, retain in messages:
+            if isinstance(payload, dict):
+                payload = json.dumps(payload)
+            info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+            # The session dropped since the check above - fail so the caller can store the
+            # messages instead of waiting on ones that can't be acknowledged
+            if info.rc == MQTT_ERR_NO_CONN:
+                raise MQTTError(f"Lost connection to {self} while publishing to {topic}")
+            if info.rc != MQTT_ERR_SUCCESS:
+                raise MQTTError(f"Failed to publish to {topic}: {get_mqtt_error_message(info.rc)}")
+            pending.append((topic, info))
+
+        for topic, info in pending:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0.0))
+            except (RuntimeError, ValueError) as e:
+                # paho raises these for messages which failed after being queued
+                raise MQTTError(f"Failed to publish to {topic}: {e}")
+            if not info.is_published():
+                raise MQTTError(f"Timed out waiting for {self} to acknowledge {topic}")
+
+    def drain_loop(self):
+        """
+        Send stored messages in rate-limited batches whenever the session
+        (re)connects or new messages are stored behind a backlog
+        """
+        while not self._closed.is_set():
+            self._drain.wait()
+            self._drain.clear()
+            if self.outbox is None:
+                continue
+
+            try:
+                self.drain()
+            except:
+                # Keep the drain thread alive - anything left is retried on the next reconnect or store
+                logging.exception(f"MQTTConnection: unexpected exception draining {self.outbox}")
+
+    def drain(self):
+        """
+        Send stored messages until the outbox is empty or sending fails
+        """
+        while self._connected.is_set() and not self._closed.is_set():
+            batch = self.outbox.peek(self.DRAIN_BATCH)
+            if not batch:
+                return
+            try:
+                self.send([message for _, message in batch])
+            except MQTTError:
+                logging.warning(f"MQTTConnection: failed to drain {self.outbox} - waiting for reconnect")
+                return
+            self.outbox.remove([message_id for message_id, _ in batch])
+            self._closed.wait(len(batch) / self.drain_rate)
+
+    def __repr__(self) -> str:
+        """
+        @rtype: str
+        """
+        return f"{self.broker}:{self.port}"
+
+
+def get_connection(
+        broker: str,
+        port: int = 1883,
+        outbox_path: str or None = None,
+        outbox_size: int = 10000,
+        drain_rate: float = 20.0
+) -> MQTTConnection:
+    """
+    Get the shared session for a broker
+    @param broker: hostname or IP address of the broker
+    @type broker: str
+    @param port: broker port
+    @type port: int
+    @param outbox_path: (Optional) path to store undelivered messages at
+    @type outbox_path: str or None
+    @param outbox_size: max number of stored messages
+    @type outbox_size: int
+    @param drain_rate: max messages/sec to send from the outbox after reconnecting
+    @type drain_rate: float
+    @rtype: MQTTConnection
+    """
+    key = (broker, port)
+    with _CONNECTIONS_LOCK:
+        if key not in _CONNECTIONS:
+            _CONNECTIONS[key] = MQTTConnection(broker, port, drain_rate=drain_rate)
+        connection = _CONNECTIONS[key]
+        if outbox_path and connection.outbox is None:
+            connection.outbox = Outbox(outbox_path, outbox_size)
+            connection.drain_rate = drain_rate
+        return connection
+
+
+def close_connections():
+    """
+    Close all shared publishing connections
+    """
+    with _CONNECTIONS_LOCK:
+        connections = list(_CONNECTIONS.values())
+        _CONNECTIONS.clear()
+    for connection in connections:
+        connection.close()
+        if connection.outbox is not None:
+            connection.outbox.close()
+
+
 class MQTTClient(Client):
     """
     paho.mqtt.client with support for passing in MQTTConfig object
@@ -80,32 +431,59 @@ class MQTTClient(Client):
             bind_address=bind_address
         )
 
-    def single(
-            self, topic, payload=None, qos=2, retain=True, hostname=None,
-            port=None, client_id="", keepalive=60, will=None, auth=None,
-            tls=None, protocol=MQTTv311, transport="tcp"
-    ):
+    @property
+    def connection(self) -> MQTTConnection:
         """
-        paho.mqtt.publish.single method
-        """
-        if isinstance(payload, dict):
-            payload = json.dumps(payload)
-        publish.single(
-            topic=topic,
-            payload=payload,
-            qos=qos,
-            retain=retain,
-            hostname=self.config.broker if self.config else hostname,
-            port=self.config.port if self.config else port,
-            client_id=self._client_id if self.config else client_id,
-            keepalive=keepalive,
-            will=will,
-            auth=auth,
-            tls=tls,
-            protocol=protocol,
-            transport=transport
+        Get the shared session to the configured broker
+        @rtype: MQTTConnection
+        """
+        return get_connection(
+            self.config.broker,
+            self.config.port,
+            self.config.outbox_path,
+            self.config.outbox_size,
+            self.config.outbox_rate
         )
 
+    def single(self, topic, payload=None, qos=2, retain=True, hostname=None, port=None, timeout=None):
+        """
+        Publish a single message over the shared connection to the broker
+        and wait for it to be acknowledged
+        @param topic: topic to publish to
+        @type topic: str
+        @param payload: message payload - dicts are sent as JSON
+        @type payload: str or dict or None
+        @param qos: quality of service level
+        @type qos: int
+        @param retain: whether the broker should retain the message
+        @type retain: bool
+        @param hostname: broker - only used if there's no config
+        @type hostname: str or None
+        @param port: broker port - only used if there's no config
+        @type port: int or None
+        @param timeout: (Optional) max seconds to wait for the acknowledgement
+        @type timeout: float or None
+        """
+        self.publish_many([(topic, payload, qos, retain)], hostname=hostname, port=port, timeout=timeout)
+
+    def publish_many(self, messages, hostname=None, port=None, timeout=None):
+        """
+        Publish a batch of messages over the shared connection to the broker
+        and wait for all of them to be acknowledged
+        @param messages: (topic, payload, qos, retain) for each message
+        @type messages: list[tuple]
+        @param hostname: broker - only used if there's no config
+        @type hostname: str or None
+        @param port: broker port - only used if there's no config
+        @type port: int or None
+        @param timeout: (Optional) max seconds to wait for all acknowledgements
+        @type timeout: float or None
+        """
+        if not messages:
+            return
+        connection = self.connection if self.config else get_connection(hostname, port or 1883)
+        connection.publish_many(messages, timeout=timeout)
+
     def __repr__(self):
         """
         @rtype: str
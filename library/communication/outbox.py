@@ -0,0 +1,124 @@
+"""
+Durable store-and-forward queue for MQTT publishes
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import json
+import os
+import sqlite3
+import threading
+from time import time
+from typing import List, Tuple
+
+OUTBOX_MESSAGE = Tuple[str, object, int, bool]
+
+
+class Outbox:
+    """
+    SQLite-backed FIFO of messages waiting for the broker to come back.
+    Once max_size messages are queued the oldest are dropped to make room
+    """
+
+    TABLE = "outbox"
+
+    def __init__(self, path: str, max_size: int = 10000):
+        """
+        @param path: path to the SQLite file
+        @type path: str
+        @param max_size: max number of queued messages
+        @type max_size: int
+        """
+        super()
+        self.path = path
+        self.max_size = max_size
+        self.dropped = 0
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} ("
+            f"id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            f"topic TEXT NOT NULL, "
+            f"payload TEXT, "
+            f"qos INTEGER NOT NULL, "
+            f"retain INTEGER NOT NULL, "
+            f"created REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    def __len__(self) -> int:
+        """
+        @return: number of queued messages
+        @rtype: int
+        """
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def put(self, messages: List[OUTBOX_MESSAGE]):
+        """
+        Queue messages, dropping the oldest if the cap is exceeded
+        @param messages: (topic, payload, qos, retain) for each message
+        @type messages: list[tuple]
+        """
+        now = time()
+        rows = [
+            (topic, json.dumps(payload) if isinstance(payload, dict) else payload, qos, int(retain), now)
+            for topic, payload, qos, retain in messages
+        ]
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT INTO {self.TABLE} (topic, payload, qos, retain, created) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            count = self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+            overflow = count - self.max_size
+            if overflow > 0:
+                self._connection.execute(
+                    f"DELETE FROM {self.TABLE} WHERE id IN "
+                    f"(SELECT id FROM {self.TABLE} ORDER BY id LIMIT ?)",
+                    (overflow,)
+                )
+                self.dropped += overflow
+            self._connection.commit()
+
+    def peek(self, count: int) -> List[Tuple[int, OUTBOX_MESSAGE]]:
+        """
+        Get the oldest queued messages without removing them
+        @param count: max number of messages to get
+        @type count: int
+        @return: (id, (topic, payload, qos, retain)) for each message, oldest first
+        @rtype: list[tuple]
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, topic, payload, qos, retain FROM {self.TABLE} ORDER BY id LIMIT ?",
+                (count,)
+            ).fetchall()
+        return [(row[0], (row[1], row[2], row[3], bool(row[4]))) for row in rows]
+
+    def remove(self, ids: List[int]):
+        """
+        Remove delivered messages
+        @param ids: IDs returned by peek()
+        @type ids: list[int]
+        """
+        with self._lock:
+            self._connection.executemany(f"DELETE FROM {self.TABLE} WHERE id = ?", [(x,) for x in ids])
+            self._connection.commit()
+
+    def close(self):
+        """
+        Close the SQLite connection
+        """
+        with self._lock:
+            self._connection.close()
+
+    def __repr__(self) -> str:
+        """
+        @rtype: str
+        """
+        return f"Outbox({self.path})"
@@ -0,0 +1,153 @@
+"""
+Wildcard-aware MQTT topic router
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import threading
+from typing import Callable, Dict, List
+
+
+class _Node:
+    """
+    One topic level in the trie
+    """
+    __slots__ = ["children", "handlers"]
+
+    def __init__(self):
+        self.children = {}  # type: Dict[str, _Node]
+        self.handlers = []  # type: List[Callable]
+
+
+class TopicRouter:
+    """
+    Trie of subscriptions, one level per topic segment, so matching a
+    topic only walks the branches that could match instead of checking
+    every subscription. Supports the MQTT single-level (+) and multi-level
+    (#) wildcards
+    """
+
+    SINGLE = "+"
+    MULTI = "#"
+
+    def __init__(self):
+        super()
+        self._root = _Node()
+        self._subscriptions = {}  # type: Dict[str, List[Callable]]
+        self._lock = threading.Lock()
+
+    @property
+    def subscriptions(self) -> List[str]:
+        """
+        Get every subscription with at least one handler
+        @rtype: list[str]
+        """
+        with self._lock:
+            return list(self._subscriptions)
+
+    def add(self, subscription: str, handler: Callable) -> bool:
+        """
+        Route messages matching a subscription to a handler
+        @param subscription: topic filter, wildcards allowed
+        @type subscription: str
+        @param handler: method to route messages to
+        @type handler: method
+        @return: True if this is a new subscription
+        @rtype: bool
+        """
+        with self._lock:
+            node = self._root
+            for level in subscription.split("/"):
+                node = node.children.setdefault(level, _Node())
+            if handler not in node.handlers:
+                node.handlers.append(handler)
+
+            is_new = subscription not in self._subscriptions
+            handlers = self._subscriptions.setdefault(subscription, [])
+            if handler not in handlers:
+                handlers.append(handler)
+            return is_new
+
+    def remove(self, subscription: str, handler: Callable) -> bool:
+        """
+        Stop routing a subscription to a handler
+        @param subscription: topic filter passed to add()
+        @type subscription: str
+        @param handler: handler passed to add()
+        @type handler: method
+        @return: True if no handlers are left for the subscription
+        @rtype: bool
+        """
+        with self._lock:
+            path = [self._root]
+            for level in subscription.split("/"):
+                node = path[-1].children.get(level)
+                if node is None:
+                    return subscription not in self._subscriptions
+                path.append(node)
+
+            if handler in path[-1].handlers:
+                path[-1].handlers.remove(handler)
+
+            # Prune empty branches
+            levels = subscription.split("/")
+            for i in range(len(levels), 0, -1):
+                node = path[i]
+                if node.handlers or node.children:
+                    break
+                del path[i - 1].children[levels[i - 1]]
+
+            handlers = self._subscriptions.get(subscription, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers:
+                self._subscriptions.pop(subscription, None)
+                return True
+            return False
+
+    def match(self, topic: str) -> List[Callable]:
+        """
+        Get the handlers for every subscription matching a topic. Handlers
+        registered for several matching subscriptions are only returned once
+        @param topic: topic a message was published to
+        @type topic: str
+        @rtype: list[method]
+        """
+        levels = topic.split("/")
+        matches = []
+        with self._lock:
+            self._match(self._root, levels, 0, matches)
+        return matches
+
+    def _match(self, node: _Node, levels: List[str], index: int, matches: List[Callable]):
+        """
+        Recursively collect handlers matching levels[index:]
+        """
+        # Wildcards don't match topics starting with $ (e.g. $SYS)
+        wildcards = not (index == 0 and levels[0].startswith("$"))
+
+        multi = node.children.get(self.MULTI)
+        if multi is not None and wildcards:
+            # '#' also matches the parent level, e.g. a/# matches a
+            self._add(multi.handlers, matches)
+
+        if index == len(levels):
+            self._add(node.handlers, matches)
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, matches)
+
+        single = node.children.get(self.SINGLE)
+        if single is not None and wildcards:
+            self._match(single, levels, index + 1, matches)
+
+    @staticmethod
+    def _add(handlers: List[Callable], matches: List[Callable]):
+        """
+        Add handlers to matches, skipping any already found
+        """
+        for handler in handlers:
+            if handler not in matches:
+                matches.append(handler)
@@ -3,7 +3,7 @@ import json
 import os
 from typing import List, Type, Union, Dict
 
-from library import HOME_DIR, CONFIG_DIR, TEST_CONFIG_DIR, CONFIG_TYPE, CONTROLLER_TYPE
+from library import HOME_DIR, CONFIG_DIR, TEST_CONFIG_DIR, CONFIG_TYPE, CONTROLLER_TYPE, Runtimes
 # from library.data.database import
 
 
@@ -21,8 +21,17 @@ class BaseConfigKeys:
     MQTT = "mqtt"
     SENSORS = "sensors"
     LOG = "log"
+    RUNTIME = "runtime"           # "threaded" (default) or "asyncio"
     BROKER = "broker"
     PORT = "port"
+    OUTBOX = "outbox"
+    OUTBOX_PATH = "path"
+    OUTBOX_SIZE = "size"
+    OUTBOX_RATE = "rate"
+    HANDLERS = "handlers"
+    HANDLER_WORKERS = "workers"
+    HANDLER_QUEUE = "queue_depth"
+    HANDLER_OVERFLOW = "overflow"     # "drop_oldest", "coalesce" or "reject"
     CLIENT_ID = "client_id"
     TOPICS = "topics"
     PUBLISH = "publish"
@@ -39,12 +48,34 @@ class BaseConfigKeys:
     DB_COLUMN_NAME = "col_name"
     DB_COLUMN_TYPE = "col_type"
     DB_COLUMN_KEY = "col_key"
+    DB_COLUMN_INDEX = "col_index"
     DB_FOREIGN_TABLE_KEY = "foreign_table_key"
+    # sqlite tuning - each is applied as a PRAGMA of the same name
+    DB_JOURNAL_MODE = "journal_mode"
+    DB_SYNCHRONOUS = "synchronous"
+    DB_BUSY_TIMEOUT = "busy_timeout"
+    DB_CACHE_SIZE = "cache_size"
+    DB_MMAP_SIZE = "mmap_size"
+    DB_PRAGMAS = [DB_BUSY_TIMEOUT, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_CACHE_SIZE, DB_MMAP_SIZE]
+    # ringbuffer databases
+    DB_CAPACITY = "capacity"
+    # per-table retention
+    DB_RETENTION = "retention"
+    RETENTION_MAX_AGE = "max_age"
+    RETENTION_BATCH_SIZE = "batch_size"
+    RETENTION_INTERVAL = "interval"
+    RETENTION_ROLLUPS = "rollups"
+    RETENTION_PERIOD = "period"
+    RETENTION_GROUP_BY = "group_by"
+    RETENTION_VALUES = "values"
+    RETENTION_GRACE = "grace"
 
     DB_SERVER = "server"
     DB_DATABASE = "database"
     DB_USERNAME = "username"
     DB_PASSWORD = "password"
+    DB_POOL_SIZE = "pool_size"
+    DB_POOL_MAX_IDLE = "pool_max_idle"
 
 
 class PubSubKeys:
@@ -79,6 +110,7 @@ class BaseConfiguration:
     Base configuration class for all sensor/controller configs to derive from
     """
     from library.data import Column
+    from library.data.retention import RetentionPolicy
     BASE_CONFIG_DIR = None
     _SECRETS_FILE = os.path.join(HOME_DIR, "secrets.json")
 
@@ -215,6 +247,30 @@ class BaseConfiguration:
         """
         return self.config.get(BaseConfigKeys.LOG, "")
 
+    @property
+    def handler_workers(self) -> int:
+        """
+        @return: number of threads handling MQTT messages
+        @rtype: int
+        """
+        return self.config.get(BaseConfigKeys.HANDLERS, {}).get(BaseConfigKeys.HANDLER_WORKERS, 1)
+
+    @property
+    def handler_queue_depth(self) -> int:
+        """
+        @return: max number of MQTT messages waiting for a handler thread
+        @rtype: int
+        """
+        return self.config.get(BaseConfigKeys.HANDLERS, {}).get(BaseConfigKeys.HANDLER_QUEUE, 8)
+
+    @property
+    def handler_overflow(self) -> str or None:
+        """
+        @return: what to do with messages when the handler queue is full - one of library.OverflowPolicies
+        @rtype: str or None
+        """
+        return self.config.get(BaseConfigKeys.HANDLERS, {}).get(BaseConfigKeys.HANDLER_OVERFLOW)
+
     @property
     def db_enabled(self) -> bool:
         """
@@ -262,11 +318,52 @@ class BaseConfiguration:
                     column_dict.get(BaseConfigKeys.DB_COLUMN_TYPE, ""),
                     column_dict.get(BaseConfigKeys.DB_COLUMN_KEY, ""),
                     column_dict.get(BaseConfigKeys.DB_FOREIGN_TABLE_KEY),
+                    bool(column_dict.get(BaseConfigKeys.DB_COLUMN_INDEX, False)),
                 )
                 columns.append(column)
             tables[table_name] = columns
+
+        # Rollup tables are defined by the retention policies
+        for table_name, policy in self.db_retention.items():
+            if table_name in tables:
+                tables.update(policy.get_rollup_tables(tables[table_name]))
         return tables
 
+    @property
+    def db_retention(self) -> Dict[str, RetentionPolicy]:
+        """
+        Get the retention policies of tables with a "retention" block
+        @return: dictionary of table names to retention policies
+        @rtype: dict[str, RetentionPolicy]
+        """
+        from library.data.retention import RetentionPolicy, Rollup
+        policies = OrderedDict()
+        for table_definition in self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_TABLES, []):
+            retention = table_definition.get(BaseConfigKeys.DB_RETENTION)
+            if not retention:
+                continue
+            rollups = []
+            for rollup in retention.get(BaseConfigKeys.RETENTION_ROLLUPS, []):
+                # Either a period in seconds or {"period": 60, "max_age": 604800}
+                if not isinstance(rollup, dict):
+                    rollup = {BaseConfigKeys.RETENTION_PERIOD: rollup}
+                rollups.append(Rollup(
+                    rollup[BaseConfigKeys.RETENTION_PERIOD],
+                    rollup.get(BaseConfigKeys.RETENTION_MAX_AGE)
+                ))
+            table_name = table_definition.get(BaseConfigKeys.NAME)
+            policies[table_name] = RetentionPolicy(
+                table_name,
+                max_age=retention.get(BaseConfigKeys.RETENTION_MAX_AGE),
+                batch_size=retention.get(BaseConfigKeys.RETENTION_BATCH_SIZE, 500),
+                interval=retention.get(BaseConfigKeys.RETENTION_INTERVAL, 60.0),
+                rollups=rollups,
+                group_by=retention.get(BaseConfigKeys.RETENTION_GROUP_BY),
+                values=retention.get(BaseConfigKeys.RETENTION_VALUES),
+                grace=retention.get(BaseConfigKeys.RETENTION_GRACE, 60.0)
+            )
+        return policies
+
     @property
     def db_columns(self) -> List[Column]:
         """
@@ -283,7 +380,8 @@ class BaseConfiguration:
                 column_dict.get(BaseConfigKeys.DB_COLUMN_NAME, ""),
                 column_dict.get(BaseConfigKeys.DB_COLUMN_TYPE, ""),
                 column_dict.get(BaseConfigKeys.DB_COLUMN_KEY, ""),
-                column_dict.get(BaseConfigKeys.DB_FOREIGN_TABLE_KEY)
+                column_dict.get(BaseConfigKeys.DB_FOREIGN_TABLE_KEY),
+                bool(column_dict.get(BaseConfigKeys.DB_COLUMN_INDEX, False))
             )
             columns.append(column)
         return columns
@@ -328,6 +426,22 @@ class BaseConfiguration:
         password = self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_PASSWORD, "")
         return os.environ.get(password[1:], "") if password.startswith("$") else password
 
+    @property
+    def db_pool_size(self) -> int:
+        """
+        @return: max connections open to the central database at once
+        @rtype: int
+        """
+        return self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_POOL_SIZE, 4)
+
+    @property
+    def db_pool_max_idle(self) -> float:
+        """
+        @return: seconds an unused central database connection is kept open
+        @rtype: float
+        """
+        return self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_POOL_MAX_IDLE, 300.0)
+
     @property
     def db_path(self) -> str:
         """
@@ -336,6 +450,24 @@ class BaseConfiguration:
         """
         return self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_PATH)
 
+    @property
+    def db_pragmas(self) -> Dict[str, int or str]:
+        """
+        Get the sqlite tuning options set in the db config, e.g. {"journal_mode": "wal"}
+        @return: dict of PRAGMA name to value, in the order they should be applied
+        @rtype: dict[str, int or str]
+        """
+        db_config = self.config.get(BaseConfigKeys.DB, {})
+        return {key: db_config[key] for key in BaseConfigKeys.DB_PRAGMAS if key in db_config}
+
+    @property
+    def db_capacity(self) -> int:
+        """
+        @return: number of records each table of a ringbuffer database keeps
+        @rtype: int
+        """
+        return self.config.get(BaseConfigKeys.DB, {}).get(BaseConfigKeys.DB_CAPACITY, 1024)
+
 
 class ConfigurationHandler(BaseConfiguration):
 
@@ -363,6 +495,15 @@ class ConfigurationHandler(BaseConfiguration):
         self.sensorTypes = list(self.config.get(BaseConfigKeys.SENSORS, {}))
         self.sensors = {}
 
+    @property
+    def runtime(self) -> str:
+        """
+        Get how controllers should be run
+        @return: one of library.Runtimes
+        @rtype: str
+        """
+        return self.config.get(BaseConfigKeys.RUNTIME, Runtimes.THREADED)
+
     # region Sensors
 
     @property
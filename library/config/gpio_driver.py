@@ -23,6 +23,7 @@ except (ImportError, RuntimeError, ModuleNotFoundError):  # pragma: no cover
 class ConfigKeys:
     PIN = BaseConfigKeys.PIN
     TOGGLE_DELAY = "gpio_toggle_delay"
+    DEBOUNCE = "gpio_debounce"
     ACTIVE_DIRECTION = "gpio_active_direction"
 
 
@@ -66,6 +67,15 @@ class GPIODriverConfig(BaseConfiguration):
         """
         return self.config.get(ConfigKeys.TOGGLE_DELAY)
 
+    @property
+    def debounce(self) -> float:
+        """
+        Get the command debounce window in seconds
+        @return: how long repeated commands are ignored for
+        @rtype: float
+        """
+        return self.config.get(ConfigKeys.DEBOUNCE, 0.5)
+
     @property
     def active_direction(self) -> int:
         """
@@ -249,6 +249,31 @@ class MQTTBaseConfig(BaseConfiguration):
         """
         return self.config.get(BaseConfigKeys.PORT, 1883)
 
+    @property
+    def outbox_path(self) -> str or None:
+        """
+        Get the path to store messages at while the broker is unreachable
+        @return: outbox path or None if messages shouldn't be stored
+        @rtype: str or None
+        """
+        return self.config.get(BaseConfigKeys.OUTBOX, {}).get(BaseConfigKeys.OUTBOX_PATH)
+
+    @property
+    def outbox_size(self) -> int:
+        """
+        Get the max number of messages to store while the broker is unreachable
+        @rtype: int
+        """
+        return self.config.get(BaseConfigKeys.OUTBOX, {}).get(BaseConfigKeys.OUTBOX_SIZE, 10000)
+
+    @property
+    def outbox_rate(self) -> float:
+        """
+        Get the max messages/sec to send stored messages at once the broker is back
+        @rtype: float
+        """
+        return self.config.get(BaseConfigKeys.OUTBOX, {}).get(BaseConfigKeys.OUTBOX_RATE, 20.0)
+
 
 class MQTTConfig(MQTTBaseConfig):
     """
@@ -7,6 +7,14 @@ from typing import List
 from library.config import BaseConfiguration, BaseConfigKeys
 
 
+class ConfigKeys:
+    INGEST = "ingest"
+    BATCH_SIZE = "batch_size"
+    MAX_DELAY = "max_delay"
+    MAX_ROWS = "max_rows"
+    TIMESTAMP_PRECISION = "timestamp_precision"
+
+
 class MqttEnvironmentConfig(BaseConfiguration):
     """
     Configuration of MQTT Environment sensor reading
@@ -37,4 +45,37 @@ class MqttEnvironmentConfig(BaseConfiguration):
         @return: topic(s) to subscribe to
         @rtype: List[library.config.mqtt.Topic]
         """
-        return list(self.mqtt_config.topics_subscribe.values())
\ No newline at end of file
+        return list(self.mqtt_config.topics_subscribe.values())
+
+    @property
+    def ingest_batch_size(self) -> int:
+        """
+        Get the number of readings written to the database at once
+        @rtype: int
+        """
+        return self.config.get(ConfigKeys.INGEST, {}).get(ConfigKeys.BATCH_SIZE, 500)
+
+    @property
+    def ingest_max_delay(self) -> float:
+        """
+        Get the max seconds a reading waits before being written to the database
+        @rtype: float
+        """
+        return self.config.get(ConfigKeys.INGEST, {}).get(ConfigKeys.MAX_DELAY, 2.0)
+
+    @property
+    def ingest_max_rows(self) -> int:
+        """
+        Get the max number of readings waiting to be written - the oldest are dropped past this
+        @rtype: int
+        """
+        return self.config.get(ConfigKeys.INGEST, {}).get(ConfigKeys.MAX_ROWS, 10000)
+
+    @property
+    def timestamp_precision(self) -> int or None:
+        """
+        Get the digits of fractional seconds in reading timestamps, 0 to 6. By
+        default (None) it's worked out from the table's timestamp column type
+        @rtype: int or None
+        """
+        return self.config.get(ConfigKeys.TIMESTAMP_PRECISION)
@@ -1,16 +1,23 @@
+import asyncio
+import json
 import logging
 import os
 from abc import ABC, abstractmethod
-from multiprocessing import Process
+from threading import Event, Lock, Thread
 from time import time
-from typing import List, Union
+from typing import Callable, Dict, List, Union
 
-from library import setup_logging, CONFIG_TYPE, CONTROLLER_TYPE
+from library import setup_logging, ControllerStates, OverflowPolicies, CONFIG_TYPE, CONTROLLER_TYPE
 from library.communication.mqtt import MQTTClient
 from library.config import DatabaseKeys
 from library.data import DatabaseEntry, DBType
+from library.executor import BoundedExecutor
+from library.scheduler import PeriodicJob, get_scheduler
 
-RUNNING = False
+# Controller running the retention policy of each (database, table) - controllers in
+# one process often share a table, which only needs cleaning up once
+_RETENTION_OWNERS = {}  # type: Dict[tuple, BaseController]
+_RETENTION_LOCK = Lock()
 
 
 def get_logger(name: str, debug_flag: bool, log_path: str or None) -> logging.Logger:
@@ -44,6 +51,11 @@ class BaseController(ABC):
     from library.config import BaseConfiguration
     from library.data.database import BaseDatabase, BaseTable
 
+    # What to do with messages when the handler queue is full, unless the config says otherwise
+    OVERFLOW = OverflowPolicies.DROP_OLDEST
+    # Whether handle_message is quick enough to run on the shared MQTT network thread
+    HANDLE_INLINE = False
+
     def __init__(self: CONTROLLER_TYPE, config: CONFIG_TYPE or BaseConfiguration, debug: bool = False):
         super()
 
@@ -52,25 +64,250 @@ class BaseController(ABC):
 
         self._mqtt = None
         self.logger = None  # type: logging.Logger or None
-        self.thread = None  # type: Process or None
+        self.thread = None  # type: Thread or None
+        self.job = None  # type: PeriodicJob or None
+        self._executor = None  # type: BoundedExecutor or None
+        self._db = None  # type: BaseDatabase or None
+        self.retention_jobs = []  # type: List[PeriodicJob]
+        self._stop_event = Event()
+        self._status = ControllerStates.CREATED
+        self._status_lock = Lock()
+
+    # region Lifecycle
+
+    @property
+    def name(self) -> str:
+        """
+        Name of this controller for logging & health reports
+        @rtype: str
+        """
+        return self.__class__.__name__
+
+    @property
+    def status(self) -> str:
+        """
+        Current lifecycle state - one of ControllerStates
+        @rtype: str
+        """
+        return self._status
+
+    @status.setter
+    def status(self, status: str):
+        """
+        Move to a new lifecycle state
+        @param status: one of ControllerStates
+        @type status: str
+        """
+        with self._status_lock:
+            last_status = self._status
+            self._status = status
+        if self.logger and last_status != status:
+            self.logger.debug(f"{self.name}: {last_status} -> {status}")
 
     @property
     def running(self) -> bool:
         """
-        Check if monitor is running
+        Check if this controller is starting or running
+        @rtype: bool
+        """
+        return self.status in [ControllerStates.STARTING, ControllerStates.RUNNING]
+
+    @property
+    def alive(self) -> bool:
+        """
+        Check if the controller's scheduled job or thread (if it has one) is still alive
         @rtype: bool
         """
-        global RUNNING
-        return RUNNING
+        if self.status == ControllerStates.FAILED:
+            return False
+        if self.job is not None:
+            return not self.job.cancelled
+        return self.thread is None or self.thread.is_alive()
+
+    def health(self) -> dict:
+        """
+        Get a summary of this controller's state
+        @rtype: dict
+        """
+        health = {
+            "name": self.name,
+            "status": self.status,
+            "alive": self.alive,
+        }
+        if self._executor is not None:
+            health["handlers"] = self._executor.metrics()
+        return health
+
+    def start_thread(self):
+        """
+        Run loop() in a new daemon thread
+        """
+        self.thread = Thread(target=self._run_loop, name=self.name)
+        self.thread.daemon = True
+        self.status = ControllerStates.RUNNING
+        self.thread.start()
+
+    def start_job(self, period: float, delay: float or None = None):
+        """
+        Run loop() every period seconds on the shared scheduler
+        @param period: seconds between calls to loop()
+        @type period: float
+        @param delay: (Optional) seconds until the first call - defaults to one period
+        @type delay: float or None
+        """
+        self.job = get_scheduler().schedule(self.loop, period, delay=delay, name=self.name)
+        self.status = ControllerStates.RUNNING
+
+    def _run_loop(self):
+        """
+        Thread target - runs loop() and records how it exited
+        """
+        try:
+            self.loop()
+        except:
+            self.status = ControllerStates.FAILED
+            if self.logger:
+                self.logger.exception(f"{self.name} loop crashed")
+            return
+        self.status = ControllerStates.STOPPED
+
+    def restart(self, timeout: float = 5.0):
+        """
+        Stop then start this controller without touching any others
+        @param timeout: max seconds to wait for the old thread to exit
+        @type timeout: float
+        """
+        self.stop()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout)
+        try:
+            self.start()
+        except:
+            self.status = ControllerStates.FAILED
+            raise
+
+    # endregion Lifecycle
+    # region Messaging
+
+    @property
+    def period(self) -> float or None:
+        """
+        Seconds between calls to loop() for periodic controllers
+        @return: period or None if this controller only reacts to messages
+        @rtype: float or None
+        """
+        return None
+
+    @property
+    def start_delay(self) -> float or None:
+        """
+        Seconds until the first call to loop()
+        @return: delay or None to wait one period
+        @rtype: float or None
+        """
+        return None
+
+    @property
+    def subscriptions(self) -> List[str]:
+        """
+        Get the MQTT topics this controller handles messages from
+        @rtype: list[str]
+        """
+        if not (self.config and self.config.mqtt_config):
+            return []
+        return list(self.config.mqtt_config.topics_subscribe)
+
+    @property
+    def executor(self) -> BoundedExecutor:
+        """
+        Get the bounded pool which runs this controller's message handlers
+        off the MQTT network thread
+        @rtype: BoundedExecutor
+        """
+        if self._executor is None:
+            self._executor = BoundedExecutor(
+                self.name,
+                workers=self.config.handler_workers,
+                max_queue=self.config.handler_queue_depth,
+                overflow=self.config.handler_overflow or self.OVERFLOW
+            )
+        return self._executor
+
+    def initialize(self):
+        """
+        Prepare anything message handlers need - nothing by default
+        """
+        pass
+
+    def decode_message(self, msg) -> dict or None:
+        """
+        Convert an MQTT message's payload to a dict
+        @param msg: message from paho
+        @type msg: paho.mqtt.client.MQTTMessage
+        @return: decoded payload or None if it isn't valid JSON
+        @rtype: dict or None
+        """
+        payload = msg.payload.decode("utf-8")
+        self.logger.debug(f"received payload: {payload}")
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            self.logger.warning(f"Some error while converting string payload to dict: {e}")
+            return None
+
+    def on_message(self, client, userdata, msg):
+        """
+        Handler for new MQTT message - called from the shared connection's network thread,
+        which every controller in the process shares, so anything slow is left to the executor
+        """
+        self.logger.debug(f"mqtt: (MESSAGE) topic: {msg.topic}, QOS: {msg.qos}")
+
+        # Convert message to JSON
+        message_data = self.decode_message(msg)
+        if message_data is None:
+            return
+
+        if self.HANDLE_INLINE:
+            self.handle_message(msg.topic, message_data)
+            return
+        self.executor.submit(
+            self.handle_message, msg.topic, message_data, key=self.get_message_key(msg, message_data)
+        )
+
+    def get_message_key(self, msg, message_data: dict):
+        """
+        Get the key a queued message is coalesced by - only exact repeats by default
+        @param msg: message from paho
+        @type msg: paho.mqtt.client.MQTTMessage
+        @param message_data: decoded payload
+        @type message_data: dict
+        @return: hashable key
+        """
+        return msg.topic, msg.payload
+
+    def handle_message(self, topic: str, message_data: dict):
+        """
+        Act on a decoded message, blocking until done - nothing by default
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
+        """
+        pass
 
-    @running.setter
-    def running(self, running: bool):
+    async def handle_message_async(self, topic: str, message_data: dict):
         """
-        Set running flag
-        @type running: bool
+        Act on a decoded message from the asyncio runtime. Sensor, DB and
+        notification I/O all block, so handle_message is run in the
+        event loop's executor
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
         """
-        global RUNNING
-        RUNNING = running
+        await asyncio.get_running_loop().run_in_executor(None, self.handle_message, topic, message_data)
+
+    # endregion Messaging
 
     @property
     def mqtt(self) -> MQTTClient:
@@ -87,14 +324,40 @@ class BaseController(ABC):
         """
         Start the thread
         """
-        self.running = True
+        self._stop_event.clear()
+        self.status = ControllerStates.STARTING
+        if self._executor is not None:
+            # Accept messages again after cleanup() shut the handlers down
+            self._executor.start()
+        self.start_retention()
 
     @abstractmethod
     def stop(self):
         """
         Stop the thread
         """
-        self.running = False
+        self.status = ControllerStates.STOPPING
+        self._stop_event.set()
+        if self.job:
+            self.job.cancel()
+        for job in self.retention_jobs:
+            job.cancel()
+        self.retention_jobs = []
+        with _RETENTION_LOCK:
+            for key in [key for key, owner in _RETENTION_OWNERS.items() if owner is self]:
+                del _RETENTION_OWNERS[key]
+        if not (self.thread and self.thread.is_alive()):
+            self.status = ControllerStates.STOPPED
+
+    def wait_for_stop(self, timeout: float or None = None) -> bool:
+        """
+        Block until stop() is called
+        @param timeout: (Optional) max seconds to wait
+        @type timeout: float or None
+        @return: True if stopped, False if the timeout expired
+        @rtype: bool
+        """
+        return self._stop_event.wait(timeout)
 
     @abstractmethod
     def loop(self):
@@ -109,6 +372,10 @@ class BaseController(ABC):
         Stop threads and do any other cleanup required
         """
         self.stop()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._db is not None:
+            self._db.cleanup()
 
     @property
     def db_enabled(self) -> bool:
@@ -119,29 +386,64 @@ class BaseController(ABC):
         return self.config.db_enabled
 
     @property
-    def db(self) -> BaseDatabase:
+    def db_connection_errors(self) -> tuple:
         """
-        Get the Database object for this controller
-        @rtype: BaseDatabase
+        Get the exceptions the configured database raises when its connection
+        fails, without connecting to it
+        @rtype: tuple
         """
+        if not (self.config and self.config.db_enabled):
+            return ()
         if self.config.db_type == DBType.CENTRAL:
             from library.data.central_database import Database
-            db = Database(
-                self.config.db_tables,
-                self.config.db_server,
-                self.config.db_database_name,
-                self.config.db_username,
-                self.config.db_password
-            )
+        elif self.config.db_type == DBType.RINGBUFFER:
+            from library.data.ringbuffer_database import Database
         else:
             from library.data.local_database import Database
-            db = Database(
-                self.config.db_tables,
-                self.config.db_database_name,
-                self.config.db_path
-            )
-        db.connect()
-        return db
+        return Database.CONNECTION_ERRORS
+
+    @property
+    def db(self) -> BaseDatabase:
+        """
+        Get the Database object for this controller. It's created once and
+        its connection is kept open between uses - if the connection fails
+        inside a 'with' block it's closed and reopened on next use
+        @rtype: BaseDatabase
+        """
+        if self._db is None:
+            if self.config.db_type == DBType.CENTRAL:
+                from library.data.central_database import Database
+                self._db = Database(
+                    self.config.db_tables,
+                    self.config.db_server,
+                    self.config.db_database_name,
+                    self.config.db_username,
+                    self.config.db_password,
+                    self.config.db_pool_size,
+                    self.config.db_pool_max_idle
+                )
+            elif self.config.db_type == DBType.RINGBUFFER:
+                from library.data.ringbuffer_database import Database
+                self._db = Database(
+                    self.config.db_tables,
+                    self.config.db_database_name,
+                    self.config.db_path,
+                    self.config.db_capacity
+                )
+            else:
+                from library.data.local_database import Database
+                self._db = Database(
+                    self.config.db_tables,
+                    self.config.db_database_name,
+                    self.config.db_path,
+                    self.config.db_pragmas
+                )
+            self._db.keep_open = True
+
+        if not self._db.connected:
+            with self._db:
+                pass
+        return self._db
 
     @property
     def db_table(self) -> BaseTable:
@@ -161,6 +463,67 @@ class BaseController(ABC):
         """
         return self.config.mqtt_config.db_table_name
 
+    def start_retention(self, schedule: Callable or None = None):
+        """
+        Schedule the retention policies of this controller's tables - tables another
+        controller in this process is already looking after are skipped
+        @param schedule: (Optional) method scheduling a periodic call, returning something with
+                         a cancel() method - defaults to the shared scheduler's schedule()
+        @type schedule: method or None
+        """
+        if not (self.config and self.config.db_enabled):
+            return
+        schedule = schedule or get_scheduler().schedule
+        for table_name, policy in self.retention_policies.items():
+            key = self.get_retention_key(table_name)
+            with _RETENTION_LOCK:
+                owner = _RETENTION_OWNERS.setdefault(key, self)
+            if owner is not self:
+                self.logger.debug(f"Retention for {table_name} is already run by {owner.name}")
+                continue
+            job = schedule(
+                lambda target=policy: self.apply_retention(target),
+                policy.interval,
+                name=f"{self.name} retention: {table_name}"
+            )
+            self.retention_jobs.append(job)
+
+    @property
+    def retention_policies(self) -> dict:
+        """
+        Get the retention policies of this controller's tables - the ones in the config by default
+        @return: dictionary of table names to retention policies
+        @rtype: dict[str, library.data.retention.RetentionPolicy]
+        """
+        return self.config.db_retention
+
+    def get_retention_key(self, table_name: str) -> tuple:
+        """
+        Get a key identifying one table in one database, whichever controller opens it
+        @param table_name: name of the table
+        @type table_name: str
+        @rtype: tuple
+        """
+        return (
+            self.config.db_type,
+            self.config.db_server,
+            self.config.db_path,
+            self.config.db_database_name,
+            table_name
+        )
+
+    def apply_retention(self, policy) -> dict:
+        """
+        Roll up & delete old rows for one table
+        @param policy: retention policy for the table
+        @type policy: library.data.retention.RetentionPolicy
+        @return: {"rolled_up": buckets written, "deleted": rows deleted}
+        @rtype: dict
+        """
+        summary = policy.apply(self.db)
+        self.logger.debug(f"Retention for {policy}: {summary}")
+        return summary
+
     def get_entry_for_id(self, convo_id: str) -> Union[DatabaseEntry, None]:
         """
         Get the latest entry for the given ID
@@ -175,18 +538,8 @@ class BaseController(ABC):
         self.logger.debug(f"Opening DB {self.config.db_database_name}")
         with self.db as db:
             table = db.get_table(self.db_table_name)
-            records = table.get_all_records()
-            if not records:
-                return None
-
-            matches = [record for record in records if record.get(DatabaseKeys.ID) == convo_id]
-            if not matches:
-                return None
-
-            if len(matches) > 1:
-                self.logger.warning(f"Found multiple records for id {convo_id} - {matches}\nReturning latest")
-
-            return matches[-1]
+            matches = table.get_records_where(DatabaseKeys.ID, convo_id, limit=1)
+            return matches[0] if matches else None
 
     def get_latest_db_entry(self, column_name: str or None = None) -> Union[int, float, str, DatabaseEntry, None]:
         """
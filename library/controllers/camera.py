@@ -4,12 +4,10 @@ Author: Charles "Chip" Wood
         imchipwood@gmail.com
         github.com/imchipwood
 """
-import json
-from threading import Thread, Lock
+from threading import Lock
 from time import time
 
-from library import GarageDoorStates
-from library.communication.mqtt import MQTTError, get_mqtt_error_message
+from library import GarageDoorStates, OverflowPolicies
 from library.config import PubSubKeys, DatabaseKeys
 from library.controllers import BaseController, get_logger
 from library.sensors.camera import Camera
@@ -21,6 +19,11 @@ if False:
 
 
 class PiCameraController(BaseController):
+
+    # Captures are serialized by the camera anyway - a burst of capture
+    # commands only needs the latest one
+    OVERFLOW = OverflowPolicies.COALESCE
+
     def __init__(self, config, debug=False):
         """
         @param config: configuration object for PiCamera
@@ -34,8 +37,6 @@ class PiCameraController(BaseController):
 
         self.logger = get_logger(__name__, debug, config.log)
 
-        self.thread = Thread(target=self.loop)
-
     # region Threading
 
     def setup(self):
@@ -47,14 +48,8 @@ class PiCameraController(BaseController):
             return
 
         self.logger.debug(f"MQTT Config: {self.mqtt}")
-        self.mqtt.on_connect = self.on_connect
-        self.mqtt.on_subscribe = self.on_subscribe
-        self.mqtt.on_message = self.on_message
-
-        self.logger.debug("Connecting MQTT")
-        result = self.mqtt.connect()
-        self.logger.debug(f"Connect result: {result}")
-        self.mqtt.loop_start()
+        self.logger.debug(f"Subscribing to {self.subscriptions} on {self.mqtt.connection}")
+        self.mqtt.connection.subscribe(self.subscriptions, self.on_message)
 
     def start(self):
         """
@@ -63,101 +58,91 @@ class PiCameraController(BaseController):
         self.logger.debug("Starting Camera MQTT connection")
         super().start()
         self.setup()
-        self.thread.start()
+        self.start_thread()
 
     def stop(self):
         """
-        Disconnect from MQTT
+        Unsubscribe from the shared MQTT connection
         """
         self.logger.info("Shutting down camera MQTT connection")
         super().stop()
         try:
             if self.mqtt:
-                self.mqtt.loop_stop()
-                result = self.mqtt.disconnect()
-                self.logger.debug(f"Disconnect result: {result}")
+                self.mqtt.connection.unsubscribe(self.subscriptions, self.on_message)
         except:
-            self.logger.exception("Exception while disconnecting from MQTT - ignoring")
+            self.logger.exception("Exception while unsubscribing from MQTT - ignoring")
 
-    def loop(self):  # pragma: no cover
+    def loop(self):
         """
-        No actual threading for Camera
-        No coverage because
+        Nothing to do here - the shared MQTT connection's network thread
+        delivers messages. Block until stop() is called instead of spinning
         """
-        self.logger.debug("Starting MQTT loop")
+        self.logger.debug("Waiting for stop")
         try:
-            while self.running:
-                pass
+            self.wait_for_stop()
         except KeyboardInterrupt:
             self.logger.debug("KeyboardInterrupt, ignoring")
-        finally:
-            self.stop()
 
     # endregion Threading
     # region MQTT
 
-    def on_connect(self, client, userdata, flags, rc):
+    def get_message_key(self, msg, message_data: dict):
         """
-        Event handler for MQTT connection
+        Only repeats of the same request are coalesced - every requester gets its capture
+        @param msg: message from paho
+        @type msg: paho.mqtt.client.MQTTMessage
+        @param message_data: decoded payload
+        @type message_data: dict
+        @return: hashable key
         """
-        self.logger.info(f"mqtt: (CONNECT) client {client._client_id} received with code {rc}")
+        return "capture", message_data.get(PubSubKeys.ID) or msg.payload
 
-        # Check the connection results
-        if rc != 0:  # pragma: no cover
-            message = get_mqtt_error_message(rc)
-            self.logger.error(message)
-            raise MQTTError(f"on_connect 'rc' failure - {message}")
-
-        # Nothing wrong with RC - subscribe to topic
-        self.logger.info("Connection successful")
-        # Subscribe to all topics simultaneously
-        self.mqtt.subscribe([(x.name, 2) for x in self.config.mqtt_topic])
-
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+    def handle_message(self, topic: str, message_data: dict):
         """
-        Simply log subscription status
+        Capture if the message asks for it - run from the executor, blocking it until done
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
         """
-        self.logger.debug(f"mqtt: (SUBSCRIBE) client: {client._client_id}, mid {mid}, granted_qos: {granted_qos}")
+        kwargs = self.get_capture_kwargs(topic, message_data)
+        if kwargs is not None:
+            self.capture_loop(**kwargs)
 
-    def on_message(self, client, userdata, msg):
+    def get_capture_kwargs(self, message_topic: str, message_data: dict) -> dict or None:
         """
-        Handler for new MQTT message
+        Check if a message indicates a capture and get the capture_loop arguments for it
+        @param message_topic: topic message came from
+        @type message_topic: str
+        @param message_data: message data as dict
+        @type message_data: dict
+        @return: capture_loop kwargs or None if no capture is needed
+        @rtype: dict or None
         """
-        self.logger.debug(f"mqtt: (MESSAGE) client: {client._client_id}, topic: {msg.topic}, QOS: {msg.qos}")
-
-        # Convert message to JSON
-        payload = msg.payload.decode("utf-8")
-        self.logger.debug(f"received payload: {payload}")
-        try:
-            message_data = json.loads(payload)
-        except ValueError as e:
-            self.logger.warning(f"Some error while converting string payload to dict: {e}")
-            return
-
         # Check if it indicated a capture
-        should_capture = self.should_capture_from_command(msg.topic, message_data)
+        should_capture = self.should_capture_from_command(message_topic, message_data)
         convo_id = message_data.get(PubSubKeys.ID)
         force_capture = should_capture == PubSubKeys.FORCE
 
         if force_capture and convo_id is None:
             convo_id = Camera.get_id()
 
-        if should_capture is not False:
-            # If no delay in message, pass in None - this will force camera to use
-            # the delay defined in the config
-            kwargs = {
-                PubSubKeys.DELAY: message_data.get(
-                    PubSubKeys.DELAY,
-                    None
-                ),
-                PubSubKeys.FORCE: message_data.get(
-                    PubSubKeys.FORCE,
-                    should_capture == PubSubKeys.FORCE
-                ),
-                PubSubKeys.ID: convo_id
-            }
-            thread = Thread(target=self.capture_loop, kwargs=kwargs)
-            thread.start()
+        if should_capture is False:
+            return None
+
+        # If no delay in message, pass in None - this will force camera to use
+        # the delay defined in the config
+        return {
+            PubSubKeys.DELAY: message_data.get(
+                PubSubKeys.DELAY,
+                None
+            ),
+            PubSubKeys.FORCE: message_data.get(
+                PubSubKeys.FORCE,
+                should_capture == PubSubKeys.FORCE
+            ),
+            PubSubKeys.ID: convo_id
+        }
 
     def should_capture_from_command(self, message_topic: str, message_data: dict) -> bool or str:
         """
@@ -239,6 +224,7 @@ class PiCameraController(BaseController):
         if not self.mqtt:
             return
 
+        messages = []
         for name, topic in self.config.mqtt_config.topics_publish.items():
             if PubSubKeys.FORCE in topic.raw_payload:
                 raw_payload = topic.raw_payload
@@ -250,7 +236,9 @@ class PiCameraController(BaseController):
                 payload = topic.raw_payload
 
             self.logger.info(f"Publish to {name}: {topic.raw_payload}")
-            self.mqtt.single(str(topic), payload=payload, retain=False, qos=2)
+            messages.append((str(topic), payload, 2, False))
+
+        self.mqtt.publish_many(messages)
 
     def update_database_entry(self, convo_id: str):
         """
@@ -261,33 +249,34 @@ class PiCameraController(BaseController):
         if not self.db_enabled:
             return
 
-        target_entry = self.get_entry_for_id(convo_id)
-        if target_entry:
-            timestamp = target_entry[DatabaseKeys.TIMESTAMP]
-            self.logger.info(
-                f"Updating DB record @ {timestamp} ({convo_id}): {DatabaseKeys.CAPTURED} = {int(True)}")
-            self.db_table.update_record(timestamp, DatabaseKeys.CAPTURED, int(True))
-
-        else:
-            timestamp = int(time())
-            captured = int(True)
-            latest_entry = self.db_table.get_latest_record()
-            if latest_entry and latest_entry[DatabaseKeys.TIMESTAMP] != timestamp:
-                raw_data = {
-                    DatabaseKeys.TIMESTAMP: timestamp,
-                    DatabaseKeys.STATE: GarageDoorStates.OPEN,
-                    DatabaseKeys.ID: convo_id,
-                    DatabaseKeys.CAPTURED: captured,
-                    DatabaseKeys.NOTIFIED: int(False)
-                }
-                data = self.db_table.format_data_for_insertion(**raw_data)
-
-                self.logger.info(f"No entry for {convo_id} - adding new record: {data}")
-                self.db_table.add_data(data)
-                self.db_table.delete_all_except_last_n_records(10)
+        # Hold the database so the lookup & write can't interleave with another thread
+        with self.db:
+            target_entry = self.get_entry_for_id(convo_id)
+            if target_entry:
+                timestamp = target_entry[DatabaseKeys.TIMESTAMP]
+                self.logger.info(
+                    f"Updating DB record @ {timestamp} ({convo_id}): {DatabaseKeys.CAPTURED} = {int(True)}")
+                self.db_table.update_record(timestamp, DatabaseKeys.CAPTURED, int(True))
+
             else:
-                self.logger.info(f"Latest record matches current timestamp... updating anyway?")
-                self.db_table.update_record(timestamp, DatabaseKeys.CAPTURED, captured)
+                timestamp = int(time())
+                captured = int(True)
+                latest_entry = self.db_table.get_latest_record()
+                if latest_entry and latest_entry[DatabaseKeys.TIMESTAMP] != timestamp:
+                    raw_data = {
+                        DatabaseKeys.TIMESTAMP: timestamp,
+                        DatabaseKeys.STATE: GarageDoorStates.OPEN,
+                        DatabaseKeys.ID: convo_id,
+                        DatabaseKeys.CAPTURED: captured,
+                        DatabaseKeys.NOTIFIED: int(False)
+                    }
+                    data = self.db_table.format_data_for_insertion(**raw_data)
+
+                    self.logger.info(f"No entry for {convo_id} - adding new record: {data}")
+                    self.db_table.add_data(data)
+                else:
+                    self.logger.info(f"Latest record matches current timestamp... updating anyway?")
+                    self.db_table.update_record(timestamp, DatabaseKeys.CAPTURED, captured)
 
     # endregion MQTT
     # region Camera
@@ -5,8 +5,6 @@ Author: Charles "Chip" Wood
         github.com/imchipwood
 """
 import json
-import timeit
-from threading import Thread
 
 from library.communication.mqtt import MQTTClient
 from library.controllers import BaseController, get_logger
@@ -46,47 +44,50 @@ class EnvironmentController(BaseController):
 
     def start(self):
         """
-        Start the thread
+        Register with the shared scheduler - first reading happens right away
         """
-        self.logger.info("Starting environment thread")
+        self.logger.info("Starting environment job")
         super().start()
-        self.thread = Thread(target=self.loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.start_job(self.period, delay=self.start_delay)
 
     def stop(self):
         """
-        Stop the thread
+        Cancel the scheduled job
         """
-        self.logger.info("Stopping environment thread")
+        self.logger.info("Stopping environment job")
         super().stop()
 
-    def loop(self):
+    @property
+    def period(self) -> float:
         """
-        Looping method for threading - reads sensor @ desired intervals and publishes results
+        @rtype: float
         """
-        last_time = 0
-        while self.running:
-
-            # Read at the desired frequency
-            now = float(timeit.default_timer())
-            if now - last_time <= self.config.period:
-                continue
+        return self.config.period
 
-            last_time = now
+    @property
+    def start_delay(self) -> float:
+        """
+        First reading happens right away
+        @rtype: float
+        """
+        return 0
 
-            # Do the readings
-            try:
-                humidity, temperature = self.sensor.read_n_times(5)
-            except SensorError as e:
-                self.logger.error(str(e))
-                continue
-            except:
-                self.logger.exception("Some error while reading sensor")
-                continue
+    def loop(self):
+        """
+        Called by the scheduler every config.period seconds - reads sensor and publishes results
+        """
+        # Do the readings
+        try:
+            humidity, temperature = self.sensor.read_n_times(5)
+        except SensorError as e:
+            self.logger.error(str(e))
+            return
+        except:
+            self.logger.exception("Some error while reading sensor")
+            return
 
-            # Publish
-            self.publish(humidity, temperature, self.sensor.units)
+        # Publish
+        self.publish(humidity, temperature, self.sensor.units)
 
     # endregion Threading
     # region Communication
@@ -104,6 +105,7 @@ class EnvironmentController(BaseController):
         if not self.mqtt:
             return
 
+        messages = []
         for topic in self.config.mqtt_topic:
             payload = topic.payload(
                 temperature=temperature,
@@ -112,15 +114,13 @@ class EnvironmentController(BaseController):
             )
 
             self.logger.info(f"Publishing to {topic}: {json.dumps(payload, indent=2)}")
-            try:
-                self.mqtt.single(
-                    topic=str(topic),
-                    payload=payload,
-                    qos=2
-                )
-            except:
-                self.logger.exception("Failed to publish MQTT data!")
-                raise
+            messages.append((str(topic), payload, 2, True))
+
+        try:
+            self.mqtt.publish_many(messages)
+        except:
+            self.logger.exception("Failed to publish MQTT data!")
+            raise
 
     # endregion Communication
 
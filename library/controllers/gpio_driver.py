@@ -4,12 +4,13 @@ Author: Charles "Chip" Wood
         imchipwood@gmail.com
         github.com/imchipwood
 """
-import json
 import logging
-from threading import Thread
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Deque, Tuple
 
 from library import GPIODriverCommands
-from library.communication.mqtt import get_mqtt_error_message, MQTTError
 from library.config import PubSubKeys
 from library.controllers import BaseController, get_logger
 from library.sensors.gpio_driver import GPIODriver
@@ -30,6 +31,9 @@ if False:
 
 class GPIODriverController(BaseController):
 
+    # Commands are only queued on the network thread - keeps their arrival time for debouncing
+    HANDLE_INLINE = True
+
     def __init__(self, config, debug=False):
         """
         @param config: configuration object for PiCamera
@@ -47,7 +51,13 @@ class GPIODriverController(BaseController):
             self.config,
             debug=debug
         )
-        self.thread = Thread(target=self.loop)
+
+        # Commands waiting to run, with the time they were received
+        self._commands = deque()  # type: Deque[Tuple[str, float]]
+        self._commands_lock = Lock()
+        self._running_commands = False
+        self._last_command = None  # type: str or None
+        self._last_command_time = 0.0
 
     def setup(self):
         """
@@ -58,15 +68,15 @@ class GPIODriverController(BaseController):
             return
 
         self.logger.debug(f"MQTT Config: {self.mqtt}")
-        self.mqtt.on_connect = self.on_connect
-        self.mqtt.on_subscribe = self.on_subscribe
-        self.mqtt.on_message = self.on_message
+        self.logger.debug(f"Subscribing to {self.subscriptions} on {self.mqtt.connection}")
+        self.mqtt.connection.subscribe(self.subscriptions, self.on_message)
 
-        self.logger.debug("Connecting MQTT")
-        result = self.mqtt.connect()
-        self.logger.debug(f"Connect result: {result}")
-        self.mqtt.loop_start()
+        self.initialize()
 
+    def initialize(self):
+        """
+        Set up the GPIO
+        """
         self.sensor.initialize()
 
     def start(self):
@@ -76,86 +86,110 @@ class GPIODriverController(BaseController):
         self.logger.debug("Starting GPIO Driver MQTT connection")
         super().start()
         self.setup()
-        self.thread.start()
+        self.start_thread()
 
     def stop(self):
         """
-        Disconnect from MQTT
+        Unsubscribe from the shared MQTT connection
         """
         self.logger.info("Shutting down GPIO Driver MQTT connection")
         super().stop()
         try:
-            if not self.mqtt:
-                return
-
-            self.mqtt.loop_stop()
-            result = self.mqtt.disconnect()
-            self.logger.debug(f"Disconnect result: {result}")
+            if self.mqtt:
+                self.mqtt.connection.unsubscribe(self.subscriptions, self.on_message)
         except:
-            self.logger.exception("Exception while disconnecting from MQTT - ignoring")
+            self.logger.exception("Exception while unsubscribing from MQTT - ignoring")
 
-    def loop(self):  # pragma: no cover
+    def loop(self):
         """
-        No actual threading for Camera
-        No coverage because
+        Nothing to do here - the shared MQTT connection's network thread
+        delivers messages. Block until stop() is called instead of spinning
         """
-        self.logger.debug("Starting MQTT loop")
+        self.logger.debug("Waiting for stop")
         try:
-            while self.running:
-                pass
+            self.wait_for_stop()
         except KeyboardInterrupt:
             self.logger.debug("KeyboardInterrupt, ignoring")
-        finally:
-            self.stop()
-
-    def on_connect(self, client, userdata, flags, rc):
-        """
-        Event handler for MQTT connection
-        """
-        self.logger.info(f"mqtt: (CONNECT) client {client._client_id} received with code {rc}")
-
-        # Check the connection results
-        if rc != 0:  # pragma: no cover
-            message = get_mqtt_error_message(rc)
-            self.logger.error(message)
-            raise MQTTError(f"on_connect 'rc' failure - {message}")
-
-        # Nothing wrong with RC - subscribe to topic
-        self.logger.info("Connection successful")
-        # Subscribe to all topics simultaneously
-        self.mqtt.subscribe([(x.name, 2) for x in self.config.mqtt_topic])
 
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+    def handle_message(self, topic: str, message_data: dict):
         """
-        Simply log subscription status
-        """
-        self.logger.debug(f"mqtt: (SUBSCRIBE) client: {client._client_id}, mid {mid}, granted_qos: {granted_qos}")
-
-    def on_message(self, client, userdata, msg):
-        """
-        Handler for new MQTT message
+        Queue the command in a message
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
         """
-        self.logger.debug(f"mqtt: (MESSAGE) client: {client._client_id}, topic: {msg.topic}, QOS: {msg.qos}")
-
-        # Convert message to JSON
-        payload = msg.payload.decode("utf-8")
-        self.logger.debug(f"received payload: {payload}")
-        try:
-            message_data = json.loads(payload)
-        except ValueError as e:
-            self.logger.warning(f"Some error while converting string payload to dict: {e}")
-            return
-
-        command = self.get_gpio_command_from_message(msg.topic, message_data)
-        if command == GPIODriverCommands.TOGGLE:
-            thread = Thread(target=self.toggle_loop)
-            thread.start()
-        elif command == GPIODriverCommands.ON:
-            thread = Thread(target=self.gpio_on_loop)
-            thread.start()
-        elif command == GPIODriverCommands.OFF:
-            thread = Thread(target=self.gpio_off_loop)
-            thread.start()
+        command = self.get_gpio_command_from_message(topic, message_data)
+        if command:
+            self.queue_command(command)
+
+    # region Commands
+
+    def queue_command(self, command: str) -> bool:
+        """
+        Queue a command to run after any others. Within the debounce window,
+        a repeat of the last command is ignored and an ON/OFF replaces an
+        ON/OFF which hasn't run yet
+        @param command: one of GPIODriverCommands
+        @type command: str
+        @return: True if the command was queued or replaced a queued command
+        @rtype: bool
+        """
+        now = monotonic()
+        debounce = self.config.debounce
+        with self._commands_lock:
+            if command == self._last_command and now - self._last_command_time < debounce:
+                self.logger.debug(f"Ignoring repeated {command} command")
+                return False
+            self._last_command = command
+            self._last_command_time = now
+
+            levels = [GPIODriverCommands.ON, GPIODriverCommands.OFF]
+            if command in levels and self._commands and self._commands[-1][0] in levels \
+                    and now - self._commands[-1][1] < debounce:
+                self.logger.debug(f"{command} replaces queued {self._commands[-1][0]} command")
+                self._commands[-1] = (command, now)
+                return True
+
+            self._commands.append((command, now))
+            if self._running_commands:
+                return True
+            self._running_commands = True
+
+        if not self.executor.submit(self.run_commands):
+            with self._commands_lock:
+                self._running_commands = False
+            return False
+        return True
+
+    def run_commands(self):
+        """
+        Run queued commands one at a time until the queue is empty
+        """
+        while True:
+            with self._commands_lock:
+                if not self._commands:
+                    self._running_commands = False
+                    return
+                command, _ = self._commands.popleft()
+
+            try:
+                self.get_command_method(command)()
+            except:
+                self.logger.exception(f"Exception running {command} command")
+
+    def get_command_method(self, command: str or None):
+        """
+        Get the method which carries out a command
+        @param command: one of GPIODriverCommands or None
+        @type command: str or None
+        @return: method for the command or None if there's nothing to do
+        """
+        return {
+            GPIODriverCommands.TOGGLE: self.toggle_loop,
+            GPIODriverCommands.ON: self.gpio_on_loop,
+            GPIODriverCommands.OFF: self.gpio_off_loop,
+        }.get(command)
 
     def get_gpio_command_from_message(self, message_topic, message_data) -> str or None:
         """
@@ -196,11 +230,16 @@ class GPIODriverController(BaseController):
         """
         self.sensor.write_off()
 
+    # endregion Commands
+
     def cleanup(self):
         """
         Gracefully exit
         """
         super().cleanup()
+        with self._commands_lock:
+            self._commands.clear()
+            self._running_commands = False
         self.sensor.cleanup()
         self.logger.info("Cleanup complete")
 
@@ -5,7 +5,6 @@ Author: Charles "Chip" Wood
         github.com/imchipwood
 """
 import time
-from threading import Thread
 
 from library import GarageDoorStates
 from library.config import DatabaseKeys
@@ -65,31 +64,31 @@ class GPIOMonitorController(BaseController):
 
     def start(self):
         """
-        Start the thread
+        Register with the shared scheduler
         """
-        self.logger.info("Starting GPIO monitor thread")
+        self.logger.info("Starting GPIO monitor job")
         super().start()
-        self.thread = Thread(target=self.loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.start_job(self.period, delay=self.start_delay)
 
     def stop(self):
         """
-        Stop the thread
+        Cancel the scheduled job
         """
-        self.logger.info("Stopping GPIO monitor thread")
+        self.logger.info("Stopping GPIO monitor job")
         super().stop()
 
+    @property
+    def period(self) -> float:
+        """
+        @rtype: float
+        """
+        return self.sensor.config.period
+
     def loop(self):
         """
-        Loop for monitoring GPIO
+        Called by the scheduler every period - read the GPIO
         """
-        last_time = time.time()
-        while self.running:
-            current_time = time.time()
-            if current_time - last_time > self.sensor.config.period:
-                last_time = current_time
-                self.state = self.sensor.read()
+        self.state = self.sensor.read()
 
     # endregion Threading
     # region Communication
@@ -110,17 +109,20 @@ class GPIOMonitorController(BaseController):
         convo_id = self.add_entry_to_database()
 
         # Publish to all topics
+        messages = []
         for topic in self.config.mqtt_topic:
 
-            # Convert state to MQTT payload and attempt to publish
+            # Convert state to MQTT payload
             payload = topic.payload(state=str(self), convo_id=convo_id)
             self.logger.info(f"Publishing to {topic}: {payload}")
-            try:
-                self.mqtt.single(topic=str(topic), payload=payload, qos=2)
-                self.logger.debug(f"Published to {topic}")
-            except:
-                self.logger.exception(f"Failed to publish to topic {topic.name}:\n\t{payload}")
-                raise
+            messages.append((str(topic), payload, 2, True))
+
+        try:
+            self.mqtt.publish_many(messages)
+            self.logger.debug(f"Published to {', '.join(x[0] for x in messages)}")
+        except:
+            self.logger.exception(f"Failed to publish:\n\t{messages}")
+            raise
 
     def should_publish(self) -> bool:
         """
@@ -173,7 +175,6 @@ class GPIOMonitorController(BaseController):
                 data = table.format_data_for_insertion(**raw_data)
                 self.logger.debug(f"Adding data to db: {data}")
                 table.add_data(data)
-                table.delete_all_except_last_n_records(2)
 
         return convo_id
 
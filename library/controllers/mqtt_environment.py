@@ -4,13 +4,12 @@ Collects data from sensors publishing data on MQTT topics
 instead of reading sensors connected to the RPi directly
 """
 
-import json
-from threading import Thread
 import time
-import datetime
+from typing import List
 
-from library.communication.mqtt import get_mqtt_error_message, MQTTError
 from library.controllers import BaseController, get_logger
+from library.data.ingest import IngestBuffer
+from library.data.timestamp import TimestampGenerator, get_resolution
 
 if False:
     from library.config.mqtt_environment import MqttEnvironmentConfig
@@ -21,6 +20,9 @@ class MqttEnvironmentController(BaseController):
     Simple controller that subscribes to MQTT topics and
     stores data received into a database
     """
+    # Readings are only timestamped & buffered - a bounded handler queue would drop bursts
+    HANDLE_INLINE = True
+
     def __init__(self, config, debug=False):
         super().__init__(config, debug)
 
@@ -28,7 +30,45 @@ class MqttEnvironmentController(BaseController):
 
         self.logger = get_logger(__name__, debug, config.log)
 
-        self.thread = Thread(target=self.loop)
+        # Readings are written in batches instead of one commit per message
+        self.ingest = IngestBuffer(
+            self.write_readings,
+            batch_size=config.ingest_batch_size,
+            max_delay=config.ingest_max_delay,
+            max_rows=config.ingest_max_rows,
+            name=f"{self.name}-ingest",
+            # Keep readings through Wi-Fi & database outages instead of dropping them
+            transient_errors=self.db_connection_errors
+        )
+
+        # Readings are keyed by timestamp - never hand out the same one twice
+        self.timestamps = self.get_timestamp_generator()
+
+        # Sensor ids already in the meta table - loaded once per DB connection
+        self.known_ids = set()
+        self._known_ids_table = None
+
+    def get_timestamp_generator(self) -> TimestampGenerator:
+        """
+        Make a timestamp generator whose ticks the readings table can store
+        without rounding two of them to the same value
+        @rtype: TimestampGenerator
+        """
+        if self.config.timestamp_precision is not None:
+            return TimestampGenerator(self.config.timestamp_precision)
+        columns = None
+        if self.config.db_enabled and self.config.mqtt_config:
+            columns = self.config.db_tables.get(self.config.mqtt_config.db_table_name)
+        if not columns:
+            return TimestampGenerator()
+        column = next((x for x in columns if x.name == "timestamp"), columns[0])
+        precision, ticks_per_second = get_resolution(column, self.config.db_type)
+        if ticks_per_second < 1000:
+            self.logger.warning(
+                f"'{column.name}' column type {column.type} only stores {ticks_per_second} distinct timestamps "
+                f"per second - faster readings are stored ahead of time. Use datetime2(6) instead"
+            )
+        return TimestampGenerator(precision, ticks_per_second)
 
     def setup(self):
         """
@@ -39,14 +79,8 @@ class MqttEnvironmentController(BaseController):
             return
 
         self.logger.debug(f"MQTT Config: {self.mqtt}")
-        self.mqtt.on_connect = self.on_connect
-        self.mqtt.on_subscribe = self.on_subscribe
-        self.mqtt.on_message = self.on_message
-
-        self.logger.debug("Connecting MQTT")
-        result = self.mqtt.connect()
-        self.logger.debug(f"Connection result: {result}")
-        self.mqtt.loop_start()
+        self.logger.debug(f"Subscribing to {self.subscriptions} on {self.mqtt.connection}")
+        self.mqtt.connection.subscribe(self.subscriptions, self.on_message)
 
     def start(self):
         """
@@ -55,114 +89,124 @@ class MqttEnvironmentController(BaseController):
         self.logger.debug("Starting Camera MQTT connection")
         super().start()
         self.setup()
-        self.thread.start()
+        self.start_thread()
 
     def stop(self):
         """
-        Disconnect from MQTT
+        Unsubscribe from the shared MQTT connection and write any buffered readings
         """
         self.logger.info("Shutting down environment MQTT connection")
         super().stop()
         try:
             if self.mqtt:
-                self.mqtt.loop_stop()
-                result = self.mqtt.disconnect()
-                self.logger.debug(f"Disconnect result: {result}")
+                self.mqtt.connection.unsubscribe(self.subscriptions, self.on_message)
         except:
-            self.logger.exception("Exception while disconnecting from MQTT - ignoring")
+            self.logger.exception("Exception while unsubscribing from MQTT - ignoring")
+        self.ingest.close()
+
+    def health(self) -> dict:
+        """
+        Get a summary of this controller's state, including ingest throughput
+        @rtype: dict
+        """
+        health = super().health()
+        health["ingest"] = self.ingest.metrics()
+        return health
 
-    def loop(self):  # pragma: no cover
+    def loop(self):
         """
-        No actual threading for Camera
-        No coverage because
+        Nothing to do here - the shared MQTT connection's network thread
+        delivers messages. Block until stop() is called instead of spinning
         """
-        self.logger.debug("Starting MQTT loop")
+        self.logger.debug("Waiting for stop")
         try:
-            while self.running:
-                pass
+            self.wait_for_stop()
         except KeyboardInterrupt:
             self.logger.debug("KeyboardInterrupt, ignoring")
-        finally:
-            self.cleanup()
 
     # region MQTT
 
-    def on_connect(self, client, userdata, flags, rc):
-        """
-        Event handler for MQTT connection
-        """
-        self.logger.info(f"mqtt: (CONNECT) client {client._client_id} received with code {rc}")
-
-        # Check the connection results
-        if rc != 0:  # pragma: no cover
-            message = get_mqtt_error_message(rc)
-            self.logger.error(message)
-            raise MQTTError(f"on_connect 'rc' failure - {message}")
-
-        # Nothing wrong with RC - subscribe to topic
-        self.logger.info("Connection successful")
-        # Subscribe to all topics simultaneously
-        self.mqtt.subscribe([(x.name, 2) for x in self.config.mqtt_topic])
-
-    def on_subscribe(self, client, userdata, mid, granted_qos):
-        """
-        Simply log subscription status
+    def handle_message(self, topic: str, message_data: dict):
         """
-        self.logger.debug(f"mqtt: (SUBSCRIBE) client: {client._client_id}, mid {mid}, granted_qos: {granted_qos}")
-
-    def on_message(self, client, userdata, msg):
+        Queue an environment reading to be stored
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
         """
-        Handler for new MQTT message
-        """
-        self.logger.debug(f"mqtt: (MESSAGE) client: {client._client_id}, topic: {msg.topic}, QOS: {msg.qos}")
-
-        # Convert message to JSON
-        payload = msg.payload.decode("utf-8")
-        self.logger.debug(f"received payload: {payload}")
-        try:
-            message_data = json.loads(payload)
-        except ValueError as e:
-            self.logger.warning(f"Some error while converting string payload to dict: {e}")
-            return
-
         # Get message data ready
         # ISO8601 format: YYYY-MM-DD HH:MM:SS.SSS
-        tmp_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f").split(".")
-        timestamp = tmp_timestamp[0] + "." + tmp_timestamp[1][:3]
+        timestamp = self.timestamps.next()
         temperature = message_data.get('temperature')
         humidity = message_data.get('humidity')
-        msg_id = message_data.get('id', msg.topic)
+        msg_id = message_data.get('id', topic)
 
-        try:
-            # write to database
-            with self.db as db:
-                # meta table available?
-                if len(db.tables) > 1:
-                    meta_table = list(db.tables.values())[0]
-                    self.logger.debug(f"meta table found: {meta_table.name}")
-
-                    # check if meta table has entry for this id
-                    if not meta_table.get_record(msg_id):
+        formatted_message = f"{msg_id} @ {timestamp}: {temperature}f, {humidity}%"
+        self.logger.info(formatted_message)
+        self.ingest.put([timestamp, msg_id, temperature, humidity])
+
+    def load_known_ids(self, meta_table):
+        """
+        Load the sensor ids in the meta table, once per DB connection, so
+        readings from known sensors don't need a lookup
+        @param meta_table: meta table
+        @type meta_table: library.data.database.BaseTable
+        """
+        # Tables are recreated when they're checked again (every connect, or after a
+        # connection failure for pooled DBs) - a new one means the DB may have changed
+        if meta_table is self._known_ids_table:
+            return
+        primary = meta_table.primary_column_name
+        self.known_ids = {entry[primary] for entry in meta_table.get_all_records()}
+        self._known_ids_table = meta_table
+        self.logger.debug(f"Loaded {len(self.known_ids)} known sensor ids from {meta_table.name}")
+
+    def write_readings(self, rows: List[List]):
+        """
+        Store a batch of readings in one transaction - called from the ingest buffer
+        @param rows: [timestamp, id, temperature, humidity] for each reading
+        @type rows: list[list]
+        """
+        table_name = self.config.mqtt_config.db_table_name
+        if not table_name:
+            raise Exception("No table name defined in environment MQTT config")
+
+        with self.db as db:
+            # meta table available?
+            if len(db.tables) > 1:
+                meta_table = list(db.tables.values())[0]
+                self.logger.debug(f"meta table found: {meta_table.name}")
+                self.load_known_ids(meta_table)
+
+                # add a meta table entry for each new id in the batch
+                for timestamp, msg_id, _, _ in rows:
+                    if msg_id not in self.known_ids:
                         self.logger.info(f"Meta table entry not found for '{msg_id}' - adding")
                         meta_data = [msg_id, timestamp] + ["" for _ in range(len(meta_table.columns[2:]))]
                         meta_table.add_data(meta_data)
-
-                formatted_message = f"{msg_id} @ {timestamp}: {temperature}f, {humidity}%"
-                self.logger.info(formatted_message)
-
-                table_name = self.config.mqtt_config.db_table_name
-                if not table_name:
-                    raise Exception("No table name defined in environment MQTT config")
-                table = db.get_table(table_name)
-                if not table:
-                    raise Exception(f"Could not find table '{table_name}' in db '{self.config.db_name}'")
-                table.add_data([timestamp, msg_id, temperature, humidity])
-        except Exception as e:
-            # it's possible for on_message to fire for two messages nearly simultaneously
-            # and wind up with the same timestamp, which is the DBs primary key.
-            # this could crash the thread
-            # just catch it and log it to prevent crashes
-            self.logger.exception(str(e))
+                        self.known_ids.add(msg_id)
+
+            table = db.get_table(table_name)
+            if not table:
+                raise Exception(f"Could not find table '{table_name}' in db '{self.config.db_name}'")
+            try:
+                table.add_data_multiple(rows)
+            except db.CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                # timestamps are unique within this process, but a reading can still
+                # collide with a row from before a restart if the clock went backwards.
+                # that fails the whole batch - retry one row at a time so only
+                # the duplicates are lost
+                self.logger.warning(f"Batch insert failed ({e}) - inserting readings one at a time")
+                db.connection.rollback()
+                for row in rows:
+                    try:
+                        table.add_data(row)
+                    except db.CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:
+                        self.logger.error(f"Failed to store reading {row}: {e}")
 
     # endregion MQTT
 
@@ -4,14 +4,11 @@ Author: Charles "Chip" Wood
         imchipwood@gmail.com
         github.com/imchipwood
 """
-import json
-from threading import Thread
 from time import time
 
 from urllib3.exceptions import MaxRetryError
 
-from library import GarageDoorStates
-from library.communication.mqtt import MQTTError, get_mqtt_error_message
+from library import ControllerStates, GarageDoorStates
 from library.communication.pushbullet import PushBulletNotify
 from library.config import PubSubKeys, DatabaseKeys
 from library.controllers import BaseController, get_logger
@@ -54,84 +51,49 @@ class PushBulletController(BaseController):
         """
         self.logger.debug("Starting PushBullet MQTT connection")
         super().start()
-        self.mqtt.on_message = self.on_message
-        self.mqtt.on_subscribe = self.on_subscribe
-        self.mqtt.on_connect = self.on_connect
-
         if not self.config.mqtt_topic:
+            # Nothing to subscribe to - only the retention jobs (if any) run
+            self.logger.warning("No MQTT topics defined! Nothing for PushBulletController to subscribe to")
+            self.status = ControllerStates.RUNNING
             return
 
-        self.mqtt.connect()
-        self.thread = Thread(target=self.loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.logger.debug(f"Subscribing to {self.subscriptions} on {self.mqtt.connection}")
+        self.mqtt.connection.subscribe(self.subscriptions, self.on_message)
+        self.start_thread()
 
     def stop(self):
         """
-        Disconnect from MQTT
+        Unsubscribe from the shared MQTT connection
         """
         self.logger.info("Shutting down PushBullet MQTT connection")
         super().stop()
         try:
-            self.mqtt.loop_stop()
-            self.mqtt.disconnect()
+            self.mqtt.connection.unsubscribe(self.subscriptions, self.on_message)
         except:
-            self.logger.exception("Exception while disconnecting from MQTT - ignoring")
+            self.logger.exception("Exception while unsubscribing from MQTT - ignoring")
 
     def loop(self):
         """
-        No actual threading for PushBullet
+        Nothing to do here - the shared MQTT connection's network thread
+        delivers messages. Block until stop() is called
         """
         try:
-            self.mqtt.loop_forever()
+            self.wait_for_stop()
         except KeyboardInterrupt:
             pass
 
     # endregion Threading
     # region MQTT
 
-    def on_connect(self, client, userdata, flags, rc):
-        """
-        Event handler for MQTT connection
-        """
-        self.logger.info(f"mqtt: (CONNECT) client {client._client_id} received with code {rc}")
-
-        # Check the connection results
-        if rc != 0:  # pragma: no cover
-            message = get_mqtt_error_message(rc)
-
-            self.logger.error(message)
-            raise MQTTError(f"on_connect 'rc' failure - {message}")
-
-        # Nothing wrong with RC - subscribe to topic
-        topics = [x.name for x in self.config.mqtt_topic]
-        self.logger.info(f"Connection successful - subscribing to {topics}")
-        # Subscribe to all topics simultaneously
-        self.mqtt.subscribe([(x, 2) for x in topics])
-
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+    def handle_message(self, topic: str, message_data: dict):
         """
-        Simply log subscription status
+        Send a notification for a message if needed
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
         """
-        self.logger.debug(f"mqtt: (SUBSCRIBE) client: {client._client_id}, mid {mid}, granted_qos: {granted_qos}")
-
-    def on_message(self, client, userdata, msg):
-        """
-        Handler for new MQTT message
-        """
-        self.logger.debug(f"mqtt: (MESSAGE) client: {client._client_id}, topic: {msg.topic}, QOS: {msg.qos}")
-
-        # Convert message to JSON
-        payload = msg.payload.decode("utf-8")
-        self.logger.debug(f"received payload: {payload}")
-        try:
-            message_data = json.loads(payload)
-        except ValueError as e:
-            self.logger.warning(f"Some error while converting string payload to dict: {e}")
-            return
-
-        topic = self.mqtt.config.topics_subscribe.get(msg.topic)
-        if not topic:
+        if not self.mqtt.config.topics_subscribe.get(topic):
             return
 
         state = message_data.get(PubSubKeys.STATE)
@@ -154,7 +116,7 @@ class PushBulletController(BaseController):
                 return
             try:
                 self.logger.debug(f"Sending text notification for state {state} from id {convo_id}")
-                self.notifier.send_text(msg.topic, notification)
+                self.notifier.send_text(topic, notification)
                 self.mark_entry_notified(convo_id=convo_id, state=state)
             except:
                 self.logger.exception("Exception attempting to send PushBullet text notification")
@@ -206,7 +168,6 @@ class PushBulletController(BaseController):
             data = self.db.format_data_for_insertion(**raw_data)
             self.logger.debug(f"Didn't find DB entry for id '{convo_id}' - adding {data}")
             self.db.add_data(data)
-            self.db.delete_all_except_last_n_records(10)
 
     def should_text_notify(self, convo_id: str) -> bool:
         """
@@ -1,10 +1,10 @@
 
 import time
-from threading import Thread
 
 from library import GarageDoorStates
 from library.controllers import BaseController, get_logger
 from library.data.central_database import Database
+from library.data.retention import RetentionPolicy
 
 if False:
     from library.config.timer import TimerConfig
@@ -27,14 +27,12 @@ class TimerController(BaseController):
         self.logger = get_logger(__name__, debug, config.log)
 
     def start(self):
-        self.logger.info("Starting timer thread")
+        self.logger.info("Starting timer job")
         super().start()
-        self.thread = Thread(target=self.loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.start_job(self.period, delay=self.start_delay)
 
     def stop(self):
-        self.logger.info("Stopping timer thread")
+        self.logger.info("Stopping timer job")
         super().stop()
 
     def cleanup(self):
@@ -43,13 +41,30 @@ class TimerController(BaseController):
         """
         self.stop()
 
+    @property
+    def period(self) -> float:
+        """
+        @rtype: float
+        """
+        return self.config.period
+
+    @property
+    def retention_policies(self) -> dict:
+        """
+        Keep about the last two entries of the timer's table unless the config sets its own policy
+        @rtype: dict[str, RetentionPolicy]
+        """
+        policies = super().retention_policies
+        table_name = self.config.mqtt_config.db_table_name if self.config.mqtt_config else None
+        if table_name and table_name not in policies:
+            policies[table_name] = RetentionPolicy(table_name, max_age=2 * self.period, interval=self.period)
+        return policies
+
     def loop(self):
-        last_time = time.time()
-        while self.running:
-            current_time = time.time()
-            if current_time - last_time > self.config.period:
-                last_time = current_time
-                self.publish()
+        """
+        Called by the scheduler every period
+        """
+        self.publish()
 
     def publish(self):
         if not self.mqtt:
@@ -58,17 +73,19 @@ class TimerController(BaseController):
 
         self.add_entry_to_database()
 
+        messages = []
         for topic in self.config.mqtt_topic:
 
             payload = topic.payload(**topic.raw_payload)
             self.logger.info(f"Publishing to {topic}: {payload}")
+            messages.append((str(topic), payload, 2, True))
 
-            try:
-                self.mqtt.single(topic=str(topic), payload=payload, qos=2)
-                self.logger.debug(f"published to {topic}")
-            except:
-                self.logger.exception(f"Failed to publish to topic {topic.name}:\n\t{payload}")
-                raise
+        try:
+            self.mqtt.publish_many(messages)
+            self.logger.debug(f"published to {', '.join(x[0] for x in messages)}")
+        except:
+            self.logger.exception(f"Failed to publish:\n\t{messages}")
+            raise
 
     def add_entry_to_database(self):
         """
@@ -84,5 +101,5 @@ class TimerController(BaseController):
             # Create the entry
             data = [int(time.time()), GarageDoorStates.OPEN, int(False), int(False)]
             self.logger.debug(f"Adding data to db: {data}")
-            db.add_data(data)
-            db.delete_all_except_last_n_records(2)
+            table = db.get_table(table_name)
+            table.add_data(data)
@@ -1,14 +1,16 @@
 import json
-from typing import List
+from collections.abc import Sequence
+from typing import Dict, Iterator, List
 
 
 class DBType:
     LOCAL = "local"
     CENTRAL = "central"
+    RINGBUFFER = "ringbuffer"
 
 
 class Column:
-    def __init__(self, col_name: str, col_type: str, col_key: str, foreign_table: str = None):
+    def __init__(self, col_name: str, col_type: str, col_key: str, foreign_table: str = None, index: bool = False):
         """
         Initialize a database column object
         @param col_name: name of column
@@ -19,12 +21,15 @@ class Column:
         @type col_key: str
         @param foreign_table: optional related table - column name must be identical
         @type foreign_table: str
+        @param index: whether to create a secondary index for lookups by this column
+        @type index: bool
         """
         super()
         self.name = col_name
         self.type = col_type
         self.key = col_key
         self.foreign_table = foreign_table
+        self.index = index
 
     @property
     def primary(self) -> bool:
@@ -52,18 +57,36 @@ class Column:
         return ""
 
 
+def get_column_index(columns: List[Column]) -> Dict[str, int]:
+    """
+    Map column names to their position in a row
+    @param columns: columns of the rows
+    @type columns: list[Column]
+    @rtype: dict[str, int]
+    """
+    return {column.name: i for i, column in enumerate(columns)}
+
+
 class DatabaseEntry:
-    def __init__(self, columns: List[Column], entry):
+    """
+    View of a single database row. The raw row is kept as-is and values are
+    looked up through a name -> position map shared by every row of a query,
+    so no per-row dict is built
+    """
+    __slots__ = ("columns", "entry", "index")
+
+    def __init__(self, columns: List[Column], entry, index: Dict[str, int] or None = None):
         """
         Convenience object to house a single database row
         @param columns: List of columns in the database
         @param entry: raw entry from SQL query
         @type entry:
+        @param index: (Optional) column name -> position map shared between rows
+        @type index: dict[str, int] or None
         """
-        super()
         self.columns = columns
         self.entry = entry
-        self._values = {}
+        self.index = get_column_index(columns) if index is None else index
 
     @property
     def values(self):
@@ -71,16 +94,73 @@ class DatabaseEntry:
         @return: dict of values
         @rtype: dict[str, int or float or str]
         """
-        if not self._values:
-            for i in range(len(self.entry)):
-                self._values[self.columns[i].name] = self.entry[i]
-        return self._values
+        return {name: self.entry[i] for name, i in self.index.items()}
 
     def get(self, item: str, default_val=None) -> int or float or str:
-        return self.values.get(item, default_val)
+        i = self.index.get(item)
+        return default_val if i is None else self.entry[i]
 
     def __getitem__(self, item) -> int or float or str:
-        return self.values.get(item)
+        i = self.index.get(item)
+        return None if i is None else self.entry[i]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DatabaseEntry):
+            return NotImplemented
+        return self.index == other.index and tuple(self.entry) == tuple(other.entry)
+
+    def __repr__(self) -> str:
+        return json.dumps(self.values, default=str)
+
+
+class ResultSet(Sequence):
+    """
+    Rows from one query. The columns are stored once and rows are kept as
+    the raw tuples the driver returned - DatabaseEntry views are only made
+    as rows are accessed
+    """
+    __slots__ = ("columns", "index", "rows")
+
+    def __init__(self, columns: List[Column], rows: List, index: Dict[str, int] or None = None):
+        """
+        @param columns: columns of the rows
+        @type columns: list[Column]
+        @param rows: raw rows from the query
+        @type rows: list
+        @param index: (Optional) column name -> position map
+        @type index: dict[str, int] or None
+        """
+        self.columns = columns
+        self.rows = rows
+        self.index = get_column_index(columns) if index is None else index
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int or slice) -> DatabaseEntry or "ResultSet":
+        if isinstance(i, slice):
+            return ResultSet(self.columns, self.rows[i], self.index)
+        return DatabaseEntry(self.columns, self.rows[i], self.index)
+
+    def __iter__(self) -> Iterator[DatabaseEntry]:
+        columns, index = self.columns, self.index
+        for row in self.rows:
+            yield DatabaseEntry(columns, row, index)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ResultSet):
+            return self.rows == other.rows
+        return list(self) == other
 
     def __repr__(self) -> str:
-        return json.dumps(self._values)
+        return f"ResultSet({len(self.rows)} rows of {', '.join(self.index)})"
+
+    def column(self, name: str) -> list:
+        """
+        Get every value of one column, e.g. for plotting
+        @param name: name of the column
+        @type name: str
+        @rtype: list
+        """
+        i = self.index[name]
+        return [row[i] for row in self.rows]
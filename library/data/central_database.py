@@ -1,12 +1,14 @@
 import datetime
 import logging
 import sys
-from typing import List, Dict
+import time
+from typing import Dict, Iterator, List
 
 import pyodbc
 
 from library.data import Column, DatabaseEntry
-from library.data.database import BaseTable, BaseDatabase
+from library.data.database import BaseTable, BaseDatabase, QueryKeys
+from library.data.pool import ConnectionPool, get_pool
 
 
 def connect_to_database_server(server_location: str, database_name: str, user: str, pw: str) -> pyodbc.Connection:
@@ -47,9 +49,21 @@ def connect_to_database_server(server_location: str, database_name: str, user: s
 
 
 class CentralTable(BaseTable):
+    # SQL Server takes at most 2100 parameters per statement and 1000 rows per VALUES list
+    MAX_PARAMETERS = 2099
+    MAX_VALUES_ROWS = 1000
+
     def __init__(self, connection: pyodbc.Connection, name: str, columns: List[Column]):
         super().__init__(connection, name, columns)
 
+    @property
+    def insert_chunk_size(self) -> int:
+        """
+        Get the most rows one multi-row INSERT can add
+        @rtype: int
+        """
+        return max(1, min(self.MAX_VALUES_ROWS, self.MAX_PARAMETERS // len(self.columns)))
+
     def does_table_exist(self, table_name: str) -> bool:
         """
         Check if a table exists in the database
@@ -58,10 +72,7 @@ class CentralTable(BaseTable):
         @return: whether the table exists
         @rtype: bool
         """
-        query = f"""
-SELECT name FROM sys.tables WHERE name='{table_name}';
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.TABLE_EXISTS), [table_name])
         result = self.cursor.fetchone()
         return result and result[0] == table_name
 
@@ -83,20 +94,124 @@ SELECT name FROM sys.tables WHERE name='{table_name}';
         query += ")"
         self.cursor.execute(query)
 
+    def create_index(self, column_name: str):
+        """
+        Create a secondary index on a column if it doesn't already exist
+        @param column_name: name of the column
+        @type column_name: str
+        """
+        index_name = self.get_index_name(column_name)
+        self.cursor.execute(f"""
+IF NOT EXISTS (SELECT name FROM sys.indexes WHERE name = '{index_name}')
+  CREATE INDEX {index_name} ON {self.name} ({column_name})
+""")
+        self.cursor.commit()
+
+    def build_query(self, key: str, *args) -> str:
+        """
+        Build a parameterized statement
+        @param key: one of QueryKeys
+        @type key: str
+        @param args: anything the statement depends on, e.g. a column name
+        @return: SQL with placeholders for values
+        @rtype: str
+        """
+        primary = self.primary_column_name
+        if key == QueryKeys.TABLE_EXISTS:
+            return "SELECT name FROM sys.tables WHERE name = ?"
+        if key == QueryKeys.INSERT:
+            return f"INSERT INTO {self.name} ({self.columns_str}) VALUES ({', '.join(['?'] * len(self.columns))})"
+        if key == QueryKeys.INSERT_MANY:
+            rows, = args
+            row = f"({', '.join(['?'] * len(self.columns))})"
+            return f"INSERT INTO {self.name} ({self.columns_str}) VALUES {', '.join([row] * rows)}"
+        if key == QueryKeys.UPDATE:
+            column_name, = args
+            self.check_column_name(column_name)
+            return f"UPDATE {self.name} SET {column_name} = ? WHERE {primary} = ?"
+        if key == QueryKeys.GET:
+            return f"SELECT {self.columns_str} FROM {self.name} WHERE {primary} = ?"
+        if key == QueryKeys.WHERE:
+            column_name, order_by, limited = args
+            self.check_column_name(column_name)
+            self.check_column_name(order_by)
+            top = "TOP (?) " if limited else ""
+            return f"SELECT {top}{self.columns_str} FROM {self.name} WHERE {column_name} = ? ORDER BY {order_by} DESC"
+        if key == QueryKeys.LATEST:
+            return f"SELECT TOP 1 {self.columns_str} FROM {self.name} ORDER BY {primary} DESC"
+        if key == QueryKeys.ALL:
+            return f"SELECT {self.columns_str} FROM {self.name}"
+        if key == QueryKeys.LAST_N:
+            return f"SELECT TOP (?) {self.columns_str} FROM {self.name} ORDER BY {primary} DESC"
+        if key == QueryKeys.DELETE_EXCEPT_LAST_N:
+            return f"""
+DELETE FROM {self.name}
+  WHERE {primary} NOT IN (
+    SELECT TOP (?) {primary}
+    FROM {self.name}
+    ORDER BY {primary} DESC
+  )
+"""
+        if key == QueryKeys.BOUNDS:
+            column_name, bounded = args
+            self.check_column_name(column_name)
+            query = f"SELECT MIN({column_name}), MAX({column_name}) FROM {self.name}"
+            return query + f" WHERE {column_name} >= ?" if bounded else query
+        if key == QueryKeys.BETWEEN:
+            column_name, = args
+            self.check_column_name(column_name)
+            return (
+                f"SELECT {self.columns_str} FROM {self.name} "
+                f"WHERE {column_name} >= ? AND {column_name} < ? ORDER BY {column_name}"
+            )
+        if key == QueryKeys.DELETE_BEFORE:
+            column_name, = args
+            self.check_column_name(column_name)
+            return f"DELETE TOP (?) FROM {self.name} WHERE {column_name} < ?"
+        if key == QueryKeys.RANGE:
+            columns, id_column, id_count, has_start, has_end = args
+            time_column = self.time_column_name
+            conditions = []
+            if has_start:
+                conditions.append(f"{time_column} >= ?")
+            if has_end:
+                conditions.append(f"{time_column} < ?")
+            if id_count:
+                self.check_column_name(id_column)
+                conditions.append(f"{id_column} IN ({', '.join(['?'] * id_count)})")
+            where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+            return f"SELECT {', '.join(columns)} FROM {self.name}{where} ORDER BY {time_column}"
+        raise Exception(f"Unknown query {key}")
+
     def add_data_multiple(self, data_to_add: List[List] or List[tuple]):
         """
-        Add multiple rows the table at once
+        Add multiple rows the table at once, in one transaction. executemany
+        costs a round trip per row, so rows are sent insert_chunk_size at a time
+        as multi-row INSERTs instead - e.g. when backfilling after an outage
         @param data_to_add: multiple rows in a list
         """
-        query = f"""
-INSERT INTO {self.name} (
-  {self.columns_str}
-) VALUES (
-  {', '.join(['?' for x in data_to_add[0]])}
-)
-"""
-        self.cursor.executemany(query, data_to_add)
-        self.connection.commit()
+        if not data_to_add:
+            return
+        start = time.monotonic()
+        chunk_size = self.insert_chunk_size
+        try:
+            for i in range(0, len(data_to_add), chunk_size):
+                chunk = data_to_add[i:i + chunk_size]
+                # Only the full-size statement is cached - the last chunk's size varies
+                if len(chunk) == chunk_size:
+                    query = self.query(QueryKeys.INSERT_MANY, chunk_size)
+                else:
+                    query = self.build_query(QueryKeys.INSERT_MANY, len(chunk))
+                self.cursor.execute(query, [value for row in chunk for value in row])
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+
+        elapsed = time.monotonic() - start
+        rate = len(data_to_add) / elapsed if elapsed else 0.0
+        log = logging.info if len(data_to_add) > chunk_size else logging.debug
+        log(f"{self.name}: inserted {len(data_to_add)} rows in {elapsed:0.2f}s ({rate:0.0f} rows/s)")
 
     def add_data(self, data_to_add: List):
         """
@@ -104,14 +219,7 @@ INSERT INTO {self.name} (
         @param data_to_add: data to add to table
         @type data_to_add: list
         """
-        query = f"""
-INSERT INTO {self.name} (
-  {self.columns_str}
-) VALUES (
-  {', '.join(['?' for x in data_to_add])}
-)
-"""
-        self.cursor.execute(query, data_to_add)
+        self.cursor.execute(self.query(QueryKeys.INSERT), data_to_add)
         self.connection.commit()
 
     def update_record(self, primary_key_value: int or float or str, column_name: str, new_value: int or float or str):
@@ -124,44 +232,55 @@ INSERT INTO {self.name} (
         @param new_value: new value for the column
         @type new_value: int or float or str
         """
-        if isinstance(primary_key_value, str):
-            primary_key_value = primary_key_value.replace("\\", "\\\\")
-        query = f"""
-UPDATE {self.name}
-SET {column_name} = {new_value}
-WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.UPDATE, column_name), [new_value, primary_key_value])
         self.connection.commit()
 
-    def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry:
+    def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry or None:
         """
         Get the target record
         @param primary_key_value: value of the primary column corresponding to the target entry
         @type primary_key_value: int or float or str
-        @return: DatabaseEntry for the target row
-        @rtype: DatabaseEntry
+        @return: DatabaseEntry for the target row or None if there isn't one
+        @rtype: DatabaseEntry or None
         """
-        if isinstance(primary_key_value, str):
-            primary_key_value = primary_key_value.replace("\\", "\\\\")
-        query = f"""SELECT * FROM {self.name} WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.GET), [primary_key_value])
         result = self.cursor.fetchone()
-        if not result:
+        if result is None:
             return None
         return self.convert_query_result_to_database_entry(result)
 
+    def get_records_where(
+            self,
+            column_name: str,
+            value: int or float or str,
+            order_by: str or None = None,
+            limit: int or None = None
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with a column equal to a value, newest first
+        @param column_name: name of the column to match
+        @type column_name: str
+        @param value: value to match exactly
+        @type value: int or float or str
+        @param order_by: (Optional) column to sort by, descending - defaults to the primary column
+        @type order_by: str or None
+        @param limit: (Optional) max number of records to get
+        @type limit: int or None
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        query = self.query(QueryKeys.WHERE, column_name, order_by or self.primary_column_name, limit is not None)
+        self.cursor.execute(query, [value] if limit is None else [limit, value])
+        results = self.cursor.fetchall()
+        return self.convert_query_results_to_database_entries(results)
+
     def get_latest_record(self) -> DatabaseEntry or None:
         """
         Get the latest record from the table
         @return: last record in the table
         @rtype: DatabaseEntry or None
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        others = [x.name for x in self.columns if x.name != primary]
-        others_str = ", ".join(others)
-        query = f"SELECT TOP 1 {primary}, {others_str} FROM {self.name} ORDER BY {primary} DESC"
-        self.cursor .execute(query)
+        self.cursor.execute(self.query(QueryKeys.LATEST))
         result = self.cursor.fetchone()
         if result is None:
             return None
@@ -173,8 +292,7 @@ WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
         @return: list of records
         @rtype: list[DatabaseEntry]
         """
-        query = f"SELECT {self.columns_str} FROM {self.name}"
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.ALL))
         results = self.cursor.fetchall()
         return self.convert_query_results_to_database_entries(results)
 
@@ -186,13 +304,7 @@ WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
         @return: last n records
         @rtype: list[DatabaseEntry]
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        query = f"""
-SELECT TOP {n} * 
-FROM {self.name}
-ORDER BY {primary} DESC
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.LAST_N), [n])
         results = self.cursor.fetchall()
         return self.convert_query_results_to_database_entries(results)
 
@@ -202,17 +314,110 @@ ORDER BY {primary} DESC
         @param n: number of records to keep
         @type n: int
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        query = f"""
-DELETE FROM {self.name}
-  WHERE {primary} NOT IN (
-    SELECT TOP {n} {primary}
-    FROM {self.name}
-    ORDER BY {primary} DESC
-  ) 
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.DELETE_EXCEPT_LAST_N), [n])
+        self.connection.commit()
+
+    def get_column_bounds(self, column_name: str, start: int or float or str or None = None) -> tuple:
+        """
+        Get the smallest & largest values in a column
+        @param column_name: name of the column
+        @type column_name: str
+        @param start: (Optional) only consider values >= start
+        @type start: int or float or str or None
+        @return: (min, max) - both None if there are no rows
+        @rtype: tuple
+        """
+        query = self.query(QueryKeys.BOUNDS, column_name, start is not None)
+        self.cursor.execute(query, [] if start is None else [start])
+        return tuple(self.cursor.fetchone())
+
+    def get_records_between(
+            self,
+            column_name: str,
+            start: int or float or str,
+            end: int or float or str
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with start <= column < end, oldest first
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param start: first value to include
+        @type start: int or float or str
+        @param end: first value to exclude
+        @type end: int or float or str
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        self.cursor.execute(self.query(QueryKeys.BETWEEN, column_name), [start, end])
+        results = self.cursor.fetchall()
+        return self.convert_query_results_to_database_entries(results)
+
+    def query_range_chunks(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            chunk_size: int = 1000
+    ) -> Iterator[list]:
+        """
+        Stream the rows with start <= timestamp < end, oldest first, in chunks of chunk_size
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param chunk_size: rows fetched at a time
+        @type chunk_size: int
+        @return: generator of lists of rows as the driver returns them
+        @rtype: Iterator[list]
+        """
+        range_columns = self.get_range_columns(columns)
+        ids = list(ids or [])
+        query = self.query(
+            QueryKeys.RANGE,
+            tuple(x.name for x in range_columns),
+            id_column,
+            len(ids),
+            start is not None,
+            end is not None
+        )
+        params = [x for x in [start, end] if x is not None] + ids
+
+        # A cursor of its own so other queries on this table don't cut the stream short
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def delete_records_before(self, column_name: str, value: int or float or str, limit: int) -> int:
+        """
+        Delete up to limit records with column < value
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param value: first value to keep
+        @type value: int or float or str
+        @param limit: max number of records to delete
+        @type limit: int
+        @return: number of records deleted
+        @rtype: int
+        """
+        self.cursor.execute(self.query(QueryKeys.DELETE_BEFORE, column_name), [limit, value])
+        deleted = self.cursor.rowcount
         self.connection.commit()
+        return deleted
 
     def drop(self):
         """
@@ -229,8 +434,19 @@ DELETE FROM {self.name}
 
 class Database(BaseDatabase):
     TABLE_CLASS = CentralTable
+    CONNECTION_ERRORS = (pyodbc.OperationalError, pyodbc.InterfaceError)
+    REUSE_TABLES = True
 
-    def __init__(self, tables: Dict[str, List[Column]], server, database, username, password):
+    def __init__(
+            self,
+            tables: Dict[str, List[Column]],
+            server,
+            database,
+            username,
+            password,
+            pool_size: int = 4,
+            pool_max_idle: float = 300.0
+    ):
         """
         Initialize a database with a table
         @param tables: dictionary of table name to columns
@@ -243,25 +459,53 @@ class Database(BaseDatabase):
         @type username: str
         @param password: password to connect to db
         @type password:
+        @param pool_size: max connections open to this server/database/user in this process
+        @type pool_size: int
+        @param pool_max_idle: seconds an unused connection is kept open
+        @type pool_max_idle: float
         """
         # from library.controllers import get_logger
         self.server = server
         self.database = database
         self.username = username
         self.__password = password
+        self.pool_size = pool_size
+        self.pool_max_idle = pool_max_idle
         super().__init__(tables)
 
-    def connect(self):
+    @property
+    def pool(self) -> ConnectionPool:
         """
-        Connect to the database
+        Get the connection pool shared by every Database for this server, database & user
+        @rtype: ConnectionPool
         """
-        self.connection = connect_to_database_server(
-            self.server,
-            self.database,
-            self.username,
-            self.__password
+        return get_pool(
+            (self.server, self.database, self.username),
+            lambda: connect_to_database_server(self.server, self.database, self.username, self.__password),
+            max_size=self.pool_size,
+            max_idle=self.pool_max_idle,
+            transient_errors=self.CONNECTION_ERRORS,
+            name=f"{self.server}/{self.database}"
         )
-        self.create_tables()
+
+    def connect(self):
+        """
+        Get a connection from the pool
+        """
+        self.connection = self.pool.acquire()
+        try:
+            self.create_tables()
+        except:
+            self.cleanup(failed=True)
+            raise
+
+    def release_connection(self, failed: bool):
+        """
+        Hand the connection back to the pool - failed connections are closed
+        @param failed: whether the connection failed
+        @type failed: bool
+        """
+        self.pool.release(self.connection, discard=failed)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,28 @@
+import threading
 from abc import ABC, abstractmethod
 
-from library.data import Column, DatabaseEntry
-from typing import Dict, List
+from library.data import Column, DatabaseEntry, ResultSet, get_column_index
+from typing import Dict, Iterator, List
+
+
+class QueryKeys:
+    """
+    Statements each table builds once and caches
+    """
+    TABLE_EXISTS = "table_exists"
+    INSERT = "insert"
+    INSERT_MANY = "insert_many"
+    UPDATE = "update"
+    GET = "get"
+    WHERE = "where"
+    LATEST = "latest"
+    ALL = "all"
+    LAST_N = "last_n"
+    DELETE_EXCEPT_LAST_N = "delete_except_last_n"
+    BOUNDS = "bounds"
+    BETWEEN = "between"
+    DELETE_BEFORE = "delete_before"
+    RANGE = "range"
 
 
 class BaseTable(ABC):
@@ -18,15 +39,76 @@ class BaseTable(ABC):
         self.connection = connection
         self.name = name
         self.columns = columns
+        # Shared by every row read from this table
+        self.column_index = get_column_index(columns)
         self.cursor = self.connection.cursor()
+        self._queries = {}  # type: Dict[tuple, str]
         self.setup()
 
+    def bind(self, connection):
+        """
+        Move an already set up table onto a new connection to the same database
+        @param connection: database connection - sqlite3.Connection or pyodbc.Connection
+        """
+        self.connection = connection
+        self.cursor = self.connection.cursor()
+
     def setup(self):
         """
-        Set up the database with a table
+        Set up the database with a table and its secondary indexes
         """
         if not self.does_table_exist(self.name):
             self.create_table(self.name, self.columns)
+        for column in self.columns:
+            if column.index and not column.primary:
+                self.create_index(column.name)
+
+    def query(self, key: str, *args) -> str:
+        """
+        Get a parameterized statement, building it the first time. Reusing
+        the exact same SQL lets sqlite3's statement cache and pyodbc's
+        prepared statements skip re-parsing it
+        @param key: one of QueryKeys
+        @type key: str
+        @param args: anything the statement depends on, e.g. a column name
+        @return: SQL with placeholders for values
+        @rtype: str
+        """
+        cache_key = (key,) + args
+        query = self._queries.get(cache_key)
+        if query is None:
+            query = self._queries[cache_key] = self.build_query(key, *args)
+        return query
+
+    @abstractmethod
+    def build_query(self, key: str, *args) -> str:
+        """
+        Build a parameterized statement
+        @param key: one of QueryKeys
+        @type key: str
+        @param args: anything the statement depends on, e.g. a column name
+        @return: SQL with placeholders for values
+        @rtype: str
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_index(self, column_name: str):
+        """
+        Create a secondary index on a column if it doesn't already exist
+        @param column_name: name of the column
+        @type column_name: str
+        """
+        raise NotImplementedError
+
+    def get_index_name(self, column_name: str) -> str:
+        """
+        Get the name of the secondary index on a column
+        @param column_name: name of the column
+        @type column_name: str
+        @rtype: str
+        """
+        return f"idx_{self.name}_{column_name}"
 
     @abstractmethod
     def does_table_exist(self, table_name: str) -> bool:
@@ -51,12 +133,30 @@ class BaseTable(ABC):
         raise NotImplementedError
 
     @property
-    def primary_column_name(self) -> str:
+    def primary_column_name(self) -> str or None:
         """
         Get the primary column name
-        @rtype: str
+        @return: name of the primary key column, None for tables without one (e.g. rollups)
+        @rtype: str or None
+        """
+        return next((x.name for x in self.columns if x.primary), None)
+
+    @property
+    def column_names(self) -> List[str]:
         """
-        return [x.name for x in self.columns if x.primary][0]
+        @return: names of the columns in the table
+        @rtype: list[str]
+        """
+        return [x.name for x in self.columns]
+
+    def check_column_name(self, column_name: str):
+        """
+        Make sure a column exists before putting its name in a query
+        @param column_name: name of the column
+        @type column_name: str
+        """
+        if column_name not in self.column_names:
+            raise Exception(f"Table {self.name} has no column {column_name}")
 
     @property
     def columns_str(self) -> str:
@@ -122,17 +222,17 @@ class BaseTable(ABC):
         @return: DatabaseEntry object
         @rtype: DatabaseEntry
         """
-        return DatabaseEntry(self.columns, result)
+        return DatabaseEntry(self.columns, result, self.column_index)
 
-    def convert_query_results_to_database_entries(self, results: List) -> List[DatabaseEntry]:
+    def convert_query_results_to_database_entries(self, results: List) -> ResultSet:
         """
-        Convert multiple query results into a list of DatabaseEntry objects
+        Convert multiple query results into a ResultSet - a list-like sequence of DatabaseEntry objects
         @param results: list of lists of table entry values
         @type results: list[list]
-        @return: list of DatabaseEntry objects
-        @rtype: list[DatabaseEntry]
+        @return: ResultSet of the rows
+        @rtype: ResultSet
         """
-        return [self.convert_query_result_to_database_entry(result) for result in results]
+        return ResultSet(self.columns, results, self.column_index)
 
     @abstractmethod
     def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry:
@@ -145,6 +245,30 @@ class BaseTable(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def get_records_where(
+            self,
+            column_name: str,
+            value: int or float or str,
+            order_by: str or None = None,
+            limit: int or None = None
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with a column equal to a value, newest first. Add
+        "col_index": true to the column's config to make this an index lookup
+        @param column_name: name of the column to match
+        @type column_name: str
+        @param value: value to match exactly
+        @type value: int or float or str
+        @param order_by: (Optional) column to sort by, descending - defaults to the primary column
+        @type order_by: str or None
+        @param limit: (Optional) max number of records to get
+        @type limit: int or None
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def get_latest_record(self) -> DatabaseEntry or None:
         """
@@ -183,6 +307,181 @@ class BaseTable(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def get_column_bounds(self, column_name: str, start: int or float or str or None = None) -> tuple:
+        """
+        Get the smallest & largest values in a column
+        @param column_name: name of the column
+        @type column_name: str
+        @param start: (Optional) only consider values >= start
+        @type start: int or float or str or None
+        @return: (min, max) - both None if there are no rows
+        @rtype: tuple
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_records_between(
+            self,
+            column_name: str,
+            start: int or float or str,
+            end: int or float or str
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with start <= column < end, oldest first
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param start: first value to include
+        @type start: int or float or str
+        @param end: first value to exclude
+        @type end: int or float or str
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        raise NotImplementedError
+
+    @property
+    def time_column_name(self) -> str:
+        """
+        Get the column time ranges are queried on - the primary key, or the first column of rollup tables
+        @rtype: str
+        """
+        return self.primary_column_name or self.columns[0].name
+
+    def get_range_columns(self, columns: List[str] or None) -> List[Column]:
+        """
+        Get the columns a range query returns
+        @param columns: names of the columns, or None for all of them
+        @type columns: list[str] or None
+        @rtype: list[Column]
+        """
+        if columns is None:
+            return self.columns
+        for column_name in columns:
+            self.check_column_name(column_name)
+        return [x for x in self.columns if x.name in columns]
+
+    def query_range(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            chunk_size: int = 1000
+    ) -> Iterator[DatabaseEntry]:
+        """
+        Stream the records with start <= timestamp < end, oldest first. Rows
+        are fetched chunk_size at a time so any number of them can be read in
+        constant memory - the database should be held ('with db') until done
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param chunk_size: rows fetched at a time
+        @type chunk_size: int
+        @return: generator of records
+        @rtype: Iterator[DatabaseEntry]
+        """
+        range_columns = self.get_range_columns(columns)
+        index = get_column_index(range_columns)
+        for rows in self.query_range_chunks(start, end, ids, columns, id_column, chunk_size):
+            for row in rows:
+                yield DatabaseEntry(range_columns, row, index)
+
+    @abstractmethod
+    def query_range_chunks(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            chunk_size: int = 1000
+    ) -> Iterator[list]:
+        """
+        Stream the rows query_range gets in chunks of chunk_size, as the
+        driver returns them - for bulk readers which don't need a record per row
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param chunk_size: rows fetched at a time
+        @type chunk_size: int
+        @return: generator of lists of rows
+        @rtype: Iterator[list]
+        """
+        raise NotImplementedError
+
+    def export_range(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            group_by: str or None = None,
+            chunk_size: int = 10000
+    ) -> dict:
+        """
+        Stream the records with start <= timestamp < end straight into typed
+        NumPy arrays - datetime64 timestamps, float32 reals - without building
+        a DatabaseEntry list. Needs numpy. Save the result with
+        library.data.export.save_arrays
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param group_by: (Optional) name of a column, e.g. id, to split the arrays by
+        @type group_by: str or None
+        @param chunk_size: rows fetched & converted at a time
+        @type chunk_size: int
+        @return: dictionary of column names to arrays or, if grouped, of group values to those
+        @rtype: dict
+        """
+        from library.data.export import group_arrays, require_numpy, to_arrays
+        require_numpy()
+        range_columns = self.get_range_columns(columns)
+        chunks = self.query_range_chunks(start, end, ids, columns, id_column, chunk_size)
+        arrays = to_arrays(chunks, range_columns)
+        if group_by:
+            return group_arrays(arrays, group_by)
+        return arrays
+
+    @abstractmethod
+    def delete_records_before(self, column_name: str, value: int or float or str, limit: int) -> int:
+        """
+        Delete up to limit records with column < value, so old data can be
+        removed in small batches without holding a long lock
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param value: first value to keep
+        @type value: int or float or str
+        @param limit: max number of records to delete
+        @type limit: int
+        @return: number of records deleted
+        @rtype: int
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def drop(self):
         """
@@ -193,21 +492,49 @@ class BaseTable(ABC):
 
 class BaseDatabase(ABC):
     TABLE_CLASS = None
+    # Exceptions which mean the connection should be dropped and reopened
+    CONNECTION_ERRORS = ()
+    # Whether tables checked on one connection are reused on the next instead of being checked
+    # again - for pooled connections, which all reach the same database
+    REUSE_TABLES = False
 
     def __init__(self, tables: Dict[str, List[Column]]):
         super()
         self.table_definitions = tables
         self.tables = {}  # type: dict[str, BaseTable]
+        # Tables set up on an earlier connection - see REUSE_TABLES
+        self.checked_tables = {}  # type: dict[str, BaseTable]
         self.connection = None
+        # Keep the connection open between 'with' blocks - see __exit__
+        self.keep_open = False
+        self._lock = threading.RLock()
+        # Number of 'with' blocks this database is in
+        self._depth = 0
+
+    @property
+    def connected(self) -> bool:
+        """
+        Check if there's an open connection
+        @rtype: bool
+        """
+        return self.connection is not None
 
     def create_tables(self):
         """
-        Create tables based on given definitions
+        Create tables based on given definitions - tables are only checked once per connection,
+        or only once at all if REUSE_TABLES is set
         """
         if self.tables or not self.TABLE_CLASS:
             return
+        if self.checked_tables:
+            for table in self.checked_tables.values():
+                table.bind(self.connection)
+            self.tables = dict(self.checked_tables)
+            return
         for table_name, columns in self.table_definitions.items():
             self.tables[table_name] = self.TABLE_CLASS(self.connection, table_name, columns)
+        if self.REUSE_TABLES:
+            self.checked_tables = dict(self.tables)
 
     def get_table(self, table_name: str) -> BaseTable or None:
         """
@@ -227,11 +554,54 @@ class BaseDatabase(ABC):
         raise NotImplementedError
 
     def __enter__(self):
-        self.connect()
+        """
+        Hold the database for this thread, connecting if needed
+        """
+        self._lock.acquire()
+        try:
+            if not self.connected:
+                self.connect()
+        except:
+            self._lock.release()
+            raise
+        self._depth += 1
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cleanup()
+        """
+        Release the database - the connection is closed unless keep_open is
+        set, in which case it's only closed if it failed so the next 'with'
+        block reconnects (and re-checks the tables)
+        """
+        self._depth -= 1
+        try:
+            # Nested 'with' blocks leave the connection to the outermost one
+            if exc_type and issubclass(exc_type, self.CONNECTION_ERRORS):
+                self.cleanup(failed=True)
+            elif not self.keep_open and not self._depth:
+                self.cleanup()
+        finally:
+            self._lock.release()
+
+    def cleanup(self, failed: bool = False):
+        """
+        Close the connection
+        @param failed: whether the connection failed
+        @type failed: bool
+        """
+        with self._lock:
+            if self.connection is not None:
+                self.release_connection(failed)
+                self.connection = None
+            self.tables = {}
+            if failed:
+                # Check the tables again once reconnected
+                self.checked_tables = {}
 
-    def cleanup(self):
+    def release_connection(self, failed: bool):
+        """
+        Close the connection - backends with a connection pool hand it back instead
+        @param failed: whether the connection failed
+        @type failed: bool
+        """
         self.connection.close()
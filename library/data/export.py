@@ -0,0 +1,132 @@
+"""
+Bulk export of time ranges into typed NumPy arrays
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from library.data import Column
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Separates the group from the column name in .npz files of grouped arrays
+GROUP_SEPARATOR = "/"
+
+
+def require_numpy():
+    """
+    Raise a helpful error if numpy isn't installed - it's only needed for exporting
+    """
+    if numpy is None:
+        raise ImportError("Exporting to arrays needs numpy - pip install numpy")
+
+
+def get_dtype(column: Column) -> str:
+    """
+    Get the NumPy dtype a column is exported as
+    @param column: column to export
+    @type column: Column
+    @return: datetime64[ms] for timestamps, float32 for real values,
+             int64 for integers or U (unicode) for anything else
+    @rtype: str
+    """
+    column_type = column.type.lower()
+    if "date" in column_type or "time" in column_type:
+        return "datetime64[ms]"
+    if any(x in column_type for x in ["real", "float", "double", "decimal", "numeric"]):
+        return "float32"
+    if "int" in column_type or column_type == "bit":
+        return "int64"
+    return "U"
+
+
+def to_arrays(chunks: Iterable[list], columns: List[Column]) -> Dict[str, "numpy.ndarray"]:
+    """
+    Convert chunks of rows to one typed array per column, a chunk at a time
+    so only one chunk of Python objects is alive at once
+    @param chunks: lists of rows as tuples, in the order of columns
+    @type chunks: Iterable[list]
+    @param columns: columns of the rows
+    @type columns: list[Column]
+    @return: dictionary of column names to arrays
+    @rtype: dict[str, numpy.ndarray]
+    """
+    require_numpy()
+    dtypes = [get_dtype(x) for x in columns]
+    arrays = [[] for _ in columns]
+    for chunk in chunks:
+        for values, dtype, column_arrays in zip(zip(*chunk), dtypes, arrays):
+            column_arrays.append(numpy.array(values, dtype=dtype))
+
+    result = OrderedDict()
+    for column, dtype, column_arrays in zip(columns, dtypes, arrays):
+        result[column.name] = numpy.concatenate(column_arrays) if column_arrays else numpy.array([], dtype=dtype)
+    return result
+
+
+def group_arrays(arrays: Dict[str, "numpy.ndarray"], group_by: str) -> Dict[str, Dict[str, "numpy.ndarray"]]:
+    """
+    Split arrays by the values of one of them, e.g. by sensor id
+    @param arrays: dictionary of column names to arrays
+    @type arrays: dict[str, numpy.ndarray]
+    @param group_by: name of the column to group by - left out of the groups
+    @type group_by: str
+    @return: dictionary of group values to dictionaries of column names to arrays
+    @rtype: dict[str, dict[str, numpy.ndarray]]
+    """
+    require_numpy()
+    keys = arrays[group_by]
+    groups = OrderedDict()
+    for value in numpy.unique(keys):
+        mask = keys == value
+        groups[str(value)] = OrderedDict((name, x[mask]) for name, x in arrays.items() if name != group_by)
+    return groups
+
+
+def save_arrays(path: str, arrays: Dict, compress: bool = True):
+    """
+    Write arrays (grouped or not) to an .npz file
+    @param path: path of the file
+    @type path: str
+    @param arrays: dictionary of column names to arrays, or of group values to those
+    @type arrays: dict
+    @param compress: whether to compress the file
+    @type compress: bool
+    """
+    require_numpy()
+    flat = OrderedDict()
+    for key, value in arrays.items():
+        if isinstance(value, dict):
+            for name, array in value.items():
+                flat[f"{key}{GROUP_SEPARATOR}{name}"] = array
+        else:
+            flat[key] = value
+    save = numpy.savez_compressed if compress else numpy.savez
+    save(path, **flat)
+    logging.debug(f"Exported {len(flat)} arrays to {path}")
+
+
+def load_arrays(path: str) -> Dict:
+    """
+    Read arrays written by save_arrays
+    @param path: path of the .npz file
+    @type path: str
+    @return: dictionary of column names to arrays, or of group values to those
+    @rtype: dict
+    """
+    require_numpy()
+    arrays = OrderedDict()
+    with numpy.load(path) as data:
+        for key in data.files:
+            if GROUP_SEPARATOR in key:
+                group, name = key.rsplit(GROUP_SEPARATOR, 1)
+                arrays.setdefault(group, OrderedDict())[name] = data[key]
+            else:
+                arrays[key] = data[key]
+    return arrays
@@ -0,0 +1,286 @@
+"""
+Buffered, batched database ingest
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Tuple, Type
+
+
+class IngestBuffer:
+    """
+    Collects rows from any thread and hands them to a flush method in
+    batches from a background thread, so many small inserts become one
+    transaction. A batch is flushed once batch_size rows are waiting or
+    the oldest waiting row is max_delay seconds old. At most max_rows rows
+    are held - past that the oldest are dropped. A batch failing with one
+    of transient_errors (e.g. a dropped database connection) goes back to
+    the front of the queue and is retried with backoff - other failures
+    are logged and the batch is dropped
+    """
+
+    def __init__(
+            self,
+            flush: Callable[[List], None],
+            batch_size: int = 500,
+            max_delay: float = 2.0,
+            max_rows: int = 10000,
+            name: str = "ingest",
+            transient_errors: Tuple[Type[BaseException], ...] = (),
+            retry_delay: float = 1.0,
+            max_retry_delay: float = 60.0
+    ):
+        """
+        @param flush: method which writes a list of rows
+        @type flush: method
+        @param batch_size: number of rows which triggers a flush
+        @type batch_size: int
+        @param max_delay: max seconds a row waits before being flushed
+        @type max_delay: float
+        @param max_rows: max number of rows waiting to be flushed
+        @type max_rows: int
+        @param name: name for logging & the flush thread
+        @type name: str
+        @param transient_errors: exceptions after which a batch is retried instead of dropped
+        @type transient_errors: tuple
+        @param retry_delay: seconds before the first retry - doubled after each failed retry
+        @type retry_delay: float
+        @param max_retry_delay: upper limit on seconds between retries
+        @type max_retry_delay: float
+        """
+        super()
+        self.flush_method = flush
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.name = name
+        self.transient_errors = transient_errors
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._rows = deque()  # type: Deque
+        self._oldest = None  # type: float or None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None  # type: threading.Thread or None
+        self._closing = False
+        # When to retry after a transient failure - 0 while writes are succeeding
+        self._retry_at = 0.0
+        self._backoff = retry_delay
+
+        self.received = 0
+        self.flushed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.batches = 0
+        self._flush_time = 0.0
+        self._started = time.monotonic()
+
+    # region Lifecycle
+
+    def start(self):
+        """
+        Start the flush thread (no-op if it's already running)
+        """
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._closing = False
+            self._thread = threading.Thread(target=self.run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self, timeout: float or None = None):
+        """
+        Stop the flush thread after flushing everything waiting
+        @param timeout: max seconds to wait for the final flush
+        @type timeout: float or None
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        # Anything put() while closing
+        self.flush()
+        with self._condition:
+            lost = len(self._rows)
+            self._rows.clear()
+            self._oldest = None
+        if lost:
+            self.failed += lost
+            logging.error(f"{self.name}: closed with {lost} rows still failing to write - dropping them")
+        if self.flushed:
+            logging.info(f"{self.name}: {self.report()}")
+
+    # endregion Lifecycle
+    # region Rows
+
+    def __len__(self) -> int:
+        """
+        @return: number of rows waiting to be flushed
+        @rtype: int
+        """
+        return len(self._rows)
+
+    def put(self, row):
+        """
+        Queue a row to be flushed
+        @param row: row for the flush method
+        """
+        self.start()
+        with self._condition:
+            self.received += 1
+            if len(self._rows) >= self.max_rows:
+                self.drop_oldest(1)
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(row)
+            # Wake the flush thread to start the max_delay timer or flush a full batch
+            if len(self._rows) == 1 or len(self._rows) >= self.batch_size:
+                self._condition.notify_all()
+
+    def run(self):
+        """
+        Flush thread - flush whenever a batch is full or old enough
+        """
+        while True:
+            with self._condition:
+                while not self._closing:
+                    if self._retry_at:
+                        # Backing off after a transient failure
+                        backoff = self._retry_at - time.monotonic()
+                        if backoff <= 0:
+                            break
+                        self._condition.wait(backoff)
+                    elif len(self._rows) >= self.batch_size:
+                        break
+                    elif self._rows:
+                        remaining = self._oldest + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                closing = self._closing
+
+            self.flush()
+            if closing:
+                return
+
+    def flush(self) -> int:
+        """
+        Flush everything waiting, one batch at a time
+        @return: number of rows flushed
+        @rtype: int
+        """
+        count = 0
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    if not self._rows:
+                        self._retry_at = 0.0
+                        return count
+                    batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                    oldest = self._oldest
+                    self._oldest = time.monotonic() if self._rows else None
+
+                start = time.monotonic()
+                try:
+                    self.flush_method(batch)
+                except self.transient_errors as e:
+                    self.retry(batch, oldest, e)
+                    return count
+                except:
+                    self.failed += len(batch)
+                    logging.exception(f"{self.name}: failed to flush {len(batch)} rows")
+                    continue
+                elapsed = time.monotonic() - start
+
+                self._retry_at = 0.0
+                self._backoff = self.retry_delay
+                self.batches += 1
+                self.flushed += len(batch)
+                self._flush_time += elapsed
+                count += len(batch)
+                logging.debug(f"{self.name}: flushed {len(batch)} rows in {elapsed * 1000:0.1f}ms")
+
+    def retry(self, batch: List, oldest: float, error: BaseException):
+        """
+        Put a batch which failed with a transient error back at the front
+        of the queue & back off before the next attempt
+        @param batch: rows which failed to flush
+        @type batch: list
+        @param oldest: time the oldest row in the batch was queued
+        @type oldest: float
+        @param error: exception raised by the flush method
+        @type error: BaseException
+        """
+        with self._condition:
+            self._rows.extendleft(reversed(batch))
+            self._oldest = oldest
+            if len(self._rows) > self.max_rows:
+                self.drop_oldest(len(self._rows) - self.max_rows)
+            self.retries += 1
+            delay = self._backoff
+            self._retry_at = time.monotonic() + delay
+            self._backoff = min(self._backoff * 2, self.max_retry_delay)
+        logging.warning(
+            f"{self.name}: failed to flush {len(batch)} rows ({error}) - "
+            f"retrying in {delay:0.1f}s with {len(self._rows)} rows waiting"
+        )
+
+    def drop_oldest(self, count: int):
+        """
+        Drop the oldest waiting rows to make room - call with the condition held
+        @param count: number of rows to drop
+        @type count: int
+        """
+        for _ in range(count):
+            self._rows.popleft()
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logging.warning(f"{self.name}: buffer full - {self.dropped} rows dropped so far")
+
+    # endregion Rows
+    # region Metrics
+
+    def metrics(self) -> dict:
+        """
+        Get ingest stats - rows_per_second is the flush rate while writing,
+        ingest_rate is rows received per second since the buffer was created
+        @rtype: dict
+        """
+        elapsed = time.monotonic() - self._started
+        return {
+            "waiting": len(self._rows),
+            "received": self.received,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "batches": self.batches,
+            "rows_per_second": self.flushed / self._flush_time if self._flush_time else 0.0,
+            "ingest_rate": self.received / elapsed if elapsed else 0.0,
+        }
+
+    def report(self) -> str:
+        """
+        Get a one line summary of the metrics
+        @rtype: str
+        """
+        metrics = self.metrics()
+        return (
+            f"{metrics['flushed']} rows in {metrics['batches']} batches "
+            f"({metrics['rows_per_second']:0.0f} rows/s while flushing, "
+            f"{metrics['ingest_rate']:0.1f} rows/s received), "
+            f"{metrics['failed']} failed, {metrics['dropped']} dropped"
+        )
+
+    # endregion Metrics
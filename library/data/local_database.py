@@ -2,11 +2,11 @@ import datetime
 import logging
 import os
 import sqlite3
-from typing import List, Dict
+from typing import Dict, Iterator, List
 
 from library import HOME_DIR
 from library.data import Column, DatabaseEntry
-from library.data.database import BaseTable, BaseDatabase
+from library.data.database import BaseTable, BaseDatabase, QueryKeys
 
 
 def get_database_path(name: str) -> str:
@@ -24,11 +24,31 @@ def get_database_path(name: str) -> str:
     return database_path
 
 
-def connect_to_database(path_or_name: str) -> sqlite3.Connection:
+def set_pragma(connection: sqlite3.Connection, name: str, value: int or str):
     """
-    Connect to target database
-    @param name: name of database
+    Set a PRAGMA on a connection
+    @param connection: open database connection
+    @type connection: sqlite3.Connection
+    @param name: name of the pragma, e.g. journal_mode
     @type name: str
+    @param value: new value, e.g. "wal" or 5000
+    @type value: int or str
+    @return: value reported back by sqlite, if any
+    """
+    # PRAGMA values can't be parameterized - only allow plain words and numbers
+    if not name.isidentifier() or not (isinstance(value, int) or str(value).isalnum()):
+        raise Exception(f"Invalid sqlite pragma: {name} = {value}")
+    result = connection.execute(f"PRAGMA {name} = {value}").fetchone()
+    return result[0] if result else None
+
+
+def connect_to_database(path_or_name: str, pragmas: Dict[str, int or str] or None = None) -> sqlite3.Connection:
+    """
+    Connect to target database
+    @param path_or_name: name of database or path to the database file
+    @type path_or_name: str
+    @param pragmas: (Optional) PRAGMAs to set on the connection, in order - e.g. {"journal_mode": "wal"}
+    @type pragmas: dict[str, int or str] or None
     @return: open database connection
     @rtype: sqlite3.Connection
     """
@@ -36,7 +56,13 @@ def connect_to_database(path_or_name: str) -> sqlite3.Connection:
         path_or_name = get_database_path(path_or_name)
 
     try:
-        con = sqlite3.connect(path_or_name)
+        # The connection is shared between threads - Database serializes access to it
+        con = sqlite3.connect(path_or_name, check_same_thread=False)
+        for name, value in (pragmas or {}).items():
+            result = set_pragma(con, name, value)
+            # journal_mode reports the mode actually in use, e.g. memory DBs can't use wal
+            if name == "journal_mode" and str(result).lower() != str(value).lower():
+                logging.warning(f"Requested journal_mode {value} for {path_or_name}, got {result}")
     except Exception as e:
         logging.exception(f"Failed to connect to DB @ {path_or_name}")
         raise e
@@ -56,12 +82,7 @@ class Table(BaseTable):
         @return: whether or not the table exists
         @rtype: bool
         """
-        query = f"""
-SELECT name FROM sqlite_master
-WHERE type='table'
-AND name='{table_name}';
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.TABLE_EXISTS), [table_name])
         result = self.cursor.fetchone()
         return result and result[0] == table_name
 
@@ -83,19 +104,98 @@ AND name='{table_name}';
         query += ")"
         self.cursor.execute(query)
 
+    def create_index(self, column_name: str):
+        """
+        Create a secondary index on a column if it doesn't already exist
+        @param column_name: name of the column
+        @type column_name: str
+        """
+        self.cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.get_index_name(column_name)} ON {self.name} ({column_name})"
+        )
+
+    def build_query(self, key: str, *args) -> str:
+        """
+        Build a parameterized statement
+        @param key: one of QueryKeys
+        @type key: str
+        @param args: anything the statement depends on, e.g. a column name
+        @return: SQL with placeholders for values
+        @rtype: str
+        """
+        primary = self.primary_column_name
+        if key == QueryKeys.TABLE_EXISTS:
+            return "SELECT name FROM sqlite_master WHERE type='table' AND name = ?"
+        if key == QueryKeys.INSERT:
+            return f"INSERT INTO {self.name} ({self.columns_str}) VALUES ({', '.join(['?'] * len(self.columns))})"
+        if key == QueryKeys.UPDATE:
+            column_name, = args
+            self.check_column_name(column_name)
+            return f"UPDATE {self.name} SET {column_name} = ? WHERE {primary} = ?"
+        if key == QueryKeys.GET:
+            return f"SELECT {self.columns_str} FROM {self.name} WHERE {primary} = ?"
+        if key == QueryKeys.WHERE:
+            column_name, order_by, limited = args
+            self.check_column_name(column_name)
+            self.check_column_name(order_by)
+            query = f"SELECT {self.columns_str} FROM {self.name} WHERE {column_name} = ? ORDER BY {order_by} DESC"
+            return query + " LIMIT ?" if limited else query
+        if key == QueryKeys.LATEST:
+            return f"SELECT {self.columns_str} FROM {self.name} ORDER BY {primary} DESC LIMIT 1"
+        if key == QueryKeys.ALL:
+            return f"SELECT {self.columns_str} FROM {self.name}"
+        if key == QueryKeys.LAST_N:
+            return f"SELECT {self.columns_str} FROM {self.name} ORDER BY {primary} DESC LIMIT ?"
+        if key == QueryKeys.DELETE_EXCEPT_LAST_N:
+            return f"""
+DELETE FROM {self.name}
+  WHERE {primary} <= (
+    SELECT {primary}
+    FROM {self.name}
+    ORDER BY {primary} DESC
+    LIMIT 1 OFFSET ?
+  )
+"""
+        if key == QueryKeys.BOUNDS:
+            column_name, bounded = args
+            self.check_column_name(column_name)
+            query = f"SELECT MIN({column_name}), MAX({column_name}) FROM {self.name}"
+            return query + f" WHERE {column_name} >= ?" if bounded else query
+        if key == QueryKeys.BETWEEN:
+            column_name, = args
+            self.check_column_name(column_name)
+            return (
+                f"SELECT {self.columns_str} FROM {self.name} "
+                f"WHERE {column_name} >= ? AND {column_name} < ? ORDER BY {column_name}"
+            )
+        if key == QueryKeys.DELETE_BEFORE:
+            column_name, = args
+            self.check_column_name(column_name)
+            return (
+                f"DELETE FROM {self.name} WHERE rowid IN "
+                f"(SELECT rowid FROM {self.name} WHERE {column_name} < ? ORDER BY {column_name} LIMIT ?)"
+            )
+        if key == QueryKeys.RANGE:
+            columns, id_column, id_count, has_start, has_end = args
+            time_column = self.time_column_name
+            conditions = []
+            if has_start:
+                conditions.append(f"{time_column} >= ?")
+            if has_end:
+                conditions.append(f"{time_column} < ?")
+            if id_count:
+                self.check_column_name(id_column)
+                conditions.append(f"{id_column} IN ({', '.join(['?'] * id_count)})")
+            where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+            return f"SELECT {', '.join(columns)} FROM {self.name}{where} ORDER BY {time_column}"
+        raise Exception(f"Unknown query {key}")
+
     def add_data_multiple(self, data_to_add: List[List] or List[tuple]):
         """
         Add multiple rows the table at once
         @param data_to_add: multiple rows in a list
         """
-        query = f"""
-INSERT INTO {self.name} (
-  {self.columns_str}
-) VALUES (
-  {', '.join(['?' for x in data_to_add[0]])}
-)
-"""
-        self.cursor.executemany(query, data_to_add)
+        self.cursor.executemany(self.query(QueryKeys.INSERT), data_to_add)
         self.connection.commit()
 
     def add_data(self, data_to_add: List):
@@ -104,14 +204,7 @@ INSERT INTO {self.name} (
         @param data_to_add: data to add to table
         @type data_to_add: list
         """
-        query = f"""
-INSERT INTO {self.name} (
-  {self.columns_str}
-) VALUES (
-  {', '.join(['?' for x in data_to_add])}
-)
-"""
-        self.cursor.execute(query, data_to_add)
+        self.cursor.execute(self.query(QueryKeys.INSERT), data_to_add)
         self.connection.commit()
 
     def update_record(self, primary_key_value: int or float or str, column_name: str, new_value: int or float or str):
@@ -124,44 +217,57 @@ INSERT INTO {self.name} (
         @param new_value: new value for the column
         @type new_value: int or float or str
         """
-        if isinstance(primary_key_value, str):
-            primary_key_value = primary_key_value.replace("\\", "\\\\")
-        query = f"""
-UPDATE {self.name}
-SET {column_name} = {new_value}
-WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.UPDATE, column_name), [new_value, primary_key_value])
         self.connection.commit()
 
-    def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry:
+    def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry or None:
         """
         Get the target record
         @param primary_key_value: value of the primary column corresponding to the target entry
         @type primary_key_value: int or float or str
-        @return: DatabaseEntry for the target row
-        @rtype: DatabaseEntry
+        @return: DatabaseEntry for the target row or None if there isn't one
+        @rtype: DatabaseEntry or None
         """
-        if isinstance(primary_key_value, str):
-            primary_key_value = primary_key_value.replace("\\", "\\\\")
-        query = f"""SELECT * FROM {self.name} WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.GET), [primary_key_value])
         result = self.cursor.fetchone()
+        if result is None:
+            return None
         return self.convert_query_result_to_database_entry(result)
 
+    def get_records_where(
+            self,
+            column_name: str,
+            value: int or float or str,
+            order_by: str or None = None,
+            limit: int or None = None
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with a column equal to a value, newest first
+        @param column_name: name of the column to match
+        @type column_name: str
+        @param value: value to match exactly
+        @type value: int or float or str
+        @param order_by: (Optional) column to sort by, descending - defaults to the primary column
+        @type order_by: str or None
+        @param limit: (Optional) max number of records to get
+        @type limit: int or None
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        query = self.query(QueryKeys.WHERE, column_name, order_by or self.primary_column_name, limit is not None)
+        self.cursor.execute(query, [value] if limit is None else [value, limit])
+        results = self.cursor.fetchall()
+        return self.convert_query_results_to_database_entries(results)
+
     def get_latest_record(self) -> DatabaseEntry or None:
         """
         Get the latest record from the table
         @return: last record in the table
         @rtype: DatabaseEntry or None
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        others = [x.name for x in self.columns if x.name != primary]
-        others_str = ", ".join(others)
-        query = f"SELECT MAX({self.primary_column_name}), {others_str} FROM {self.name}"
-        self.cursor .execute(query)
+        self.cursor.execute(self.query(QueryKeys.LATEST))
         result = self.cursor.fetchone()
-        if all([x is None for x in result]):
+        if result is None:
             return None
         return self.convert_query_result_to_database_entry(result)
 
@@ -171,8 +277,7 @@ WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
         @return: list of records
         @rtype: list[DatabaseEntry]
         """
-        query = f"SELECT {self.columns_str} FROM {self.name}"
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.ALL))
         results = self.cursor.fetchall()
         return self.convert_query_results_to_database_entries(results)
 
@@ -184,16 +289,7 @@ WHERE {self.primary_column_name} LIKE '%{primary_key_value}%'
         @return: last n records
         @rtype: list[DatabaseEntry]
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        query = f"""
-SELECT * FROM (
-  SELECT * 
-  FROM {self.name}
-  ORDER BY {primary} DESC
-  LIMIT {n}
-) ORDER BY {primary} DESC
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.LAST_N), [n])
         results = self.cursor.fetchall()
         return self.convert_query_results_to_database_entries(results)
 
@@ -203,21 +299,110 @@ SELECT * FROM (
         @param n: number of records to keep
         @type n: int
         """
-        primary = [x.name for x in self.columns if x.primary][0]
-        query = f"""
-DELETE FROM {self.name}
-  WHERE {primary} <= (
-    SELECT {primary}
-    FROM (
-      SELECT {primary}
-      FROM {self.name}
-      ORDER BY {primary} DESC
-      LIMIT 1 OFFSET {n}
-    )
-  )
-"""
-        self.cursor.execute(query)
+        self.cursor.execute(self.query(QueryKeys.DELETE_EXCEPT_LAST_N), [n])
+        self.connection.commit()
+
+    def get_column_bounds(self, column_name: str, start: int or float or str or None = None) -> tuple:
+        """
+        Get the smallest & largest values in a column
+        @param column_name: name of the column
+        @type column_name: str
+        @param start: (Optional) only consider values >= start
+        @type start: int or float or str or None
+        @return: (min, max) - both None if there are no rows
+        @rtype: tuple
+        """
+        query = self.query(QueryKeys.BOUNDS, column_name, start is not None)
+        self.cursor.execute(query, [] if start is None else [start])
+        return tuple(self.cursor.fetchone())
+
+    def get_records_between(
+            self,
+            column_name: str,
+            start: int or float or str,
+            end: int or float or str
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with start <= column < end, oldest first
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param start: first value to include
+        @type start: int or float or str
+        @param end: first value to exclude
+        @type end: int or float or str
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        self.cursor.execute(self.query(QueryKeys.BETWEEN, column_name), [start, end])
+        results = self.cursor.fetchall()
+        return self.convert_query_results_to_database_entries(results)
+
+    def query_range_chunks(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            chunk_size: int = 1000
+    ) -> Iterator[list]:
+        """
+        Stream the rows with start <= timestamp < end, oldest first, in chunks of chunk_size
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param chunk_size: rows fetched at a time
+        @type chunk_size: int
+        @return: generator of lists of rows as the driver returns them
+        @rtype: Iterator[list]
+        """
+        range_columns = self.get_range_columns(columns)
+        ids = list(ids or [])
+        query = self.query(
+            QueryKeys.RANGE,
+            tuple(x.name for x in range_columns),
+            id_column,
+            len(ids),
+            start is not None,
+            end is not None
+        )
+        params = [x for x in [start, end] if x is not None] + ids
+
+        # A cursor of its own so other queries on this table don't cut the stream short
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def delete_records_before(self, column_name: str, value: int or float or str, limit: int) -> int:
+        """
+        Delete up to limit records with column < value
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param value: first value to keep
+        @type value: int or float or str
+        @param limit: max number of records to delete
+        @type limit: int
+        @return: number of records deleted
+        @rtype: int
+        """
+        self.cursor.execute(self.query(QueryKeys.DELETE_BEFORE, column_name), [value, limit])
+        deleted = self.cursor.rowcount
         self.connection.commit()
+        return deleted
 
     def drop(self):
         """
@@ -229,8 +414,15 @@ DELETE FROM {self.name}
 
 class Database(BaseDatabase):
     TABLE_CLASS = Table
+    CONNECTION_ERRORS = (sqlite3.OperationalError, sqlite3.InterfaceError)
 
-    def __init__(self, tables: Dict[str, List[Column]], name: str, path: str = None):
+    def __init__(
+            self,
+            tables: Dict[str, List[Column]],
+            name: str,
+            path: str = None,
+            pragmas: Dict[str, int or str] or None = None
+    ):
         """
         Initialize a database with a table
         @param tables: dictionary of table name to columns
@@ -239,17 +431,20 @@ class Database(BaseDatabase):
         @type name: str
         @param path: optional direct path to DB file
         @type path: str or None
+        @param pragmas: optional PRAGMAs set on every connection, e.g. {"journal_mode": "wal"}
+        @type pragmas: dict[str, int or str] or None
         """
         # from library.controllers import get_logger
         super().__init__(tables)
         self.name = name
         self.path = path
+        self.pragmas = pragmas or {}
 
     def connect(self):
         """
         Connect to the database
         """
-        self.connection = connect_to_database(self.path or self.name)
+        self.connection = connect_to_database(self.path or self.name, self.pragmas)
         self.create_tables()
 
 
@@ -0,0 +1,293 @@
+"""
+Process-wide database connection pools
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+class PoolExhausted(Exception):
+    """
+    Every connection in a pool is in use and none was released in time
+    """
+    pass
+
+
+class ConnectionPool:
+    """
+    Hands out open connections from any DB-API driver and takes them back
+    for reuse, so a connection's handshake & login are paid once instead of
+    on every connect. Connections idle longer than check_after are checked
+    with a cheap query before they're handed out, connections idle longer
+    than max_idle are closed, and failed connects are retried with backoff
+    if the error is one of transient_errors
+    """
+
+    def __init__(
+            self,
+            connect: Callable,
+            max_size: int = 4,
+            max_idle: float = 300.0,
+            check_after: float = 30.0,
+            health_check: str = "SELECT 1",
+            transient_errors: tuple = (),
+            retries: int = 3,
+            retry_delay: float = 0.5,
+            timeout: float = 10.0,
+            name: str = "pool"
+    ):
+        """
+        @param connect: method which opens a new connection
+        @type connect: method
+        @param max_size: max number of connections open at once, in use or idle
+        @type max_size: int
+        @param max_idle: seconds an unused connection is kept open
+        @type max_idle: float
+        @param check_after: seconds unused after which a connection is checked before reuse
+        @type check_after: float
+        @param health_check: statement which must succeed on a working connection
+        @type health_check: str
+        @param transient_errors: exceptions which are worth retrying a connect after
+        @type transient_errors: tuple
+        @param retries: extra attempts at a failed connect
+        @type retries: int
+        @param retry_delay: seconds before the first retry - doubled for each one after
+        @type retry_delay: float
+        @param timeout: max seconds to wait for a connection when all are in use
+        @type timeout: float
+        @param name: name for logging
+        @type name: str
+        """
+        super()
+        assert max_size > 0, "Pool size must be positive"
+        self.connect_method = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.health_check = health_check
+        self.transient_errors = transient_errors
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.name = name
+
+        # (connection, time it was released), most recently released last
+        self._idle = []  # type: List[tuple]
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self.closed = False
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.retried = 0
+
+    # region Connections
+
+    @property
+    def size(self) -> int:
+        """
+        @return: number of open connections, in use or idle
+        @rtype: int
+        """
+        return self._in_use + len(self._idle)
+
+    def acquire(self, timeout: float or None = None):
+        """
+        Get a working connection - an idle one if there is one, otherwise a new one
+        @param timeout: (Optional) max seconds to wait if every connection is in use - defaults to the pool's
+        @type timeout: float or None
+        @return: open connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self.closed:
+                    raise Exception(f"{self.name}: pool is closed")
+                self.evict_idle()
+                if self._idle:
+                    connection, released = self._idle.pop()
+                elif self.size < self.max_size:
+                    connection, released = None, None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(f"{self.name}: all {self.max_size} connections are in use")
+                    self._condition.wait(remaining)
+                    continue
+                # Reserve the slot while connecting/checking outside the lock
+                self._in_use += 1
+
+            try:
+                if connection is None:
+                    connection = self.connect()
+                    with self._condition:
+                        self.created += 1
+                    return connection
+                if time.monotonic() - released < self.check_after or self.is_healthy(connection):
+                    with self._condition:
+                        self.reused += 1
+                    return connection
+            except:
+                with self._condition:
+                    self._in_use -= 1
+                    self._condition.notify()
+                raise
+
+            # Stale - drop it and try the next one
+            self.close_connection(connection)
+            with self._condition:
+                self._in_use -= 1
+                self.discarded += 1
+
+    def release(self, connection, discard: bool = False):
+        """
+        Give a connection back to the pool. Any open transaction is rolled back
+        @param connection: connection from acquire()
+        @param discard: whether to close it instead - e.g. after a connection error
+        @type discard: bool
+        """
+        if not discard and not self.closed:
+            try:
+                connection.rollback()
+            except:
+                logging.debug(f"{self.name}: rollback failed - discarding connection")
+                discard = True
+
+        with self._condition:
+            self._in_use -= 1
+            if discard or self.closed:
+                self.discarded += discard
+            else:
+                self._idle.append((connection, time.monotonic()))
+                connection = None
+            self._condition.notify()
+        if connection is not None:
+            self.close_connection(connection)
+
+    def connect(self):
+        """
+        Open a new connection, retrying transient errors with backoff
+        @return: open connection
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return self.connect_method()
+            except self.transient_errors:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                logging.warning(f"{self.name}: connect failed - retrying in {delay:0.1f}s")
+                time.sleep(delay)
+                delay *= 2
+
+    def is_healthy(self, connection) -> bool:
+        """
+        Check a connection still works
+        @param connection: open connection
+        @rtype: bool
+        """
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.health_check).fetchall()
+            finally:
+                cursor.close()
+            return True
+        except:
+            logging.info(f"{self.name}: dropping a connection which failed its health check")
+            return False
+
+    @staticmethod
+    def close_connection(connection):
+        """
+        Close a connection, ignoring errors - it may already be broken
+        @param connection: open connection
+        """
+        try:
+            connection.close()
+        except:
+            pass
+
+    def evict_idle(self) -> int:
+        """
+        Close connections which have been idle longer than max_idle
+        @return: number of connections closed
+        @rtype: int
+        """
+        cutoff = time.monotonic() - self.max_idle
+        with self._condition:
+            expired = [x for x, released in self._idle if released < cutoff]
+            self._idle = [x for x in self._idle if x[1] >= cutoff]
+        for connection in expired:
+            self.close_connection(connection)
+        return len(expired)
+
+    def close(self):
+        """
+        Close every idle connection - connections in use are closed when they're released
+        """
+        with self._condition:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for connection, _ in idle:
+            self.close_connection(connection)
+
+    # endregion Connections
+    # region Metrics
+
+    def metrics(self) -> dict:
+        """
+        @return: pool stats
+        @rtype: dict
+        """
+        return {
+            "in_use": self._in_use,
+            "idle": len(self._idle),
+            "created": self.created,
+            "reused": self.reused,
+            "discarded": self.discarded,
+            "retried": self.retried,
+        }
+
+    # endregion Metrics
+
+
+_POOLS = {}  # type: Dict[tuple, ConnectionPool]
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(key: tuple, connect: Callable, **kwargs) -> ConnectionPool:
+    """
+    Get the process-wide pool for a key, creating it the first time
+    @param key: what the connections are to, e.g. (server, database, user)
+    @type key: tuple
+    @param connect: method which opens a new connection
+    @type connect: method
+    @param kwargs: ConnectionPool options - only used when the pool is created
+    @return: the pool
+    @rtype: ConnectionPool
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None or pool.closed:
+            pool = _POOLS[key] = ConnectionPool(connect, **kwargs)
+        return pool
+
+
+def close_pools():
+    """
+    Close every pool
+    """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,333 @@
+"""
+Time-based retention & downsampling for time-series tables
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import datetime
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from library.data import Column
+
+
+def to_seconds(value: int or float or str or datetime.datetime) -> float:
+    """
+    Convert a timestamp column value to seconds since the epoch
+    @param value: epoch seconds, datetime or ISO8601 string (local time)
+    @type value: int or float or str or datetime.datetime
+    @rtype: float
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def from_seconds(seconds: float, like: int or float or str or datetime.datetime):
+    """
+    Convert seconds since the epoch to the same kind of value as a timestamp column holds
+    @param seconds: seconds since the epoch
+    @type seconds: float
+    @param like: any value from the column
+    @type like: int or float or str or datetime.datetime
+    @return: value comparable with the column
+    @rtype: int or float or str or datetime.datetime
+    """
+    if isinstance(like, (int, float)):
+        return type(like)(seconds)
+    value = datetime.datetime.fromtimestamp(seconds)
+    if isinstance(like, str):
+        # ISO8601 format: YYYY-MM-DD HH:MM:SS.SSS
+        return value.strftime("%Y-%m-%d %H:%M:%S.") + f"{value.microsecond // 1000:03d}"
+    return value
+
+
+class Rollup:
+    """
+    Downsampled copy of a table - min/max/avg of each value per period
+    """
+
+    def __init__(self, period: int, max_age: float or None = None):
+        """
+        @param period: seconds per bucket, e.g. 60 or 3600
+        @type period: int
+        @param max_age: (Optional) seconds of rollups to keep - forever if None
+        @type max_age: float or None
+        """
+        super()
+        assert period > 0, "Rollup period must be positive"
+        self.period = period
+        self.max_age = max_age
+
+    @property
+    def label(self) -> str:
+        """
+        @return: short name of the period, e.g. 1m or 1h
+        @rtype: str
+        """
+        for unit, seconds in [("d", 86400), ("h", 3600), ("m", 60)]:
+            if self.period % seconds == 0:
+                return f"{self.period // seconds}{unit}"
+        return f"{self.period}s"
+
+    def bucket(self, seconds: float) -> float:
+        """
+        Get the start of the bucket a time falls in
+        @param seconds: seconds since the epoch
+        @type seconds: float
+        @rtype: float
+        """
+        return seconds - seconds % self.period
+
+
+class RetentionPolicy:
+    """
+    Keeps a time-series table from growing without bound. Every run it
+    rolls complete buckets up into its rollup tables, then deletes rows
+    older than max_age in batches of batch_size. Rows are never deleted
+    before every rollup has covered them. A bucket is only rolled up once
+    it ended grace seconds ago, so rows which are written late - held in
+    an ingest buffer or outbox - still make it into their bucket
+    """
+    # Most raw data a rollup reads per run - a new or long-stopped rollup catches up over several runs
+    CATCH_UP_SECONDS = 3600
+    # Most batches deleted per table per run
+    MAX_BATCHES = 100
+
+    def __init__(
+            self,
+            table_name: str,
+            max_age: float or None = None,
+            batch_size: int = 500,
+            interval: float = 60.0,
+            rollups: List[Rollup] or None = None,
+            group_by: List[str] or None = None,
+            values: List[str] or None = None,
+            grace: float = 60.0
+    ):
+        """
+        @param table_name: name of the table
+        @type table_name: str
+        @param max_age: (Optional) seconds of rows to keep - forever if None
+        @type max_age: float or None
+        @param batch_size: rows deleted per statement
+        @type batch_size: int
+        @param interval: seconds between runs
+        @type interval: float
+        @param rollups: (Optional) rollups to maintain
+        @type rollups: list[Rollup] or None
+        @param group_by: columns rollups are grouped by, e.g. sensor id
+        @type group_by: list[str] or None
+        @param values: numeric columns rollups summarize
+        @type values: list[str] or None
+        @param grace: seconds after a bucket ends before it's rolled up
+        @type grace: float
+        """
+        super()
+        self.table_name = table_name
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rollups = rollups or []
+        self.group_by = group_by or []
+        self.values = values or []
+        self.grace = grace
+        assert not self.rollups or self.values, f"Rollups for {table_name} need values to summarize"
+
+    def __repr__(self) -> str:
+        """
+        @rtype: str
+        """
+        rollups = ", ".join([x.label for x in self.rollups]) or "none"
+        return f"{self.table_name} (max_age {self.max_age}s, rollups: {rollups})"
+
+    # region Tables
+
+    def get_rollup_table_name(self, rollup: Rollup) -> str:
+        """
+        @param rollup: one of this policy's rollups
+        @type rollup: Rollup
+        @return: name of the table the rollup is stored in
+        @rtype: str
+        """
+        return f"{self.table_name}_{rollup.label}"
+
+    def get_rollup_tables(self, columns: List[Column]) -> Dict[str, List[Column]]:
+        """
+        Get the definitions of the rollup tables: the start of each bucket,
+        the group_by columns, the number of samples and min/max/avg of each value
+        @param columns: columns of the source table
+        @type columns: list[Column]
+        @return: dictionary of table name to columns
+        @rtype: dict[str, list[Column]]
+        """
+        by_name = {column.name: column for column in columns}
+        time_column = [x for x in columns if x.primary][0]
+        rollup_columns = [Column(time_column.name, time_column.type, "NOT NULL", index=True)]
+        for name in self.group_by:
+            rollup_columns.append(Column(name, by_name[name].type, "NOT NULL"))
+        rollup_columns.append(Column("samples", "integer", "NOT NULL"))
+        for name in self.values:
+            for stat in ["min", "max", "avg"]:
+                # null if none of the samples had this value
+                rollup_columns.append(Column(f"{name}_{stat}", "real", ""))
+
+        tables = OrderedDict()
+        for rollup in self.rollups:
+            tables[self.get_rollup_table_name(rollup)] = rollup_columns
+        return tables
+
+    # endregion Tables
+    # region Run
+
+    def apply(self, db, now: float or None = None) -> dict:
+        """
+        Update the rollups then delete old rows
+        @param db: database holding the table - kept open between calls
+        @type db: library.data.database.BaseDatabase
+        @param now: (Optional) current time in seconds since the epoch
+        @type now: float or None
+        @return: {"rolled_up": buckets written, "deleted": rows deleted}
+        @rtype: dict
+        """
+        now = datetime.datetime.now().timestamp() if now is None else now
+        summary = {"rolled_up": 0, "deleted": 0}
+
+        # Rows can only be deleted once every rollup has covered them
+        cutoff = None if self.max_age is None else now - self.max_age
+        for rollup in self.rollups:
+            rolled_up, covered = self.roll_up(db, rollup, now)
+            summary["rolled_up"] += rolled_up
+            if cutoff is not None:
+                cutoff = min(cutoff, covered)
+            if rollup.max_age is not None:
+                summary["deleted"] += self.delete_before(db, self.get_rollup_table_name(rollup), now - rollup.max_age)
+
+        if cutoff is not None:
+            summary["deleted"] += self.delete_before(db, self.table_name, cutoff)
+        return summary
+
+    def roll_up(self, db, rollup: Rollup, now: float) -> tuple:
+        """
+        Summarize complete buckets that aren't in the rollup table yet
+        @param db: database holding the table
+        @type db: library.data.database.BaseDatabase
+        @param rollup: rollup to update
+        @type rollup: Rollup
+        @param now: current time in seconds since the epoch
+        @type now: float
+        @return: (buckets written, time up to which every row has been rolled up)
+        @rtype: tuple
+        """
+        with db:
+            source = db.get_table(self.table_name)
+            target = db.get_table(self.get_rollup_table_name(rollup))
+            time_column = source.primary_column_name
+
+            # Pick up after the last bucket written, skipping any gap with no data
+            _, last_bucket = target.get_column_bounds(time_column)
+            resume = None if last_bucket is None else to_seconds(last_bucket) + rollup.period
+            first, _ = source.get_column_bounds(
+                time_column, None if resume is None else from_seconds(resume, last_bucket)
+            )
+            # Leave the latest buckets until rows written late have had time to arrive
+            end = rollup.bucket(now - self.grace)
+            if first is None:
+                # Nothing new - everything before end is covered
+                return 0, end
+            start = rollup.bucket(to_seconds(first))
+            if rollup.max_age is not None:
+                # Don't write rollups which would be deleted straight away
+                start = max(start, rollup.bucket(now - rollup.max_age))
+            end = min(end, start + max(rollup.period, rollup.bucket(self.CATCH_UP_SECONDS)))
+            if start >= end:
+                return 0, start
+
+            # Stream the raw rows - an hour of them can be a lot
+            records = source.query_range(from_seconds(start, first), from_seconds(end, first))
+            rows = self.summarize(records, rollup, time_column, first)
+            if rows:
+                target.add_data_multiple(rows)
+        logging.debug(f"Retention: rolled {self.table_name} up into {len(rows)} {rollup.label} rows")
+        return len(rows), end
+
+    def summarize(self, records: Iterable, rollup: Rollup, time_column: str, like) -> List[list]:
+        """
+        Get min/max/avg of each value per bucket & group
+        @param records: rows from the source table, oldest first
+        @type records: Iterable[library.data.DatabaseEntry]
+        @param rollup: rollup being updated
+        @type rollup: Rollup
+        @param time_column: name of the timestamp column
+        @type time_column: str
+        @param like: any timestamp from the source table
+        @return: rows for the rollup table
+        @rtype: list[list]
+        """
+        buckets = OrderedDict()
+        for record in records:
+            bucket = rollup.bucket(to_seconds(record[time_column]))
+            key = (bucket,) + tuple(record[name] for name in self.group_by)
+            # [samples, [min, max, total, count] per value]
+            stats = buckets.setdefault(key, [0] + [[None, None, 0.0, 0] for _ in self.values])
+            stats[0] += 1
+            for stat, name in zip(stats[1:], self.values):
+                value = record[name]
+                if value is None:
+                    continue
+                value = float(value)
+                stat[0] = value if stat[0] is None else min(stat[0], value)
+                stat[1] = value if stat[1] is None else max(stat[1], value)
+                stat[2] += value
+                stat[3] += 1
+
+        rows = []
+        for (bucket, *group), (samples, *stats) in buckets.items():
+            row = [from_seconds(bucket, like)] + group + [samples]
+            for minimum, maximum, total, count in stats:
+                row += [minimum, maximum, total / count if count else None]
+            rows.append(row)
+        return rows
+
+    def delete_before(self, db, table_name: str, cutoff: float) -> int:
+        """
+        Delete rows older than the cutoff in batches, releasing the database
+        between batches so other threads aren't held up
+        @param db: database holding the table
+        @type db: library.data.database.BaseDatabase
+        @param table_name: name of the table
+        @type table_name: str
+        @param cutoff: seconds since the epoch - older rows are deleted
+        @type cutoff: float
+        @return: number of rows deleted
+        @rtype: int
+        """
+        deleted = 0
+        for _ in range(self.MAX_BATCHES):
+            with db:
+                table = db.get_table(table_name)
+                time_column = table.columns[0].name if self.is_rollup(table_name) else table.primary_column_name
+                oldest, _ = table.get_column_bounds(time_column)
+                if oldest is None or to_seconds(oldest) >= cutoff:
+                    break
+                count = table.delete_records_before(time_column, from_seconds(cutoff, oldest), self.batch_size)
+            deleted += count
+            if count < self.batch_size:
+                break
+        if deleted:
+            logging.info(f"Retention: deleted {deleted} rows from {table_name}")
+        return deleted
+
+    def is_rollup(self, table_name: str) -> bool:
+        """
+        @param table_name: name of a table
+        @type table_name: str
+        @return: whether the table is one of this policy's rollup tables
+        @rtype: bool
+        """
+        return table_name in [self.get_rollup_table_name(x) for x in self.rollups]
+
+    # endregion Run
@@ -0,0 +1,704 @@
+"""
+Ring buffer database - each table is a fixed-size memory-mapped file of
+fixed-width records. Appending, the latest record and the last N records
+are O(1)/O(N) with no SQL engine, and old records are dropped by moving a
+pointer instead of running delete queries, so the only disk writes are the
+record itself and a 64 byte header
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+from typing import Dict, Iterator, List
+
+from library import HOME_DIR
+from library.data import Column, DatabaseEntry
+from library.data.database import BaseTable, BaseDatabase
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows - no locking between processes
+    fcntl = None
+
+# magic, version, reserved, record size, schema checksum, capacity, first record, record count
+HEADER = struct.Struct("<4sHHIIQQQ")
+HEADER_SIZE = 64
+MAGIC = b"RING"
+VERSION = 1
+# Offset of the first & count fields, which change on every append - 8 byte aligned
+FIRST_OFFSET = struct.calcsize("<4sHHIIQ")
+COUNTERS = struct.Struct("<QQ")
+
+# Bytes stored for text columns without a width, e.g. "text"
+DEFAULT_TEXT_WIDTH = 64
+# Bytes stored for date/time columns - YYYY-MM-DD HH:MM:SS.SSSSSS
+TIMESTAMP_WIDTH = 26
+
+
+def get_ringbuffer_path(name: str) -> str:
+    """
+    Get the directory the tables of a ring buffer database are stored in
+    @param name: name of the database
+    @type name: str
+    @return: path to the directory
+    @rtype: str
+    """
+    return os.path.join(HOME_DIR, "data", os.path.basename(name) + ".ring")
+
+
+def get_field_format(column: Column) -> str:
+    """
+    Get the struct format a column's values are stored as
+    @param column: column to store
+    @type column: Column
+    @return: q for integers, d for reals or Ns for N bytes of UTF-8 text
+    @rtype: str
+    """
+    column_type = column.type.lower()
+    width = re.search(r"\((\d+)\)", column_type)
+    if width and "char" in column_type:
+        return f"{width.group(1)}s"
+    if "date" in column_type or "time" in column_type:
+        return f"{TIMESTAMP_WIDTH}s"
+    if any(x in column_type for x in ["real", "float", "double", "decimal", "numeric"]):
+        return "d"
+    if "int" in column_type or column_type in ["bit", "bool", "boolean"]:
+        return "q"
+    return f"{DEFAULT_TEXT_WIDTH}s"
+
+
+def get_record_struct(columns: List[Column]) -> struct.Struct:
+    """
+    Get the layout of a record - a bitmask of null values followed by each column
+    @param columns: columns of the table
+    @type columns: list[Column]
+    @rtype: struct.Struct
+    """
+    assert len(columns) <= 64, "Ring buffer tables can have at most 64 columns"
+    return struct.Struct("<Q" + "".join(get_field_format(x) for x in columns))
+
+
+def get_schema_checksum(columns: List[Column]) -> int:
+    """
+    Get a checksum of the columns so a file written with other columns is recognized
+    @param columns: columns of the table
+    @type columns: list[Column]
+    @rtype: int
+    """
+    return zlib.crc32(", ".join(f"{x.name} {x.type}" for x in columns).encode())
+
+
+class Connection:
+    """
+    Stand-in for a database connection - the open files of each table
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: directory the table files are in
+        @type path: str
+        """
+        super()
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.files = {}  # type: Dict[str, tuple]
+
+    def cursor(self):
+        """
+        There are no cursors - only here so tables can share BaseTable's constructor
+        """
+        return None
+
+    def get_table_path(self, table_name: str) -> str:
+        """
+        @param table_name: name of the table
+        @type table_name: str
+        @return: path to the table's file
+        @rtype: str
+        """
+        return os.path.join(self.path, f"{table_name}.ring")
+
+    def open(self, table_name: str) -> mmap.mmap:
+        """
+        Map a table's file into memory
+        @param table_name: name of the table
+        @type table_name: str
+        @rtype: mmap.mmap
+        """
+        if table_name not in self.files:
+            handle = open(self.get_table_path(table_name), "r+b")
+            self.files[table_name] = (handle, mmap.mmap(handle.fileno(), 0))
+        return self.files[table_name][1]
+
+    def lock(self, table_name: str, exclusive: bool = True):
+        """
+        Lock a table's file against other processes (no-op without fcntl)
+        @param table_name: name of the table
+        @type table_name: str
+        @param exclusive: whether to lock for writing
+        @type exclusive: bool
+        """
+        if fcntl is not None and table_name in self.files:
+            fcntl.flock(self.files[table_name][0], fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def unlock(self, table_name: str):
+        """
+        Release a lock from lock()
+        @param table_name: name of the table
+        @type table_name: str
+        """
+        if fcntl is not None and table_name in self.files:
+            fcntl.flock(self.files[table_name][0], fcntl.LOCK_UN)
+
+    def release(self, table_name: str):
+        """
+        Unmap & close a table's file
+        @param table_name: name of the table
+        @type table_name: str
+        """
+        handle, memory = self.files.pop(table_name, (None, None))
+        if memory is not None:
+            memory.flush()
+            memory.close()
+            handle.close()
+
+    def close(self):
+        """
+        Close every table - changes are left to the OS to write out
+        """
+        for table_name in list(self.files):
+            self.release(table_name)
+
+
+class Table(BaseTable):
+    """
+    Fixed-size table of fixed-width records. Text longer than a column's
+    width is truncated. Records are kept in the order they were added, which
+    is assumed to be primary key order - the latest record is the last one
+    added. Primary keys aren't checked for uniqueness
+    """
+
+    def __init__(self, connection: Connection, name: str, columns: List[Column], capacity: int = 1024):
+        """
+        @param connection: open files of the database
+        @type connection: Connection
+        @param name: name of table
+        @type name: str
+        @param columns: columns of the table
+        @type columns: list[Column]
+        @param capacity: number of records kept - the oldest are overwritten
+        @type capacity: int
+        """
+        assert capacity > 0, "Ring buffer capacity must be positive"
+        self.capacity = capacity
+        self.record = get_record_struct(columns)
+        self.checksum = get_schema_checksum(columns)
+        self._text = [get_field_format(x).endswith("s") for x in columns]
+        super().__init__(connection, name, columns)
+        self.memory = connection.open(name)
+
+    # region Setup
+
+    def read_header(self, table_name: str) -> tuple or None:
+        """
+        Read the header of a table's file
+        @param table_name: name of the table
+        @type table_name: str
+        @return: header fields, or None if there's no valid file
+        @rtype: tuple or None
+        """
+        path = self.connection.get_table_path(table_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as handle:
+            data = handle.read(HEADER.size)
+        if len(data) < HEADER.size:
+            return None
+        header = HEADER.unpack(data)
+        return header if header[0] == MAGIC else None
+
+    def does_table_exist(self, table_name: str) -> bool:
+        """
+        Check if the table's file exists with these columns & capacity
+        @param table_name: name of table
+        @type table_name: str
+        @rtype: bool
+        """
+        header = self.read_header(table_name)
+        return header is not None and header[1:6] == (VERSION, 0, self.record.size, self.checksum, self.capacity)
+
+    def create_table(self, table_name: str, columns: List[Column]):
+        """
+        Create the table's file. If it already exists with the same columns but
+        another capacity, the newest records that fit are copied over
+        @param table_name: name of the table
+        @type table_name: str
+        @param columns: list of columns to add to the table
+        @type columns: list[Column]
+        """
+        assert table_name, "Must define table name"
+        assert columns and all([isinstance(x, Column) for x in columns]), "Must define columns"
+        path = self.connection.get_table_path(table_name)
+        rows = []
+        header = self.read_header(table_name)
+        if header is not None and header[1:5] == (VERSION, 0, self.record.size, self.checksum):
+            rows = self.read_file(path, header)
+            logging.info(f"Resizing ring buffer {table_name} from {header[5]} to {self.capacity} records")
+        elif header is not None:
+            logging.warning(f"Ring buffer {table_name} has other columns - starting over")
+
+        rows = rows[-self.capacity:]
+        with open(path + ".tmp", "wb") as handle:
+            handle.write(HEADER.pack(MAGIC, VERSION, 0, self.record.size, self.checksum, self.capacity, 0, len(rows)))
+            handle.write(b"\0" * (HEADER_SIZE - HEADER.size))
+            for row in rows:
+                handle.write(row)
+            handle.truncate(HEADER_SIZE + self.capacity * self.record.size)
+        os.replace(path + ".tmp", path)
+
+    def read_file(self, path: str, header: tuple) -> List[bytes]:
+        """
+        Read the raw records from a file, oldest first
+        @param path: path to the file
+        @type path: str
+        @param header: the file's header
+        @type header: tuple
+        @rtype: list[bytes]
+        """
+        _, _, _, size, _, capacity, first, count = header
+        with open(path, "rb") as handle:
+            data = handle.read()
+        rows = []
+        for i in range(first, count):
+            offset = HEADER_SIZE + (i % capacity) * size
+            rows.append(data[offset:offset + size])
+        return rows
+
+    def create_index(self, column_name: str):
+        """
+        Records are only ever scanned - there are no indexes
+        @param column_name: name of the column
+        @type column_name: str
+        """
+        pass
+
+    def build_query(self, key: str, *args) -> str:
+        """
+        There's no SQL
+        """
+        raise Exception(f"Ring buffer tables don't support queries ({key})")
+
+    # endregion Setup
+    # region Records
+
+    @property
+    def bounds(self) -> tuple:
+        """
+        @return: (first, count) - records first to count - 1 are in the table
+        @rtype: tuple
+        """
+        return COUNTERS.unpack_from(self.memory, FIRST_OFFSET)
+
+    def __len__(self) -> int:
+        """
+        @return: number of records in the table
+        @rtype: int
+        """
+        first, count = self.bounds
+        return count - first
+
+    def get_offset(self, i: int) -> int:
+        """
+        @param i: number of the record - 0 for the first one ever added
+        @type i: int
+        @return: offset of the record in the file
+        @rtype: int
+        """
+        return HEADER_SIZE + (i % self.capacity) * self.record.size
+
+    def pack(self, row: List or tuple) -> bytes:
+        """
+        Convert a row to a record
+        @param row: one value per column
+        @type row: list or tuple
+        @rtype: bytes
+        """
+        if len(row) != len(self.columns):
+            raise Exception(f"Table {self.name} has {len(self.columns)} columns, got {len(row)} values")
+        nulls = 0
+        values = []
+        for i, (value, text) in enumerate(zip(row, self._text)):
+            if value is None:
+                nulls |= 1 << i
+                value = b"" if text else 0
+            elif text:
+                value = str(value).encode()
+            values.append(value)
+        return self.record.pack(nulls, *values)
+
+    def unpack(self, i: int) -> tuple:
+        """
+        Read a record
+        @param i: number of the record
+        @type i: int
+        @return: one value per column
+        @rtype: tuple
+        """
+        nulls, *values = self.record.unpack_from(self.memory, self.get_offset(i))
+        row = []
+        for n, (value, text) in enumerate(zip(values, self._text)):
+            if nulls & (1 << n):
+                value = None
+            elif text:
+                value = value.rstrip(b"\0").decode(errors="replace")
+            row.append(value)
+        return tuple(row)
+
+    def rows(self, newest_first: bool = False) -> Iterator[tuple]:
+        """
+        Read every record
+        @param newest_first: whether to start with the latest record
+        @type newest_first: bool
+        @rtype: Iterator[tuple]
+        """
+        first, count = self.bounds
+        numbers = range(count - 1, first - 1, -1) if newest_first else range(first, count)
+        for i in numbers:
+            yield self.unpack(i)
+
+    def find(self, column_name: str, value) -> int or None:
+        """
+        Find the newest record with a column equal to a value
+        @param column_name: name of the column
+        @type column_name: str
+        @param value: value to match
+        @return: number of the record or None if there isn't one
+        @rtype: int or None
+        """
+        self.check_column_name(column_name)
+        position = self.column_index[column_name]
+        first, count = self.bounds
+        for i in range(count - 1, first - 1, -1):
+            if self.unpack(i)[position] == value:
+                return i
+        return None
+
+    def append(self, rows: List[List] or List[tuple]):
+        """
+        Add records, overwriting the oldest ones once the table is full
+        @param rows: rows to add
+        @type rows: list[list] or list[tuple]
+        """
+        records = [self.pack(x) for x in rows]
+        self.connection.lock(self.name)
+        try:
+            first, count = self.bounds
+            for record in records:
+                if count - first >= self.capacity:
+                    # Drop the oldest before overwriting it so readers never see a half-written record
+                    first += 1
+                    COUNTERS.pack_into(self.memory, FIRST_OFFSET, first, count)
+                self.memory[self.get_offset(count):self.get_offset(count) + self.record.size] = record
+                count += 1
+                COUNTERS.pack_into(self.memory, FIRST_OFFSET, first, count)
+        finally:
+            self.connection.unlock(self.name)
+
+    def drop_oldest(self, n: int):
+        """
+        Drop the oldest records by moving the first record forward
+        @param n: number of records to drop
+        @type n: int
+        """
+        self.connection.lock(self.name)
+        try:
+            first, count = self.bounds
+            COUNTERS.pack_into(self.memory, FIRST_OFFSET, min(first + n, count), count)
+        finally:
+            self.connection.unlock(self.name)
+
+    def add_data_multiple(self, data_to_add: List[List] or List[tuple]):
+        """
+        Add multiple rows the table at once
+        @param data_to_add: multiple rows in a list
+        """
+        self.append(data_to_add)
+
+    def add_data(self, data_to_add: List):
+        """
+        Add data to the table
+        @param data_to_add: data to add to table
+        @type data_to_add: list
+        """
+        self.append([data_to_add])
+
+    def update_record(self, primary_key_value: int or float or str, column_name: str, new_value: int or float or str):
+        """
+        Update a record in place
+        @param primary_key_value: value of the primary column corresponding to the target entry
+        @type primary_key_value: int or float or str
+        @param column_name: name of the column to update
+        @type column_name: str
+        @param new_value: new value for the column
+        @type new_value: int or float or str
+        """
+        self.check_column_name(column_name)
+        self.connection.lock(self.name)
+        try:
+            i = self.find(self.primary_column_name, primary_key_value)
+            if i is None:
+                return
+            row = list(self.unpack(i))
+            row[self.column_index[column_name]] = new_value
+            offset = self.get_offset(i)
+            self.memory[offset:offset + self.record.size] = self.pack(row)
+        finally:
+            self.connection.unlock(self.name)
+
+    def get_record(self, primary_key_value: int or float or str) -> DatabaseEntry or None:
+        """
+        Get the target record
+        @param primary_key_value: value of the primary column corresponding to the target entry
+        @type primary_key_value: int or float or str
+        @return: DatabaseEntry for the target row or None if there isn't one
+        @rtype: DatabaseEntry or None
+        """
+        i = self.find(self.primary_column_name, primary_key_value)
+        if i is None:
+            return None
+        return self.convert_query_result_to_database_entry(self.unpack(i))
+
+    def get_records_where(
+            self,
+            column_name: str,
+            value: int or float or str,
+            order_by: str or None = None,
+            limit: int or None = None
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with a column equal to a value, newest first
+        @param column_name: name of the column to match
+        @type column_name: str
+        @param value: value to match exactly
+        @type value: int or float or str
+        @param order_by: (Optional) column to sort by, descending - defaults to the order records were added
+        @type order_by: str or None
+        @param limit: (Optional) max number of records to get
+        @type limit: int or None
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        self.check_column_name(column_name)
+        position = self.column_index[column_name]
+        rows = [x for x in self.rows(newest_first=True) if x[position] == value]
+        if order_by and order_by != self.primary_column_name:
+            self.check_column_name(order_by)
+            order = self.column_index[order_by]
+            rows.sort(key=lambda x: x[order], reverse=True)
+        return self.convert_query_results_to_database_entries(rows if limit is None else rows[:limit])
+
+    def get_latest_record(self) -> DatabaseEntry or None:
+        """
+        Get the last record added - O(1)
+        @return: last record in the table
+        @rtype: DatabaseEntry or None
+        """
+        first, count = self.bounds
+        if count == first:
+            return None
+        return self.convert_query_result_to_database_entry(self.unpack(count - 1))
+
+    def get_all_records(self) -> List[DatabaseEntry]:
+        """
+        Get all the records in the table, oldest first
+        @return: list of records
+        @rtype: list[DatabaseEntry]
+        """
+        return self.convert_query_results_to_database_entries(list(self.rows()))
+
+    def get_last_n_records(self, n: int):
+        """
+        Get the last n records added, newest first - O(n)
+        @param n: number of records to get
+        @type n: int
+        @return: last n records
+        @rtype: list[DatabaseEntry]
+        """
+        first, count = self.bounds
+        rows = [self.unpack(i) for i in range(count - 1, max(first, count - n) - 1, -1)]
+        return self.convert_query_results_to_database_entries(rows)
+
+    def delete_all_except_last_n_records(self, n: int):
+        """
+        Drop all records except the last n - O(1), nothing is erased
+        @param n: number of records to keep
+        @type n: int
+        """
+        self.drop_oldest(max(len(self) - n, 0))
+
+    def get_column_bounds(self, column_name: str, start: int or float or str or None = None) -> tuple:
+        """
+        Get the smallest & largest values in a column
+        @param column_name: name of the column
+        @type column_name: str
+        @param start: (Optional) only consider values >= start
+        @type start: int or float or str or None
+        @return: (min, max) - both None if there are no rows
+        @rtype: tuple
+        """
+        self.check_column_name(column_name)
+        position = self.column_index[column_name]
+        values = [x[position] for x in self.rows() if x[position] is not None]
+        if start is not None:
+            values = [x for x in values if x >= start]
+        if not values:
+            return None, None
+        return min(values), max(values)
+
+    def get_records_between(
+            self,
+            column_name: str,
+            start: int or float or str,
+            end: int or float or str
+    ) -> List[DatabaseEntry]:
+        """
+        Get the records with start <= column < end, oldest first
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param start: first value to include
+        @type start: int or float or str
+        @param end: first value to exclude
+        @type end: int or float or str
+        @return: matching records
+        @rtype: list[DatabaseEntry]
+        """
+        self.check_column_name(column_name)
+        position = self.column_index[column_name]
+        rows = [x for x in self.rows() if x[position] is not None and start <= x[position] < end]
+        return self.convert_query_results_to_database_entries(sorted(rows, key=lambda x: x[position]))
+
+    def query_range_chunks(
+            self,
+            start: int or float or str or None = None,
+            end: int or float or str or None = None,
+            ids: List[str] or None = None,
+            columns: List[str] or None = None,
+            id_column: str = "id",
+            chunk_size: int = 1000
+    ) -> Iterator[list]:
+        """
+        Stream the rows with start <= timestamp < end in the order they were added, in chunks of chunk_size
+        @param start: (Optional) first timestamp to include - unbounded if None
+        @type start: int or float or str or None
+        @param end: (Optional) first timestamp to exclude - unbounded if None
+        @type end: int or float or str or None
+        @param ids: (Optional) only get records whose id_column is one of these
+        @type ids: list[str] or None
+        @param columns: (Optional) names of the columns to get - all of them if None
+        @type columns: list[str] or None
+        @param id_column: name of the column ids are matched against
+        @type id_column: str
+        @param chunk_size: rows at a time
+        @type chunk_size: int
+        @return: generator of lists of rows
+        @rtype: Iterator[list]
+        """
+        positions = [self.column_index[x.name] for x in self.get_range_columns(columns)]
+        time_position = self.column_index[self.time_column_name]
+        if ids:
+            self.check_column_name(id_column)
+            id_position, ids = self.column_index[id_column], set(ids)
+        chunk = []
+        for row in self.rows():
+            value = row[time_position]
+            if start is not None and (value is None or value < start):
+                continue
+            if end is not None and (value is None or value >= end):
+                continue
+            if ids and row[id_position] not in ids:
+                continue
+            chunk.append(tuple(row[i] for i in positions))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def delete_records_before(self, column_name: str, value: int or float or str, limit: int) -> int:
+        """
+        Drop up to limit of the oldest records with column < value
+        @param column_name: name of the column, e.g. timestamp
+        @type column_name: str
+        @param value: first value to keep
+        @type value: int or float or str
+        @param limit: max number of records to delete
+        @type limit: int
+        @return: number of records deleted
+        @rtype: int
+        """
+        self.check_column_name(column_name)
+        position = self.column_index[column_name]
+        first, count = self.bounds
+        dropped = 0
+        for i in range(first, min(count, first + limit)):
+            if self.unpack(i)[position] >= value:
+                break
+            dropped += 1
+        self.drop_oldest(dropped)
+        return dropped
+
+    def drop(self):
+        """
+        Delete the table's file
+        """
+        self.connection.release(self.name)
+        path = self.connection.get_table_path(self.name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # endregion Records
+
+
+class Database(BaseDatabase):
+    TABLE_CLASS = Table
+    CONNECTION_ERRORS = (OSError, ValueError)
+
+    def __init__(self, tables: Dict[str, List[Column]], name: str, path: str = None, capacity: int = 1024):
+        """
+        Initialize a ring buffer database
+        @param tables: dictionary of table name to columns
+        @type tables: dict[str, list[Column]]
+        @param name: name of the database
+        @type name: str
+        @param path: optional directory for the table files
+        @type path: str or None
+        @param capacity: number of records each table keeps
+        @type capacity: int
+        """
+        super().__init__(tables)
+        self.name = name
+        self.path = path
+        self.capacity = capacity
+
+    def connect(self):
+        """
+        Open the table files, creating them if needed
+        """
+        self.connection = Connection(self.path or get_ringbuffer_path(self.name))
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Create tables based on given definitions - tables are only checked once per connection
+        """
+        if self.tables:
+            return
+        for table_name, columns in self.table_definitions.items():
+            self.tables[table_name] = Table(self.connection, table_name, columns, self.capacity)
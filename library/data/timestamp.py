@@ -0,0 +1,105 @@
+"""
+Collision-free timestamps for primary keys
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import re
+import threading
+import time
+from typing import Tuple
+
+from library.data import Column, DBType
+
+# SQL Server datetime columns store 1/300 s - .000, .003, .007, .010...
+SQL_SERVER_DATETIME_TICKS = 300
+
+
+def get_resolution(column: Column, db_type: str) -> Tuple[int, int]:
+    """
+    Get the timestamp format a column can store without merging
+    neighbouring timestamps
+    @param column: timestamp column
+    @type column: Column
+    @param db_type: type of database the column is in (DBType)
+    @type db_type: str
+    @return: digits of fractional seconds, distinct timestamps per second
+    @rtype: (int, int)
+    """
+    if db_type != DBType.CENTRAL:
+        # sqlite keeps the text as is, the ring buffer has room for all 6 digits
+        return 6, 10 ** 6
+    col_type = column.type.lower().replace(" ", "")
+    if col_type == "datetime":
+        return 3, SQL_SERVER_DATETIME_TICKS
+    match = re.match(r"^(datetime2|datetimeoffset|time)(?:\((\d)\))?$", col_type)
+    if match:
+        # SQL Server defaults to 7 digits - Python stops at 6
+        precision = min(int(match.group(2) or 7), 6)
+        return precision, 10 ** precision
+    return 6, 10 ** 6
+
+
+class TimestampGenerator:
+    """
+    Generates strictly increasing local time timestamps in ISO8601 format,
+    YYYY-MM-DD HH:MM:SS.SSS for 3 digits of precision. When two calls land
+    on the same tick the later one is moved forward one tick so every
+    timestamp is unique and can be used as a primary key. Ticks default to
+    the last printed digit but can be coarser, e.g. 1/300 s for SQL Server
+    datetime columns, so the database's rounding can't merge two timestamps.
+    The date & time part is only formatted once per second
+    """
+
+    def __init__(self, precision: int = 6, ticks_per_second: int or None = None):
+        """
+        @param precision: digits of fractional seconds, 0 to 6
+        @type precision: int
+        @param ticks_per_second: (Optional) distinct timestamps per second - defaults to 10 ** precision
+        @type ticks_per_second: int or None
+        """
+        super()
+        assert 0 <= precision <= 6, f"Timestamp precision must be 0 to 6 digits, not {precision}"
+        self.precision = precision
+        self.ticks_per_second = ticks_per_second or 10 ** precision
+        assert self.ticks_per_second <= 10 ** precision, \
+            f"{precision} digits can't show {self.ticks_per_second} ticks per second"
+        self._lock = threading.Lock()
+        self._last = 0
+        self._second = None  # type: int or None
+        self._prefix = ""
+
+    def now(self) -> int:
+        """
+        @return: current tick
+        @rtype: int
+        """
+        return time.time_ns() * self.ticks_per_second // 10 ** 9
+
+    @property
+    def skew(self) -> float:
+        """
+        @return: seconds the last timestamp is ahead of the clock - only non-zero
+                 while more than one timestamp per tick is being generated
+        @rtype: float
+        """
+        return max(self._last - self.now(), 0) / self.ticks_per_second
+
+    def next(self) -> str:
+        """
+        Get a timestamp later than every previous one
+        @rtype: str
+        """
+        with self._lock:
+            tick = max(self.now(), self._last + 1)
+            self._last = tick
+            second, index = divmod(tick, self.ticks_per_second)
+            if second != self._second:
+                self._second = second
+                self._prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            prefix = self._prefix
+        if not self.precision:
+            return prefix
+        # round to the nearest printable value - the database rounds it back to the same tick
+        fraction = (2 * index * 10 ** self.precision + self.ticks_per_second) // (2 * self.ticks_per_second)
+        return f"{prefix}.{fraction:0{self.precision}d}"
@@ -0,0 +1,262 @@
+"""
+Bounded worker pool for controller message handlers
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List
+
+from library import OverflowPolicies
+
+
+class _Job:
+    """
+    Queued call
+    """
+    __slots__ = ["method", "args", "kwargs", "key", "submitted"]
+
+    def __init__(self, method: Callable, args: tuple, kwargs: dict, key):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.submitted = time.monotonic()
+
+
+class BoundedExecutor:
+    """
+    Fixed number of worker threads fed from a bounded queue. When the
+    queue is full, the overflow policy decides what gives:
+    - drop_oldest: the oldest queued job is discarded to make room
+    - coalesce: a queued job with the same key is replaced by the new one
+      (keeping its place in line); if there isn't one the new job is rejected
+    - reject: the new job is discarded
+    Once shut down, new jobs are rejected until start() is called again
+    """
+
+    def __init__(
+            self,
+            name: str,
+            workers: int = 1,
+            max_queue: int = 8,
+            overflow: str = OverflowPolicies.DROP_OLDEST
+    ):
+        """
+        @param name: name for logging & worker threads
+        @type name: str
+        @param workers: number of worker threads
+        @type workers: int
+        @param max_queue: max number of jobs waiting for a worker
+        @type max_queue: int
+        @param overflow: one of OverflowPolicies
+        @type overflow: str
+        """
+        super()
+        assert overflow in OverflowPolicies.ALL, f"Unknown overflow policy {overflow}"
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+
+        self._queue = deque()  # type: Deque[_Job]
+        self._condition = threading.Condition()
+        self._threads = []  # type: List[threading.Thread]
+        self._running = False
+        self._shutdown = False
+        # Workers exit once shutdown() moves the generation on, even if start() runs again meanwhile
+        self._generation = 0
+        self._active = 0
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._wait_time = 0.0
+        self._run_time = 0.0
+        self.max_run_time = 0.0
+
+    # region Lifecycle
+
+    def start(self):
+        """
+        Start the worker threads (no-op if they're already running),
+        accepting jobs again after a shutdown
+        """
+        with self._condition:
+            self._shutdown = False
+            self._start_workers()
+
+    def _start_workers(self):
+        """
+        Start a new generation of workers if none are running - must hold the lock
+        """
+        if self._running:
+            return
+        self._running = True
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, args=(self._generation,), name=f"{self.name}-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, wait: bool = True, timeout: float or None = None):
+        """
+        Stop the workers and reject new jobs - queued jobs which haven't started are discarded
+        @param wait: whether to wait for running jobs to finish
+        @type wait: bool
+        @param timeout: max seconds to wait for each worker
+        @type timeout: float or None
+        """
+        with self._condition:
+            self._running = False
+            self._shutdown = True
+            self._generation += 1
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join(timeout)
+
+    # endregion Lifecycle
+    # region Jobs
+
+    def submit(self, method: Callable, *args, key=None, **kwargs) -> bool:
+        """
+        Queue a call to method(*args, **kwargs), starting the workers on first use
+        @param method: method to call from a worker thread
+        @type method: method
+        @param key: jobs with equal keys are coalesced - defaults to the method
+        @return: True if the job was queued, False if it was rejected
+        @rtype: bool
+        """
+        job = _Job(method, args, kwargs, method if key is None else key)
+        with self._condition:
+            self.submitted += 1
+            if self._shutdown:
+                # e.g. a late MQTT message while the controller stops
+                self.rejected += 1
+                logging.debug(f"{self.name}: shut down - rejected job {job.method.__name__}")
+                return False
+            self._start_workers()
+            if len(self._queue) >= self.max_queue and not self._overflow(job):
+                return False
+            self._queue.append(job)
+            self._condition.notify()
+            return True
+
+    def _overflow(self, job: _Job) -> bool:
+        """
+        Make room for a job in a full queue - must hold the lock
+        @param job: new job
+        @type job: _Job
+        @return: True if the new job should be appended to the queue
+        @rtype: bool
+        """
+        if self.overflow == OverflowPolicies.DROP_OLDEST:
+            dropped = self._queue.popleft()
+            self.dropped += 1
+            logging.warning(f"{self.name}: queue full - dropped oldest job {dropped.method.__name__}")
+            return True
+
+        if self.overflow == OverflowPolicies.COALESCE:
+            for i, queued in enumerate(self._queue):
+                if queued.key == job.key:
+                    job.submitted = queued.submitted
+                    self._queue[i] = job
+                    self.coalesced += 1
+                    return False
+
+        self.rejected += 1
+        logging.warning(f"{self.name}: queue full - rejected job {job.method.__name__}")
+        return False
+
+    def worker(self, generation: int):
+        """
+        Worker thread - run jobs until shut down
+        @param generation: generation the worker was started in
+        @type generation: int
+        """
+        while True:
+            with self._condition:
+                while self._generation == generation and not self._queue:
+                    self._condition.wait()
+                if self._generation != generation:
+                    return
+                job = self._queue.popleft()
+                self._active += 1
+
+            started = time.monotonic()
+            try:
+                job.method(*job.args, **job.kwargs)
+            except:
+                self.failed += 1
+                logging.exception(f"{self.name}: exception in {job.method.__name__}")
+            finished = time.monotonic()
+
+            with self._condition:
+                self._active -= 1
+                self.completed += 1
+                self._wait_time += started - job.submitted
+                self._run_time += finished - started
+                self.max_run_time = max(self.max_run_time, finished - started)
+                self._condition.notify_all()
+
+    def wait_until_idle(self, timeout: float or None = None) -> bool:
+        """
+        Block until the queue is empty and no jobs are running
+        @param timeout: max seconds to wait
+        @type timeout: float or None
+        @return: True if idle, False if the timeout expired
+        @rtype: bool
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._active, timeout)
+
+    # endregion Jobs
+    # region Metrics
+
+    @property
+    def queue_length(self) -> int:
+        """
+        Number of jobs waiting for a worker
+        @rtype: int
+        """
+        return len(self._queue)
+
+    def metrics(self) -> dict:
+        """
+        Get queue & latency stats - latencies are in seconds
+        @rtype: dict
+        """
+        with self._condition:
+            completed = self.completed
+            return {
+                "queue_length": len(self._queue),
+                "active": self._active,
+                "submitted": self.submitted,
+                "completed": completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "mean_wait_time": self._wait_time / completed if completed else 0.0,
+                "mean_run_time": self._run_time / completed if completed else 0.0,
+                "max_run_time": self.max_run_time,
+            }
+
+    # endregion Metrics
+
+    def __repr__(self) -> str:
+        """
+        @rtype: str
+        """
+        return f"{self.name} ({self.workers} workers, queue {len(self._queue)}/{self.max_queue}, {self.overflow})"
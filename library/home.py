@@ -1,6 +1,6 @@
-import logging
-
+from library import Runtimes
 from library.config import ConfigurationHandler
+from library.supervisor import Supervisor
 
 
 def execute(config_path, stop=lambda: False, debug=False):
@@ -15,23 +15,10 @@ def execute(config_path, stop=lambda: False, debug=False):
     """
     handler = ConfigurationHandler(config_path=config_path, debug=debug)
 
-    try:
-        logging.info("Launching sensor threads")
-        for sensor in handler:
-            sensor.start()
-
-        # Infinite loop while threads run
-        logging.info("Sensor threads launched - looping forever")
-        while not stop():
-            pass
-
-    except KeyboardInterrupt:
-        logging.info("KeyboardInterrupt - exiting gracefully")
+    if handler.runtime == Runtimes.ASYNCIO:
+        from library.runtime import AsyncRuntime
+        AsyncRuntime(handler, stop=stop, debug=debug).run()
+        return
 
-    finally:
-        logging.info("Cleaning up sensor threads")
-        for sensor in handler:
-            try:
-                sensor.cleanup()
-            except:
-                logging.exception(f"Exception cleaning up sensor {sensor}")
+    supervisor = Supervisor(handler, stop=stop, debug=debug)
+    supervisor.run()
@@ -0,0 +1,404 @@
+"""
+Optional asyncio runtime - one event loop and one MQTT session for all controllers
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Set
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+from library import ControllerStates
+from library.communication.mqtt import MQTTConnection, close_connections, get_connection
+from library.controllers import BaseController, get_logger
+
+
+class AsyncRuntime:
+    """
+    Runs every controller from a single asyncio event loop instead of a
+    thread (plus a paho network thread) each. Periodic controllers become
+    tasks calling loop() every period, and subscribing controllers share
+    one MQTT session driven by the event loop - their handlers run as
+    tasks. Blocking sensor, DB and notification I/O is handed to a small
+    executor so it can't stall the loop
+    """
+
+    SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(
+            self,
+            controllers: Iterable[BaseController],
+            stop: Callable[[], bool] = lambda: False,
+            check_interval: float = 1.0,
+            io_workers: int = 2,
+            min_backoff: float = 1.0,
+            max_backoff: float = 120.0,
+            debug: bool = False
+    ):
+        """
+        @param controllers: controllers to run
+        @type controllers: iterable[BaseController]
+        @param stop: method polled every check_interval - return True to shut down
+        @type stop: method
+        @param check_interval: seconds between stop() polls & MQTT keepalive checks
+        @type check_interval: float
+        @param io_workers: number of threads for blocking I/O
+        @type io_workers: int
+        @param min_backoff: seconds to wait before the first reconnect attempt
+        @type min_backoff: float
+        @param max_backoff: upper limit on seconds between reconnect attempts
+        @type max_backoff: float
+        @param debug: debug flag
+        @type debug: bool
+        """
+        super()
+        self.controllers = [x for x in controllers if x]  # type: List[BaseController]
+        self.stop = stop
+        self.check_interval = check_interval
+        self.io_workers = io_workers
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.logger = get_logger(__name__, debug, None)
+
+        self.loop = None  # type: asyncio.AbstractEventLoop or None
+        self.connection = None  # type: MQTTConnection or None
+        self.handlers = {}  # type: Dict[BaseController, Callable]
+        self.tasks = set()  # type: Set[asyncio.Task]
+        self._shutdown = None  # type: asyncio.Event or None
+        self._reconnecting = False
+        self._loop_thread = None  # type: threading.Thread or None
+
+    # region Lifecycle
+
+    def run(self):
+        """
+        Start all controllers and block until shutdown is requested,
+        then clean up all controllers
+        """
+        asyncio.run(self.main())
+
+    async def main(self):
+        """
+        Event loop entry point
+        """
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.current_thread()
+        self.loop.set_default_executor(ThreadPoolExecutor(self.io_workers, thread_name_prefix="io"))
+        self._shutdown = asyncio.Event()
+        signals = self.install_signal_handlers()
+        try:
+            self.start()
+            self.logger.info("Controllers launched - waiting for shutdown")
+            while not self._shutdown.is_set():
+                try:
+                    await asyncio.wait_for(self._shutdown.wait(), self.check_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self.stop():
+                    break
+                self.check_connection()
+        finally:
+            self.remove_signal_handlers(signals)
+            await self.cleanup()
+
+    def start(self):
+        """
+        Start periodic tasks and register message handlers for all controllers
+        """
+        self.logger.info("Launching controllers on the event loop")
+        for controller in self.controllers:
+            try:
+                controller.status = ControllerStates.STARTING
+                controller.initialize()
+                if controller.subscriptions:
+                    self.register(controller)
+                if controller.period:
+                    self.spawn(self.run_periodic(controller))
+                controller.start_retention(self.schedule)
+                controller.status = ControllerStates.RUNNING
+            except:
+                controller.status = ControllerStates.FAILED
+                self.logger.exception(f"Exception starting controller {controller.name}")
+
+        if self.handlers:
+            self.connect()
+
+    def shutdown(self):
+        """
+        Request a shutdown - safe to call from any thread
+        """
+        if self.loop and self._shutdown:
+            self.loop.call_soon_threadsafe(self._shutdown.set)
+
+    async def cleanup(self):
+        """
+        Cancel all tasks, clean up all controllers and close the MQTT session
+        """
+        self.logger.info("Cleaning up controllers")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        for controller in self.controllers:
+            try:
+                controller.cleanup()
+            except:
+                self.logger.exception(f"Exception cleaning up controller {controller.name}")
+        close_connections()
+
+    def spawn(self, coroutine) -> asyncio.Task:
+        """
+        Run a coroutine as a task, keeping a reference until it's done
+        @rtype: asyncio.Task
+        """
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def health(self) -> List[dict]:
+        """
+        Get the state of every controller
+        @return: one health dict per controller
+        @rtype: list[dict]
+        """
+        return [controller.health() for controller in self.controllers]
+
+    # endregion Lifecycle
+    # region Signals
+
+    def install_signal_handlers(self) -> List[int]:
+        """
+        Route SIGTERM/SIGINT to shutdown(). Signal handlers can only be
+        installed from the main thread, so this is a no-op elsewhere
+        @return: signals with handlers installed
+        @rtype: list[int]
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return []
+        for signum in self.SIGNALS:
+            self.loop.add_signal_handler(signum, self._shutdown.set)
+        return list(self.SIGNALS)
+
+    def remove_signal_handlers(self, signals: List[int]):
+        """
+        Remove the handlers added by install_signal_handlers
+        @param signals: signals with handlers installed
+        @type signals: list[int]
+        """
+        for signum in signals:
+            self.loop.remove_signal_handler(signum)
+
+    # endregion Signals
+    # region Periodic
+
+    async def run_periodic(self, controller: BaseController):
+        """
+        Call a controller's loop() every period in the executor
+        @param controller: periodic controller
+        @type controller: BaseController
+        """
+        await self.run_every(controller.loop, controller.period, controller.start_delay, f"{controller.name} loop")
+
+    def schedule(self, callback: Callable, period: float, delay: float = None, name: str = "") -> asyncio.Task:
+        """
+        Call a method every period seconds from a task - same arguments as
+        the shared scheduler's schedule(), so controllers can use either
+        @param callback: method to call
+        @type callback: method
+        @param period: seconds between calls
+        @type period: float
+        @param delay: seconds until the first call - defaults to one period
+        @type delay: float or None
+        @param name: name for logging
+        @type name: str
+        @return: task - cancel() it to stop the calls
+        @rtype: asyncio.Task
+        """
+        assert period > 0, "Period must be positive"
+        return self.spawn(self.run_every(callback, period, delay, name))
+
+    async def run_every(self, callback: Callable, period: float, delay: float or None, name: str):
+        """
+        Call a blocking method every period in the executor. Deadlines
+        are multiples of the period from the first run, and missed
+        deadlines are skipped rather than stacked
+        @param callback: method to call
+        @type callback: method
+        @param period: seconds between calls
+        @type period: float
+        @param delay: seconds until the first call - defaults to one period
+        @type delay: float or None
+        @param name: name for logging
+        @type name: str
+        """
+        next_run = self.loop.time() + (period if delay is None else delay)
+        while True:
+            await asyncio.sleep(max(next_run - self.loop.time(), 0.0))
+            try:
+                await self.loop.run_in_executor(None, callback)
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.logger.exception(f"Exception in {name}")
+
+            now = self.loop.time()
+            missed = int((now - next_run) // period)
+            next_run += (max(missed, 0) + 1) * period
+
+    # endregion Periodic
+    # region MQTT
+
+    def register(self, controller: BaseController):
+        """
+        Route a controller's subscriptions to it over the shared session
+        @param controller: subscribing controller
+        @type controller: BaseController
+        """
+        mqtt_config = controller.config.mqtt_config
+        if self.connection is None:
+            self.connection = get_connection(
+                mqtt_config.broker,
+                mqtt_config.port,
+                mqtt_config.outbox_path,
+                mqtt_config.outbox_size,
+                mqtt_config.outbox_rate
+            )
+        elif (mqtt_config.broker, mqtt_config.port) != (self.connection.broker, self.connection.port):
+            raise Exception(f"{controller.name} uses broker {mqtt_config.broker}:{mqtt_config.port} - "
+                            f"the asyncio runtime only supports one broker ({self.connection})")
+
+        # Add routes directly - subscribe() would start paho's network thread.
+        # The session subscribes to everything routed once it connects
+        self.handlers[controller] = partial(self.dispatch, controller)
+        for topic in controller.subscriptions:
+            self.connection.router.add(topic, self.handlers[controller])
+
+    def connect(self):
+        """
+        Hook the shared session's socket up to the event loop and connect
+        """
+        client = self.connection.client
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.connection.start(network_thread=False)
+        self.spawn(self.reconnect())
+
+    async def reconnect(self):
+        """
+        Connect to the broker, backing off between failed attempts
+        """
+        self._reconnecting = True
+        backoff = self.min_backoff
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    await self.loop.run_in_executor(None, self.connection.connect)
+                    return
+                except OSError as e:
+                    self.logger.warning(f"Failed to connect to {self.connection} ({e}) - retrying in {backoff:0.1f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        finally:
+            self._reconnecting = False
+
+    def check_connection(self):
+        """
+        Let paho send keepalive pings & retry messages, and reconnect if
+        the session dropped
+        """
+        if self.connection is None:
+            return
+        rc = self.connection.client.loop_misc()
+        if rc != MQTT_ERR_SUCCESS and not self._reconnecting:
+            self.spawn(self.reconnect())
+
+    def on_connect(self, client, userdata, flags, rc):
+        """
+        Log the connection - the session subscribes to every controller's topics
+        """
+        self.logger.info(f"mqtt: (CONNECT) {self.connection} received with code {rc}")
+        self.connection.on_connect(client, userdata, flags, rc)
+
+    def on_disconnect(self, client, userdata, rc):
+        """
+        Note the dropped session - check_connection reconnects
+        """
+        self.connection.on_disconnect(client, userdata, rc)
+        self.logger.warning(f"mqtt: (DISCONNECT) {self.connection} with code {rc}")
+
+    def dispatch(self, controller: BaseController, client, userdata, msg):
+        """
+        Hand a message routed to a controller to its async handler - called
+        from the event loop when the socket is readable
+        @param controller: subscribed controller
+        @type controller: BaseController
+        """
+        self.logger.debug(f"mqtt: (MESSAGE) {controller.name} topic: {msg.topic}, QOS: {msg.qos}")
+        message_data = controller.decode_message(msg)
+        if message_data is not None:
+            self.spawn(self.handle(controller, msg.topic, message_data))
+
+    async def handle(self, controller: BaseController, topic: str, message_data: dict):
+        """
+        Run a controller's message handler, logging anything it raises
+        @param controller: subscribed controller
+        @type controller: BaseController
+        @param topic: topic the message came from
+        @type topic: str
+        @param message_data: decoded payload
+        @type message_data: dict
+        """
+        try:
+            await controller.handle_message_async(topic, message_data)
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.logger.exception(f"Exception in {controller.name} message handler")
+
+    # paho may open/close the socket from an executor thread (connect,
+    # publish), so changes to the event loop's watched sockets are passed
+    # back to the loop thread. File descriptors are read up front since
+    # the socket may be closed by the time the loop gets to the change
+
+    def on_socket_open(self, client, userdata, sock):
+        self.update_selector(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.update_selector(self.loop.remove_reader, sock.fileno())
+        self.update_selector(self.loop.remove_writer, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.update_selector(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.update_selector(self.loop.remove_writer, sock.fileno())
+
+    def update_selector(self, method: Callable, fd: int, *args):
+        """
+        Add/remove a socket reader/writer from the loop thread
+        @param method: loop.add_reader, loop.remove_writer, etc.
+        @type method: method
+        @param fd: socket's file descriptor
+        @type fd: int
+        """
+        if self._loop_thread is not threading.current_thread():
+            self.loop.call_soon_threadsafe(self.update_selector, method, fd, *args)
+            return
+        try:
+            method(fd, *args)
+        except OSError:
+            # Socket was closed before the change was made - nothing left to watch
+            pass
+
+    # endregion MQTT
@@ -0,0 +1,232 @@
+"""
+Shared scheduler for periodic controller work
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+class PeriodicJob:
+    """
+    Handle for a callback registered with the Scheduler
+    """
+
+    def __init__(self, scheduler, callback: Callable, period: float, name: str = ""):
+        """
+        @param scheduler: scheduler running this job
+        @type scheduler: Scheduler
+        @param callback: method to call every period
+        @type callback: method
+        @param period: seconds between calls
+        @type period: float
+        @param name: name for logging
+        @type name: str
+        """
+        super()
+        self.scheduler = scheduler
+        self.callback = callback
+        self.period = period
+        self.name = name or getattr(callback, "__qualname__", str(callback))
+
+        self.next_run = 0.0
+        self.cancelled = False
+        self.busy = False
+        self.runs = 0
+        self.skipped = 0
+
+    def cancel(self):
+        """
+        Stop running this job
+        """
+        self.scheduler.cancel(self)
+
+    def __repr__(self) -> str:
+        """
+        @rtype: str
+        """
+        return f"{self.name} (every {self.period}s)"
+
+
+class Scheduler:
+    """
+    Single thread sleeping on a heap of deadlines - due jobs are handed
+    off to a small worker pool so a slow sensor read doesn't delay the rest
+    """
+
+    def __init__(self, workers: int = 2):
+        """
+        @param workers: number of worker threads for running callbacks
+        @type workers: int
+        """
+        super()
+        self.workers = workers
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None  # type: ThreadPoolExecutor or None
+        self._thread = None  # type: threading.Thread or None
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        """
+        Check if the scheduler thread is running
+        @rtype: bool
+        """
+        return self._running
+
+    def start(self):
+        """
+        Start the scheduler thread (no-op if it's already running)
+        """
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scheduler")
+            self._thread = threading.Thread(target=self.loop, name="scheduler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the scheduler thread and worker pool
+        @param wait: whether to wait for running callbacks to finish
+        @type wait: bool
+        """
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def schedule(self, callback: Callable, period: float, delay: float = None, name: str = "") -> PeriodicJob:
+        """
+        Call a method every period seconds
+        @param callback: method to call
+        @type callback: method
+        @param period: seconds between calls
+        @type period: float
+        @param delay: seconds until the first call - defaults to one period
+        @type delay: float or None
+        @param name: name for logging
+        @type name: str
+        @return: handle for cancelling the job
+        @rtype: PeriodicJob
+        """
+        assert period > 0, "Period must be positive"
+        job = PeriodicJob(self, callback, period, name)
+        job.next_run = time.monotonic() + (period if delay is None else delay)
+        with self._condition:
+            heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+            self._condition.notify()
+        self.start()
+        return job
+
+    def cancel(self, job: PeriodicJob):
+        """
+        Cancel a job - it's dropped from the heap the next time it comes up
+        @param job: job to cancel
+        @type job: PeriodicJob
+        """
+        with self._condition:
+            job.cancelled = True
+            self._condition.notify()
+
+    def loop(self):
+        """
+        Sleep until the earliest deadline, dispatch the job and reschedule it
+        """
+        with self._condition:
+            while self._running:
+                # Lazily drop cancelled jobs
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+
+                _, _, job = heapq.heappop(self._heap)
+                self.dispatch(job)
+                job.next_run = self.get_next_run(job, time.monotonic())
+                heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+
+    @staticmethod
+    def get_next_run(job: PeriodicJob, now: float) -> float:
+        """
+        Get the next deadline for a job. Deadlines are multiples of the period
+        from the first deadline rather than from when the job actually ran, so
+        jitter doesn't accumulate. Deadlines missed entirely are skipped.
+        @param job: job that just ran
+        @type job: PeriodicJob
+        @param now: current monotonic time
+        @type now: float
+        @return: next monotonic deadline
+        @rtype: float
+        """
+        missed = int((now - job.next_run) // job.period)
+        if missed > 0:
+            job.skipped += missed
+            logging.debug(f"Scheduler: {job} fell behind - skipping {missed} run(s)")
+        return job.next_run + (max(missed, 0) + 1) * job.period
+
+    def dispatch(self, job: PeriodicJob):
+        """
+        Hand a due job off to the worker pool, skipping it if the previous
+        run hasn't finished yet
+        @param job: due job
+        @type job: PeriodicJob
+        """
+        if job.busy:
+            job.skipped += 1
+            logging.debug(f"Scheduler: {job} still running - skipping")
+            return
+        job.busy = True
+        self._executor.submit(self.run_job, job)
+
+    @staticmethod
+    def run_job(job: PeriodicJob):
+        """
+        Run a job's callback in a worker thread
+        @param job: job to run
+        @type job: PeriodicJob
+        """
+        try:
+            if not job.cancelled:
+                job.callback()
+        except:
+            logging.exception(f"Scheduler: exception in {job}")
+        finally:
+            job.runs += 1
+            job.busy = False
+
+
+def get_scheduler() -> Scheduler:
+    """
+    Get the process-wide scheduler shared by all periodic controllers
+    @rtype: Scheduler
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = Scheduler()
+        return _SCHEDULER
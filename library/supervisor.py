@@ -0,0 +1,245 @@
+"""
+Supervisor for controller threads
+Author: Charles "Chip" Wood
+        imchipwood@gmail.com
+        github.com/imchipwood
+"""
+import signal
+import threading
+import time
+from typing import Callable, Dict, Iterable, List
+
+from library import ControllerStates
+from library.communication.mqtt import close_connections
+from library.controllers import BaseController, get_logger
+
+
+class Supervisor:
+    """
+    Starts a set of controllers, sleeps until a shutdown is requested
+    (signal, stop() callback or shutdown()) and restarts any controller
+    whose thread dies unexpectedly, backing off between attempts
+    """
+
+    SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(
+            self,
+            controllers: Iterable[BaseController],
+            stop: Callable[[], bool] = lambda: False,
+            check_interval: float = 1.0,
+            min_backoff: float = 1.0,
+            max_backoff: float = 300.0,
+            debug: bool = False
+    ):
+        """
+        @param controllers: controllers to supervise
+        @type controllers: iterable[BaseController]
+        @param stop: method polled every check_interval - return True to shut down
+        @type stop: method
+        @param check_interval: seconds between controller health checks
+        @type check_interval: float
+        @param min_backoff: seconds to wait before the first restart attempt
+        @type min_backoff: float
+        @param max_backoff: upper limit on seconds between restart attempts
+        @type max_backoff: float
+        @param debug: debug flag
+        @type debug: bool
+        """
+        super()
+        self.controllers = [x for x in controllers if x]  # type: List[BaseController]
+        self.stop = stop
+        self.check_interval = check_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.logger = get_logger(__name__, debug, None)
+
+        self._shutdown = threading.Event()
+        self._backoff = {}  # type: Dict[BaseController, float]
+        self._next_restart = {}  # type: Dict[BaseController, float]
+        self._last_restart = {}  # type: Dict[BaseController, float]
+        self.restarts = {}  # type: Dict[BaseController, int]
+
+    # region Lifecycle
+
+    def start(self):
+        """
+        Start all controllers
+        """
+        self.logger.info("Launching sensor threads")
+        for controller in self.controllers:
+            try:
+                controller.start()
+            except:
+                # Leave it to check() to retry
+                controller.status = ControllerStates.FAILED
+                self.logger.exception(f"Exception starting sensor {controller.name}")
+
+    def run(self):
+        """
+        Start all controllers and block until shutdown is requested,
+        then clean up all controllers
+        """
+        previous_handlers = self.install_signal_handlers()
+        try:
+            self.start()
+            self.logger.info("Sensor threads launched - waiting for shutdown")
+            while not self._shutdown.is_set():
+                self._shutdown.wait(self.get_wait_time())
+                if self.stop():
+                    break
+                self.check()
+
+        except KeyboardInterrupt:
+            self.logger.info("KeyboardInterrupt - exiting gracefully")
+
+        finally:
+            self.restore_signal_handlers(previous_handlers)
+            self.cleanup()
+
+    def shutdown(self, signum=None, frame=None):
+        """
+        Request a shutdown - usable directly as a signal handler
+        @param signum: signal number if called as a signal handler
+        @type signum: int or None
+        @param frame: current stack frame if called as a signal handler
+        """
+        if signum is not None:
+            self.logger.info(f"Received signal {signum} - shutting down")
+        self._shutdown.set()
+
+    def cleanup(self):
+        """
+        Clean up all controllers
+        """
+        self.logger.info("Cleaning up sensor threads")
+        for controller in self.controllers:
+            try:
+                controller.cleanup()
+            except:
+                self.logger.exception(f"Exception cleaning up sensor {controller.name}")
+        close_connections()
+
+    # endregion Lifecycle
+    # region Signals
+
+    def install_signal_handlers(self) -> dict:
+        """
+        Route SIGTERM/SIGINT to shutdown(). Signal handlers can only be
+        installed from the main thread, so this is a no-op elsewhere
+        @return: previous handlers keyed by signal number
+        @rtype: dict
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+
+        previous_handlers = {}
+        for signum in self.SIGNALS:
+            previous_handlers[signum] = signal.signal(signum, self.shutdown)
+        return previous_handlers
+
+    @staticmethod
+    def restore_signal_handlers(previous_handlers: dict):
+        """
+        Put back the handlers replaced by install_signal_handlers
+        @param previous_handlers: handlers keyed by signal number
+        @type previous_handlers: dict
+        """
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    # endregion Signals
+    # region Health
+
+    def get_wait_time(self) -> float:
+        """
+        Get how long to sleep before the next check - wake up early
+        if a restart is due before the regular check interval
+        @rtype: float
+        """
+        wait_time = self.check_interval
+        if self._next_restart:
+            wait_time = min(wait_time, min(self._next_restart.values()) - time.monotonic())
+        return max(wait_time, 0.0)
+
+    def health(self) -> List[dict]:
+        """
+        Get the state of every supervised controller
+        @return: one health dict per controller
+        @rtype: list[dict]
+        """
+        health = []
+        for controller in self.controllers:
+            controller_health = controller.health()
+            controller_health["restarts"] = self.restarts.get(controller, 0)
+            health.append(controller_health)
+        return health
+
+    @staticmethod
+    def is_dead(controller: BaseController) -> bool:
+        """
+        Check if a controller should be running but isn't. Controllers
+        which were deliberately stopped are left alone
+        @param controller: controller to check
+        @type controller: BaseController
+        @rtype: bool
+        """
+        if controller.status not in [ControllerStates.RUNNING, ControllerStates.FAILED]:
+            return False
+        return not controller.alive
+
+    def check(self):
+        """
+        Check all controllers and restart any which have died
+        """
+        now = time.monotonic()
+        for controller in self.controllers:
+            if not self.is_dead(controller):
+                continue
+
+            # First time seeing this crash - schedule the restart
+            if controller not in self._next_restart:
+                self.schedule_restart(controller, now)
+
+            if now >= self._next_restart[controller]:
+                self.restart(controller, now)
+
+    def schedule_restart(self, controller: BaseController, now: float):
+        """
+        Schedule a restart for a dead controller, doubling the delay
+        each time it dies shortly after being restarted
+        @param controller: dead controller
+        @type controller: BaseController
+        @param now: current monotonic time
+        @type now: float
+        """
+        backoff = self._backoff.get(controller, self.min_backoff)
+        last_restart = self._last_restart.get(controller)
+        if last_restart is None or now - last_restart > self.max_backoff:
+            backoff = self.min_backoff
+
+        self._backoff[controller] = backoff
+        self._next_restart[controller] = now + backoff
+        self.logger.warning(f"Controller {controller.name} died - restarting in {backoff:0.1f}s")
+
+    def restart(self, controller: BaseController, now: float):
+        """
+        Restart a dead controller
+        @param controller: dead controller
+        @type controller: BaseController
+        @param now: current monotonic time
+        @type now: float
+        """
+        del self._next_restart[controller]
+        self._last_restart[controller] = now
+        self._backoff[controller] = min(self._backoff[controller] * 2, self.max_backoff)
+        self.restarts[controller] = self.restarts.get(controller, 0) + 1
+
+        self.logger.info(f"Restarting controller {controller.name} (attempt {self.restarts[controller]})")
+        try:
+            controller.restart()
+        except:
+            self.logger.exception(f"Exception restarting sensor {controller.name}")
+
+    # endregion Health
@@ -27,9 +27,20 @@ TABLE1 = {
     DB1_NAME: DB1_COLUMNS
 }
 
+DB2_NAME = "PITEST_DB2"
+DB2_COLUMNS = [
+    Column("timestamp", "integer", "PRIMARY KEY"),
+    Column("state", "varchar(50)", "NOT NULL", index=True),
+    Column("notified", "integer", "NOT NULL")
+]
+TABLE2 = {
+    DB2_NAME: DB2_COLUMNS
+}
+
 TABLE_NAMES = [
     DB0_NAME,
-    DB1_NAME
+    DB1_NAME,
+    DB2_NAME
 ]
 
 server = "localhost,1433"
@@ -268,3 +279,90 @@ def test_update_record(table_dict, data_to_add):
             table.update_record(primary_key_value, "notified", int(True))
             entry = table.get_record(primary_key_value)
             assert entry["notified"]
+
+
+@pytest.mark.parametrize("table_dict", [
+    TABLE1,
+    TABLE2
+])
+def test_get_records_where(table_dict):
+    """
+    Test getting records by exact match on a column, newest first
+    @param table_dict: list of columns to add to table
+    @type table_dict: Dict[str, List[Column]]
+    """
+    name = list(table_dict.keys())[0]
+    with Database(table_dict, server, database, username, password) as db:
+        table = db.get_table(name)
+        table.add_data_multiple(arrange_data_for_insert(["a", "b", "a", "ab", "a"]))
+
+        matches = table.get_records_where("state", "a")
+        assert [x["timestamp"] for x in matches] == [4, 2, 0]
+
+        matches = table.get_records_where("state", "a", limit=1)
+        assert [x["timestamp"] for x in matches] == [4]
+
+        matches = table.get_records_where("state", "b", order_by="notified")
+        assert [x["timestamp"] for x in matches] == [1]
+
+        assert not table.get_records_where("state", "c")
+
+        with pytest.raises(Exception):
+            table.get_records_where("missing", "a")
+
+
+def test_time_range():
+    """
+    Test the bounds, range & batched delete queries retention is built on
+    """
+    with Database(TABLE1, server, database, username, password) as db:
+        table = db.get_table(DB1_NAME)
+        assert table.get_column_bounds("timestamp") == (None, None)
+        table.add_data_multiple(arrange_data_for_insert(["a", "b", "c", "d", "e"]))
+
+        assert table.get_column_bounds("timestamp") == (0, 4)
+        assert table.get_column_bounds("timestamp", 3) == (3, 4)
+        assert [x["state"] for x in table.get_records_between("timestamp", 1, 3)] == ["b", "c"]
+
+        assert table.delete_records_before("timestamp", 4, 2) == 2
+        assert table.delete_records_before("timestamp", 4, 2) == 2
+        assert table.delete_records_before("timestamp", 4, 2) == 0
+        assert [x["state"] for x in table.get_all_records()] == ["e"]
+
+
+def test_query_range():
+    """
+    Test streaming a time range in chunks, filtered by id and narrowed to some columns
+    """
+    with Database(TABLE1, server, database, username, password) as db:
+        table = db.get_table(DB1_NAME)
+        table.add_data_multiple([(i, f"sensor{i % 3}", 0) for i in range(100)])
+
+        assert [x["timestamp"] for x in table.query_range(10, 40, chunk_size=7)] == list(range(10, 40))
+        assert len(list(table.query_range())) == 100
+        assert [x["timestamp"] for x in table.query_range(start=97)] == [97, 98, 99]
+
+        entries = list(table.query_range(
+            0, 10, ids=["sensor0", "sensor2"], columns=["timestamp", "state"], id_column="state"
+        ))
+        assert [x["timestamp"] for x in entries] == [0, 2, 3, 5, 6, 8, 9]
+        assert entries[0]["notified"] is None
+
+
+def test_bulk_insert():
+    """
+    Test that large inserts are split into multi-row statements under SQL Server's parameter limit
+    """
+    with Database(TABLE1, server, database, username, password) as db:
+        table = db.get_table(DB1_NAME)
+        # 3 columns - 699 rows of 3 parameters fit under 2100
+        assert table.insert_chunk_size == 699
+        rows = [(i, f"sensor{i % 3}", 0) for i in range(2500)]
+        table.add_data_multiple(rows)
+        assert len(table.get_all_records()) == 2500
+        assert table.get_latest_record()["timestamp"] == 2499
+
+        # a failed chunk rolls the whole insert back
+        with pytest.raises(Exception):
+            table.add_data_multiple([(i, "sensor0", 0) for i in range(2500, 3500)] + [rows[0]])
+        assert len(table.get_all_records()) == 2500
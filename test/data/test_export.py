@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from library.data import Column
+from library.data.local_database import Database, get_database_path
+
+numpy = pytest.importorskip("numpy")
+
+from library.data.export import get_dtype, load_arrays, save_arrays, to_arrays
+
+DB_PATH = get_database_path("TEST_EXPORT_DB")
+TABLE_NAME = "PITEST_EXPORT"
+COLUMNS = [
+    Column("timestamp", "datetime", "PRIMARY KEY"),
+    Column("id", "varchar(50)", "NOT NULL"),
+    Column("temperature", "real", "NOT NULL"),
+    Column("humidity", "real", "NOT NULL"),
+]
+ROWS = [
+    (f"2024-01-01 00:{i // 60:02d}:{i % 60:02d}.000", f"sensor{i % 2}", 20.0 + i / 4, 50.0)
+    for i in range(100)
+]
+
+
+@pytest.fixture
+def table():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    with Database({TABLE_NAME: COLUMNS}, TABLE_NAME, DB_PATH) as db:
+        table = db.get_table(TABLE_NAME)
+        table.add_data_multiple(ROWS)
+        yield table
+    os.remove(DB_PATH)
+
+
+def test_dtypes():
+    assert [get_dtype(x) for x in COLUMNS] == ["datetime64[ms]", "U", "float32", "float32"]
+    assert get_dtype(Column("count", "integer", "")) == "int64"
+
+
+def test_to_arrays():
+    arrays = to_arrays((ROWS[i:i + 7] for i in range(0, 100, 7)), COLUMNS)
+    assert list(arrays) == ["timestamp", "id", "temperature", "humidity"]
+    assert arrays["timestamp"].dtype == numpy.dtype("datetime64[ms]")
+    assert arrays["temperature"].dtype == numpy.float32
+    assert len(arrays["id"]) == 100
+    assert arrays["timestamp"][61] == numpy.datetime64("2024-01-01T00:01:01")
+    assert arrays["temperature"][4] == 21.0
+
+    empty = to_arrays([], COLUMNS)
+    assert len(empty["timestamp"]) == 0
+    assert empty["humidity"].dtype == numpy.float32
+
+
+def test_export_range(table):
+    arrays = table.export_range("2024-01-01 00:00:10", "2024-01-01 00:00:20", chunk_size=3)
+    assert len(arrays["timestamp"]) == 10
+    assert arrays["timestamp"][0] == numpy.datetime64("2024-01-01T00:00:10")
+    assert arrays["temperature"].tolist() == [20.0 + i / 4 for i in range(10, 20)]
+
+    arrays = table.export_range(ids=["sensor1"], columns=["timestamp", "temperature"])
+    assert list(arrays) == ["timestamp", "temperature"]
+    assert len(arrays["timestamp"]) == 50
+
+    groups = table.export_range(group_by="id")
+    assert list(groups) == ["sensor0", "sensor1"]
+    assert list(groups["sensor0"]) == ["timestamp", "temperature", "humidity"]
+    assert groups["sensor1"]["temperature"][0] == 20.25
+
+
+def test_save_load(table, tmp_path):
+    path = str(tmp_path / "export.npz")
+    arrays = table.export_range()
+    save_arrays(path, arrays)
+    loaded = load_arrays(path)
+    assert list(loaded) == list(arrays)
+    for name in arrays:
+        assert numpy.array_equal(loaded[name], arrays[name])
+
+    groups = table.export_range(group_by="id")
+    save_arrays(path, groups, compress=False)
+    loaded = load_arrays(path)
+    assert list(loaded) == ["sensor0", "sensor1"]
+    assert numpy.array_equal(loaded["sensor1"]["timestamp"], groups["sensor1"]["timestamp"])
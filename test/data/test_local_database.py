@@ -1,10 +1,14 @@
 import os
+import sqlite3
+import threading
+import types
 from typing import List, Dict
 
 import pytest
 
-from library.data import Column
-from library.data.local_database import Database, get_database_path
+from library.data import Column, DatabaseEntry, ResultSet
+from library.data.database import QueryKeys
+from library.data.local_database import Database, Table, get_database_path
 
 DB_PATH = get_database_path("TEST_DB")
 
@@ -27,9 +31,20 @@ TABLE1 = {
     DB1_NAME: DB1_COLUMNS
 }
 
+DB2_NAME = "PITEST_DB2"
+DB2_COLUMNS = [
+    Column("timestamp", "integer", "PRIMARY KEY"),
+    Column("state", "varchar(50)", "NOT NULL", index=True),
+    Column("notified", "integer", "NOT NULL")
+]
+TABLE2 = {
+    DB2_NAME: DB2_COLUMNS
+}
+
 TABLE_NAMES = [
     DB0_NAME,
-    DB1_NAME
+    DB1_NAME,
+    DB2_NAME
 ]
 
 
@@ -40,8 +55,9 @@ def arrange_data_for_insert(data_to_add: List[int or str]) -> List[tuple]:
 
 
 def remove_dbs():
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
+    for path in [DB_PATH, DB_PATH + "-wal", DB_PATH + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def teardown_function(function):
@@ -247,3 +263,267 @@ def test_update_record(table_dict, data_to_add):
             table.update_record(primary_key_value, "notified", int(True))
             entry = table.get_record(primary_key_value)
             assert entry["notified"]
+
+
+def test_keep_open(monkeypatch):
+    """
+    Test that a kept-open database reuses its connection, only checks its
+    tables once per connection and reconnects after a connection error
+    """
+    checks = []
+    does_table_exist = Table.does_table_exist
+
+    def counting_does_table_exist(self, table_name):
+        checks.append(table_name)
+        return does_table_exist(self, table_name)
+
+    monkeypatch.setattr(Table, "does_table_exist", counting_does_table_exist)
+
+    db = Database(TABLE0, DB0_NAME, DB_PATH)
+    db.keep_open = True
+    with db:
+        connection = db.connection
+        db.get_table(DB0_NAME).add_data([0, 1, int(False)])
+    assert db.connected
+
+    with db:
+        assert db.connection is connection
+        assert len(db.get_table(DB0_NAME).get_all_records()) == 1
+    assert checks == [DB0_NAME]
+
+    with pytest.raises(sqlite3.OperationalError):
+        with db:
+            db.get_table(DB0_NAME).cursor.execute("SELECT * FROM missing_table")
+    assert not db.connected
+
+    with db:
+        assert db.connection is not connection
+        assert len(db.get_table(DB0_NAME).get_all_records()) == 1
+    assert checks == [DB0_NAME, DB0_NAME]
+
+    db.cleanup()
+    assert not db.connected
+
+
+@pytest.mark.parametrize("table_dict", [
+    TABLE1,
+    TABLE2
+])
+def test_get_records_where(table_dict):
+    """
+    Test getting records by exact match on a column, newest first
+    @param table_dict: list of columns to add to table
+    @type table_dict: Dict[str, List[Column]]
+    """
+    name = list(table_dict.keys())[0]
+    with Database(table_dict, name, DB_PATH) as db:
+        table = db.get_table(name)
+        table.add_data_multiple(arrange_data_for_insert(["a", "b", "a", "ab", "a"]))
+
+        matches = table.get_records_where("state", "a")
+        assert [x["timestamp"] for x in matches] == [4, 2, 0]
+
+        matches = table.get_records_where("state", "a", limit=1)
+        assert [x["timestamp"] for x in matches] == [4]
+
+        matches = table.get_records_where("state", "b", order_by="notified")
+        assert [x["timestamp"] for x in matches] == [1]
+
+        assert not table.get_records_where("state", "c")
+
+        with pytest.raises(Exception):
+            table.get_records_where("missing", "a")
+
+        # Lookups by an indexed column don't scan the table
+        plan = table.cursor.execute(
+            f"EXPLAIN QUERY PLAN SELECT * FROM {name} WHERE state = ?", ["a"]
+        ).fetchall()
+        if table.columns[1].index:
+            assert f"USING INDEX {table.get_index_name('state')}" in str(plan)
+
+
+def test_exact_match():
+    """
+    Test that primary key lookups & updates only touch the exact key and
+    reuse one cached statement
+    """
+    with Database(TABLE1, DB1_NAME, DB_PATH) as db:
+        table = db.get_table(DB1_NAME)
+        table.add_data_multiple([(1, "a", 0), (11, "b", 0), (21, "c", 0)])
+
+        table.update_record(1, "state", "it's")
+        assert [x["state"] for x in table.get_all_records()] == ["it's", "b", "c"]
+        assert table.get_record(1)["state"] == "it's"
+        assert table.get_record(2) is None
+
+        assert table.query(QueryKeys.GET) is table.query(QueryKeys.GET)
+
+
+def test_pragmas():
+    """
+    Test that PRAGMAs are applied to every connection and bad ones are refused
+    """
+    pragmas = {"busy_timeout": 2500, "journal_mode": "wal", "synchronous": "normal", "cache_size": -4096}
+    db = Database(TABLE0, DB0_NAME, DB_PATH, pragmas)
+    with db:
+        cursor = db.connection.cursor()
+        assert cursor.execute("PRAGMA busy_timeout").fetchone()[0] == 2500
+        assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # normal = 1
+        assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert cursor.execute("PRAGMA cache_size").fetchone()[0] == -4096
+
+    with pytest.raises(Exception):
+        with Database(TABLE0, DB0_NAME, DB_PATH, {"journal_mode": "wal; DROP TABLE x"}):
+            pass
+
+
+def test_concurrent_access():
+    """
+    Test that writers & readers on separate connections to one WAL file,
+    and several threads sharing one connection, don't step on each other
+    """
+    pragmas = {"busy_timeout": 5000, "journal_mode": "wal", "synchronous": "normal"}
+    shared = Database(TABLE0, DB0_NAME, DB_PATH, pragmas)
+    shared.keep_open = True
+    with shared:
+        pass
+
+    rows_per_writer = 200
+    errors = []
+
+    def write(offset, db):
+        try:
+            for i in range(rows_per_writer):
+                with db:
+                    db.get_table(DB0_NAME).add_data([offset + i, i, int(False)])
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            with Database(TABLE0, DB0_NAME, DB_PATH, pragmas) as db:
+                for _ in range(rows_per_writer):
+                    db.get_table(DB0_NAME).get_latest_record()
+        except Exception as e:
+            errors.append(e)
+
+    # two threads on their own connections, two sharing the kept-open one
+    threads = [
+        threading.Thread(target=write, args=(0, Database(TABLE0, DB0_NAME, DB_PATH, pragmas))),
+        threading.Thread(target=write, args=(1000, Database(TABLE0, DB0_NAME, DB_PATH, pragmas))),
+        threading.Thread(target=write, args=(2000, shared)),
+        threading.Thread(target=write, args=(3000, shared)),
+        threading.Thread(target=read),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shared.cleanup()
+
+    assert not errors
+    with Database(TABLE0, DB0_NAME, DB_PATH) as db:
+        assert len(db.get_table(DB0_NAME).get_all_records()) == rows_per_writer * 4
+
+
+def test_time_range():
+    """
+    Test the bounds, range & batched delete queries retention is built on
+    """
+    with Database(TABLE1, DB1_NAME, DB_PATH) as db:
+        table = db.get_table(DB1_NAME)
+        assert table.get_column_bounds("timestamp") == (None, None)
+        table.add_data_multiple(arrange_data_for_insert(["a", "b", "c", "d", "e"]))
+
+        assert table.get_column_bounds("timestamp") == (0, 4)
+        assert table.get_column_bounds("timestamp", 3) == (3, 4)
+        assert [x["state"] for x in table.get_records_between("timestamp", 1, 3)] == ["b", "c"]
+
+        assert table.delete_records_before("timestamp", 4, 2) == 2
+        assert table.delete_records_before("timestamp", 4, 2) == 2
+        assert table.delete_records_before("timestamp", 4, 2) == 0
+        assert [x["state"] for x in table.get_all_records()] == ["e"]
+
+
+def test_query_range():
+    """
+    Test streaming a time range in chunks, filtered by id and narrowed to some columns
+    """
+    columns = [
+        Column("timestamp", "integer", "PRIMARY KEY"),
+        Column("id", "varchar(50)", "NOT NULL"),
+        Column("temperature", "real", "NOT NULL"),
+    ]
+    with Database({DB0_NAME: columns}, DB0_NAME, DB_PATH) as db:
+        table = db.get_table(DB0_NAME)
+        table.add_data_multiple([(i, f"sensor{i % 3}", i / 2) for i in range(100)])
+
+        records = table.query_range(10, 40, chunk_size=7)
+        assert isinstance(records, types.GeneratorType)
+        entries = list(records)
+        assert [x["timestamp"] for x in entries] == list(range(10, 40))
+        assert entries[0]["temperature"] == 5.0
+
+        assert len(list(table.query_range())) == 100
+        assert [x["timestamp"] for x in table.query_range(start=97)] == [97, 98, 99]
+        assert [x["timestamp"] for x in table.query_range(end=2)] == [0, 1]
+
+        entries = list(table.query_range(0, 10, ids=["sensor0", "sensor2"], columns=["timestamp", "id"]))
+        assert [x["timestamp"] for x in entries] == [0, 2, 3, 5, 6, 8, 9]
+        assert entries[0]["temperature"] is None
+        assert entries[0].get("id") == "sensor0"
+
+        # other queries on the table while streaming don't cut it short
+        count = 0
+        for _ in table.query_range(chunk_size=10):
+            table.get_latest_record()
+            count += 1
+        assert count == 100
+
+        with pytest.raises(Exception):
+            list(table.query_range(columns=["missing"]))
+
+        # the range is read off the timestamp's index rather than scanning the table
+        plan = table.cursor.execute(
+            f"EXPLAIN QUERY PLAN {table.query(QueryKeys.RANGE, ('timestamp',), 'id', 0, True, True)}", [10, 40]
+        ).fetchall()
+        assert "SEARCH" in str(plan)
+
+
+def test_result_set():
+    """
+    Test that query results behave like a list of DatabaseEntry objects
+    """
+    with Database(TABLE1, DB1_NAME, DB_PATH) as db:
+        table = db.get_table(DB1_NAME)
+        assert table.get_all_records() == []
+        table.add_data_multiple(arrange_data_for_insert(["a", "b", "c"]))
+        records = table.get_all_records()
+
+    assert isinstance(records, ResultSet)
+    assert len(records) == 3
+    assert isinstance(records[0], DatabaseEntry)
+    assert records[-1]["state"] == "c"
+    assert [x["state"] for x in records[1:]] == ["b", "c"]
+    assert records.column("timestamp") == [0, 1, 2]
+
+    entry = records[1]
+    assert entry.get("state") == "b"
+    assert entry["missing"] is None
+    assert entry.get("missing", "default") == "default"
+    assert entry.values == {"timestamp": 1, "state": "b", "notified": 0}
+    assert "\"state\": \"b\"" in repr(entry)
+    # rows share one column map
+    assert entry.index is records[0].index is table.column_index
+    assert not hasattr(entry, "__dict__")
+
+    # results compare equal to lists of entries, including entries from another query
+    assert records == list(records)
+    assert list(records) == records
+    with Database(TABLE1, DB1_NAME, DB_PATH) as db:
+        again = db.get_table(DB1_NAME).get_all_records()
+    assert records == list(again)
+    assert records[1] == again[1]
+    assert records[1] != again[2]
+    assert records != list(again)[:2]
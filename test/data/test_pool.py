@@ -0,0 +1,246 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import pytest
+
+from library.data import Column
+from library.data.local_database import Database, Table, connect_to_database
+from library.data.pool import ConnectionPool, PoolExhausted, close_pools, get_pool
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, *args):
+        if self.connection.broken:
+            raise FakeError("connection reset")
+        self.connection.executed.append(query)
+        return self
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Stands in for a pyodbc connection
+    """
+
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+        self.rollbacks = 0
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.broken:
+            raise FakeError("connection reset")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDriver:
+    """
+    Counts connects and fails the first few
+    """
+
+    def __init__(self, failures: int = 0, error=FakeError):
+        self.failures = failures
+        self.error = error
+        self.connections = []
+
+    def connect(self):
+        if self.failures:
+            self.failures -= 1
+            raise self.error("login timeout")
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+
+def test_reuse():
+    driver = FakeDriver()
+    pool = ConnectionPool(driver.connect, max_size=2)
+    first = pool.acquire()
+    pool.release(first)
+    assert first.rollbacks == 1
+    assert pool.acquire() is first
+    second = pool.acquire()
+    assert second is not first
+    assert pool.metrics() == {"in_use": 2, "idle": 0, "created": 2, "reused": 1, "discarded": 0, "retried": 0}
+
+    pool.release(second, discard=True)
+    assert second.closed
+    assert pool.size == 1
+    pool.release(first)
+    pool.close()
+    assert first.closed
+    with pytest.raises(Exception):
+        pool.acquire()
+
+
+def test_max_size():
+    driver = FakeDriver()
+    pool = ConnectionPool(driver.connect, max_size=1, timeout=0.05)
+    connection = pool.acquire()
+    start = time.monotonic()
+    with pytest.raises(PoolExhausted):
+        pool.acquire()
+    assert time.monotonic() - start >= 0.05
+
+    # a waiting thread gets the connection as soon as it's released
+    threading.Timer(0.05, pool.release, [connection]).start()
+    assert pool.acquire(timeout=2.0) is connection
+    assert len(driver.connections) == 1
+
+
+def test_health_check():
+    driver = FakeDriver()
+    pool = ConnectionPool(driver.connect, check_after=0.0, transient_errors=(FakeError,))
+    connection = pool.acquire()
+    pool.release(connection)
+    assert pool.acquire() is connection
+    assert connection.executed == ["SELECT 1"]
+    pool.release(connection)
+
+    # dropped while idle - replaced by a new connection
+    connection.broken = True
+    replacement = pool.acquire()
+    assert replacement is not connection
+    assert connection.closed
+    assert pool.metrics()["discarded"] == 1
+
+    # broken while in use - the rollback on release fails so it's discarded
+    replacement.broken = True
+    pool.release(replacement)
+    assert replacement.closed
+    assert pool.size == 0
+
+
+def test_idle_eviction():
+    driver = FakeDriver()
+    pool = ConnectionPool(driver.connect, max_idle=0.05)
+    connections = [pool.acquire(), pool.acquire()]
+    for connection in connections:
+        pool.release(connection)
+    assert pool.evict_idle() == 0
+    time.sleep(0.06)
+    assert pool.evict_idle() == 2
+    assert all(x.closed for x in connections)
+    assert pool.acquire() is driver.connections[-1]
+    assert len(driver.connections) == 3
+
+
+def test_retry():
+    driver = FakeDriver(failures=2)
+    pool = ConnectionPool(driver.connect, transient_errors=(FakeError,), retries=3, retry_delay=0.01)
+    assert pool.acquire() is driver.connections[0]
+    assert pool.metrics()["retried"] == 2
+
+    # out of retries
+    driver.failures = 5
+    with pytest.raises(FakeError):
+        pool.acquire()
+    assert pool.size == 1
+
+    # not transient - no retries
+    driver = FakeDriver(failures=1, error=ValueError)
+    pool = ConnectionPool(driver.connect, transient_errors=(FakeError,), retry_delay=0.01)
+    with pytest.raises(ValueError):
+        pool.acquire()
+    assert pool.metrics()["retried"] == 0
+
+
+def test_shared_pools():
+    driver = FakeDriver()
+    pool = get_pool(("server", "db", "user"), driver.connect)
+    assert get_pool(("server", "db", "user"), driver.connect, max_size=10) is pool
+    assert pool.max_size == 4
+    assert get_pool(("server", "db", "other"), driver.connect) is not pool
+    close_pools()
+    assert pool.closed
+    assert get_pool(("server", "db", "user"), driver.connect) is not pool
+    close_pools()
+
+
+class CountingTable(Table):
+    """
+    Table which counts how often it's checked
+    """
+    checks = 0
+
+    def does_table_exist(self, table_name):
+        CountingTable.checks += 1
+        return super().does_table_exist(table_name)
+
+
+class PooledDatabase(Database):
+    """
+    sqlite database which gets its connections from a pool, like the central database
+    """
+    TABLE_CLASS = CountingTable
+    REUSE_TABLES = True
+
+    def __init__(self, tables, name, path, pool):
+        super().__init__(tables, name, path)
+        self.pool = pool
+
+    def connect(self):
+        self.connection = self.pool.acquire()
+        self.create_tables()
+
+    def release_connection(self, failed: bool):
+        self.pool.release(self.connection, discard=failed)
+
+
+def test_database():
+    """
+    Test that databases hand their connections back to the pool, and drop failed ones
+    """
+    path = os.path.join(tempfile.mkdtemp(), "pool.sqlite3")
+    pool = ConnectionPool(
+        lambda: connect_to_database(path), max_size=2, transient_errors=Database.CONNECTION_ERRORS
+    )
+    tables = {"pool": [Column("timestamp", "integer", "PRIMARY KEY"), Column("value", "real", "NOT NULL")]}
+    first = PooledDatabase(tables, "pool", path, pool)
+    second = PooledDatabase(tables, "pool", path, pool)
+
+    CountingTable.checks = 0
+    for i in range(3):
+        for db in [first, second]:
+            with db:
+                db.get_table("pool").add_data([len(db.get_table("pool").get_all_records()), float(i)])
+    assert pool.metrics()["created"] == 1
+    assert pool.metrics()["reused"] == 5
+    # tables are checked once per database, not on every acquire
+    assert CountingTable.checks == 2
+
+    with pytest.raises(sqlite3.OperationalError):
+        with first:
+            first.connection.execute("SELECT * FROM missing")
+    assert pool.metrics()["discarded"] == 1
+    assert pool.size == 0
+
+    with second:
+        assert len(second.get_table("pool").get_all_records()) == 6
+    # a failed connection's tables are checked again
+    with first:
+        assert len(first.get_table("pool").get_all_records()) == 6
+    assert CountingTable.checks == 3
+    pool.close()
+    os.remove(path)
@@ -0,0 +1,183 @@
+import datetime
+import os
+import tempfile
+
+import pytest
+
+from library.data import Column
+from library.data.local_database import Database
+from library.data.retention import RetentionPolicy, Rollup, from_seconds, to_seconds
+
+TABLE_NAME = "pytest_environment"
+COLUMNS = [
+    Column("timestamp", "datetime", "PRIMARY KEY"),
+    Column("id", "varchar(50)", "NOT NULL"),
+    Column("temperature", "real", "NOT NULL"),
+    Column("humidity", "real", "NOT NULL"),
+]
+# 12:00:00 local time - readings cover the three hours before
+NOW = datetime.datetime(2024, 1, 1, 12).timestamp()
+START = NOW - 3 * 3600
+
+
+@pytest.fixture
+def db():
+    """
+    Kept-open database with 3 hours of readings from two sensors, one every 10s
+    """
+    path = os.path.join(tempfile.mkdtemp(), "retention.sqlite3")
+    policy = environment_policy()
+    tables = {TABLE_NAME: COLUMNS}
+    tables.update(policy.get_rollup_tables(COLUMNS))
+    database = Database(tables, TABLE_NAME, path)
+    database.keep_open = True
+    with database:
+        rows = []
+        for i in range(3 * 360):
+            for sensor, offset in [("a", 0.0), ("b", 100.0)]:
+                seconds = START + i * 10 + (0.001 if sensor == "b" else 0)
+                rows.append([from_seconds(seconds, ""), sensor, offset + i, offset - i])
+        database.get_table(TABLE_NAME).add_data_multiple(rows)
+    yield database
+    database.cleanup()
+    os.remove(path)
+
+
+def environment_policy(**kwargs) -> RetentionPolicy:
+    """
+    Policy keeping 1 hour of readings with 1m & 1h rollups - the fixture's readings
+    are all in already, so there's no grace period
+    """
+    options = dict(
+        max_age=3600,
+        batch_size=100,
+        rollups=[Rollup(60), Rollup(3600)],
+        group_by=["id"],
+        values=["temperature", "humidity"],
+        grace=0.0,
+    )
+    options.update(kwargs)
+    return RetentionPolicy(TABLE_NAME, **options)
+
+
+def test_conversions():
+    """
+    Test converting timestamps to & from seconds keeps their type and value
+    """
+    assert from_seconds(NOW, 0) == int(NOW)
+    assert from_seconds(NOW, "") == "2024-01-01 12:00:00.000"
+    assert from_seconds(NOW, datetime.datetime.now()) == datetime.datetime(2024, 1, 1, 12)
+    for like in [0, "", datetime.datetime.now()]:
+        assert to_seconds(from_seconds(NOW, like)) == NOW
+    assert Rollup(60).label == "1m"
+    assert Rollup(3600).label == "1h"
+    assert Rollup(90).label == "90s"
+
+
+def test_rollups(db):
+    """
+    Test that complete buckets are summarized per sensor and only rolled up once
+    """
+    policy = environment_policy(max_age=None)
+    summary = policy.apply(db, NOW)
+    # 1m rollups catch up an hour at a time
+    assert summary == {"rolled_up": 2 * 60 + 2 * 1, "deleted": 0}
+    while policy.apply(db, NOW)["rolled_up"]:
+        pass
+
+    with db:
+        minutes = db.get_table(f"{TABLE_NAME}_1m").get_all_records()
+        hours = db.get_table(f"{TABLE_NAME}_1h").get_all_records()
+    assert len(minutes) == 2 * 3 * 60
+    assert len(hours) == 2 * 3
+
+    first = [x for x in minutes if x["id"] == "b"][0]
+    assert first["timestamp"] == from_seconds(START, "")
+    assert first["samples"] == 6
+    assert (first["temperature_min"], first["temperature_max"], first["temperature_avg"]) == (100.0, 105.0, 102.5)
+    assert (first["humidity_min"], first["humidity_max"], first["humidity_avg"]) == (95.0, 100.0, 97.5)
+
+    last_hour = [x for x in hours if x["id"] == "a"][-1]
+    assert last_hour["timestamp"] == from_seconds(NOW - 3600, "")
+    assert last_hour["samples"] == 360
+    assert last_hour["temperature_avg"] == (720 + 1079) / 2
+
+    # nothing new - nothing written
+    assert policy.apply(db, NOW)["rolled_up"] == 0
+
+
+def test_delete(db):
+    """
+    Test that old rows are deleted in batches, and not before they're rolled up
+    """
+    policy = environment_policy()
+    policy.MAX_BATCHES = 3
+
+    # The first run only rolls up the first hour, so only that can be deleted - 3 batches of 100
+    summary = policy.apply(db, NOW)
+    assert summary["deleted"] == 300
+    with db:
+        oldest, _ = db.get_table(TABLE_NAME).get_column_bounds("timestamp")
+    assert to_seconds(oldest) > START
+
+    while policy.apply(db, NOW)["deleted"]:
+        pass
+    with db:
+        table = db.get_table(TABLE_NAME)
+        oldest, newest = table.get_column_bounds("timestamp")
+        assert to_seconds(oldest) >= NOW - 3600
+        assert len(table.get_all_records()) == 2 * 360
+        # rollups are untouched
+        assert len(db.get_table(f"{TABLE_NAME}_1m").get_all_records()) == 2 * 3 * 60
+
+
+def test_rollup_max_age(db):
+    """
+    Test that rollups have their own retention
+    """
+    policy = environment_policy(max_age=None, rollups=[Rollup(60, max_age=1800)])
+    while policy.apply(db, NOW)["rolled_up"]:
+        pass
+    with db:
+        minutes = db.get_table(f"{TABLE_NAME}_1m").get_all_records()
+    assert len(minutes) == 2 * 30
+    assert min(to_seconds(x["timestamp"]) for x in minutes) == NOW - 1800
+
+
+def test_late_rows(db):
+    """
+    Test that rows written late still make it into their bucket's rollup within the grace period
+    """
+    policy = environment_policy(max_age=None, rollups=[Rollup(60)], grace=120.0)
+    while policy.apply(db, NOW)["rolled_up"]:
+        pass
+    with db:
+        minutes = db.get_table(f"{TABLE_NAME}_1m").get_all_records()
+    # the last two minutes are still open
+    assert max(to_seconds(x["timestamp"]) for x in minutes) == NOW - 180
+
+    # a reading from a minute ago arrives late, e.g. from an ingest buffer or outbox
+    with db:
+        db.get_table(TABLE_NAME).add_data([from_seconds(NOW - 55, ""), "a", 5000.0, 0.0])
+    assert policy.apply(db, NOW + 120)["rolled_up"] == 2 * 2
+    with db:
+        minutes = db.get_table(f"{TABLE_NAME}_1m").get_all_records()
+    late = [x for x in minutes if x["id"] == "a" and x["timestamp"] == from_seconds(NOW - 60, "")][0]
+    assert late["samples"] == 7
+    assert late["temperature_max"] == 5000.0
+
+
+def test_epoch_timestamps():
+    """
+    Test retention on a table keyed by integer epoch seconds, like the GPIO monitor's
+    """
+    path = os.path.join(tempfile.mkdtemp(), "retention.sqlite3")
+    columns = [Column("timestamp", "integer", "PRIMARY KEY"), Column("state", "text", "NOT NULL")]
+    with Database({"pytest_door": columns}, "pytest_door", path) as db:
+        table = db.get_table("pytest_door")
+        table.add_data_multiple([[int(NOW) - i * 60, "Open"] for i in range(100)])
+
+        policy = RetentionPolicy("pytest_door", max_age=30 * 60, batch_size=25)
+        assert policy.apply(db, NOW) == {"rolled_up": 0, "deleted": 69}
+        assert [x["timestamp"] for x in table.get_all_records()][0] == int(NOW) - 30 * 60
+    os.remove(path)
@@ -0,0 +1,163 @@
+import os
+import tempfile
+
+import pytest
+
+from library.data import Column, ResultSet
+from library.data.ringbuffer_database import Database, HEADER_SIZE, get_record_struct
+
+TABLE_NAME = "PITEST_RING"
+COLUMNS = [
+    Column("timestamp", "integer", "PRIMARY KEY"),
+    Column("state", "text", "NOT NULL"),
+    Column("convo_id", "varchar(8)", "NOT NULL", index=True),
+    Column("captured", "integer", "NOT NULL"),
+    Column("temperature", "real", ""),
+]
+TABLES = {TABLE_NAME: COLUMNS}
+
+
+def rows(start: int, stop: int) -> list:
+    return [(i, "Open" if i % 2 else "Closed", f"id{i}", 0, i / 2) for i in range(start, stop)]
+
+
+@pytest.fixture
+def path():
+    return os.path.join(tempfile.mkdtemp(), "pitest.ring")
+
+
+def test_layout(path):
+    record = get_record_struct(COLUMNS)
+    # null mask, 3 integers & reals, default-width text and varchar(8)
+    assert record.size == 8 + 8 * 3 + 64 + 8
+    with Database(TABLES, "pitest", path, capacity=5):
+        pass
+    assert os.path.getsize(os.path.join(path, f"{TABLE_NAME}.ring")) == HEADER_SIZE + 5 * record.size
+
+
+def test_append_and_latest(path):
+    with Database(TABLES, "pitest", path, capacity=5) as db:
+        table = db.get_table(TABLE_NAME)
+        assert table.get_latest_record() is None
+        assert table.get_all_records() == []
+
+        table.add_data(rows(0, 1)[0])
+        table.add_data_multiple(rows(1, 4))
+        assert len(table) == 4
+        assert table.get_latest_record().values == {
+            "timestamp": 3, "state": "Open", "convo_id": "id3", "captured": 0, "temperature": 1.5
+        }
+        assert isinstance(table.get_all_records(), ResultSet)
+        assert [x["timestamp"] for x in table.get_all_records()] == [0, 1, 2, 3]
+        assert [x["timestamp"] for x in table.get_last_n_records(2)] == [3, 2]
+        assert [x["timestamp"] for x in table.get_last_n_records(10)] == [3, 2, 1, 0]
+
+        with pytest.raises(Exception):
+            table.add_data([1, 2])
+
+
+def test_wrap_around(path):
+    with Database(TABLES, "pitest", path, capacity=5) as db:
+        table = db.get_table(TABLE_NAME)
+        table.add_data_multiple(rows(0, 13))
+        assert len(table) == 5
+        assert [x["timestamp"] for x in table.get_all_records()] == [8, 9, 10, 11, 12]
+        assert table.get_latest_record()["timestamp"] == 12
+        assert [x["timestamp"] for x in table.get_last_n_records(3)] == [12, 11, 10]
+
+
+def test_delete_except_last_n(path):
+    with Database(TABLES, "pitest", path, capacity=10) as db:
+        table = db.get_table(TABLE_NAME)
+        table.add_data_multiple(rows(0, 6))
+        table.delete_all_except_last_n_records(2)
+        assert [x["timestamp"] for x in table.get_all_records()] == [4, 5]
+        table.delete_all_except_last_n_records(5)
+        assert len(table) == 2
+        table.add_data_multiple(rows(6, 8))
+        assert [x["timestamp"] for x in table.get_all_records()] == [4, 5, 6, 7]
+
+
+def test_lookups_and_updates(path):
+    with Database(TABLES, "pitest", path, capacity=10) as db:
+        table = db.get_table(TABLE_NAME)
+        table.add_data_multiple(rows(0, 6))
+
+        assert table.get_record(3)["convo_id"] == "id3"
+        assert table.get_record(30) is None
+        assert [x["timestamp"] for x in table.get_records_where("state", "Open")] == [5, 3, 1]
+        assert [x["timestamp"] for x in table.get_records_where("state", "Open", limit=1)] == [5]
+
+        table.update_record(3, "captured", 1)
+        assert table.get_record(3)["captured"] == 1
+        assert table.get_latest_record()["captured"] == 0
+        with pytest.raises(Exception):
+            table.update_record(3, "missing", 1)
+
+
+def test_nulls_and_text(path):
+    with Database(TABLES, "pitest", path, capacity=10) as db:
+        table = db.get_table(TABLE_NAME)
+        table.add_data([1, "Öffnen", "far too long", 0, None])
+        record = table.get_latest_record()
+        assert record["state"] == "Öffnen"
+        # varchar(8) is truncated to 8 bytes
+        assert record["convo_id"] == "far too "
+        assert record["temperature"] is None
+
+
+def test_reopen_and_resize(path):
+    with Database(TABLES, "pitest", path, capacity=5) as db:
+        db.get_table(TABLE_NAME).add_data_multiple(rows(0, 7))
+
+    with Database(TABLES, "pitest", path, capacity=5) as db:
+        assert [x["timestamp"] for x in db.get_table(TABLE_NAME).get_all_records()] == [2, 3, 4, 5, 6]
+
+    # the newest records that fit are kept
+    with Database(TABLES, "pitest", path, capacity=3) as db:
+        table = db.get_table(TABLE_NAME)
+        assert [x["timestamp"] for x in table.get_all_records()] == [4, 5, 6]
+        table.add_data(rows(7, 8)[0])
+        assert [x["timestamp"] for x in table.get_all_records()] == [5, 6, 7]
+
+    # other columns start over
+    with Database({TABLE_NAME: COLUMNS[:3]}, "pitest", path, capacity=3) as db:
+        assert db.get_table(TABLE_NAME).get_all_records() == []
+
+
+def test_shared_file(path):
+    """
+    Two databases on one directory - e.g. two controllers - see each other's changes
+    """
+    writer = Database(TABLES, "pitest", path, capacity=5)
+    reader = Database(TABLES, "pitest", path, capacity=5)
+    writer.keep_open = reader.keep_open = True
+    with writer, reader:
+        writer.get_table(TABLE_NAME).add_data_multiple(rows(0, 3))
+        assert reader.get_table(TABLE_NAME).get_latest_record()["timestamp"] == 2
+        reader.get_table(TABLE_NAME).update_record(2, "captured", 1)
+        assert writer.get_table(TABLE_NAME).get_record(2)["captured"] == 1
+    writer.cleanup()
+    reader.cleanup()
+
+
+def test_time_range(path):
+    with Database(TABLES, "pitest", path, capacity=100) as db:
+        table = db.get_table(TABLE_NAME)
+        assert table.get_column_bounds("timestamp") == (None, None)
+        table.add_data_multiple(rows(0, 20))
+
+        assert table.get_column_bounds("timestamp") == (0, 19)
+        assert table.get_column_bounds("timestamp", 15) == (15, 19)
+        assert [x["timestamp"] for x in table.get_records_between("timestamp", 3, 6)] == [3, 4, 5]
+        assert [x["timestamp"] for x in table.query_range(10, 13)] == [10, 11, 12]
+        entries = list(table.query_range(ids=["id1", "id2"], id_column="convo_id", columns=["timestamp"]))
+        assert [x.entry for x in entries] == [(1,), (2,)]
+
+        assert table.delete_records_before("timestamp", 10, 4) == 4
+        assert table.delete_records_before("timestamp", 10, 100) == 6
+        assert table.delete_records_before("timestamp", 10, 100) == 0
+        assert table.get_column_bounds("timestamp") == (10, 19)
+
+        table.drop()
+    assert not os.path.exists(os.path.join(path, f"{TABLE_NAME}.ring"))
@@ -0,0 +1,116 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from library.data import Column, DBType
+from library.data.timestamp import SQL_SERVER_DATETIME_TICKS, TimestampGenerator, get_resolution
+
+
+def to_sql_server_datetime(timestamp: str) -> datetime.datetime:
+    """
+    Store a timestamp the way a SQL Server datetime column does - rounded to 1/300 s
+    """
+    parsed = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+    ticks = round(parsed.microsecond * SQL_SERVER_DATETIME_TICKS / 10 ** 6)
+    return parsed.replace(microsecond=0) + datetime.timedelta(seconds=ticks / SQL_SERVER_DATETIME_TICKS)
+
+
+def generate_burst(generator: TimestampGenerator, rate: int, count: int) -> list:
+    """
+    Generate timestamps paced at rate per second
+    """
+    timestamps = []
+    start = time.monotonic()
+    for i in range(count):
+        ahead = start + i / rate - time.monotonic()
+        if ahead > 0.001:
+            time.sleep(ahead)
+        timestamps.append(generator.next())
+    return timestamps
+
+
+@pytest.mark.parametrize("precision", [0, 3, 6])
+def test_format(precision):
+    """
+    Test that timestamps match the old strftime based format
+    """
+    generator = TimestampGenerator(precision)
+    before = datetime.datetime.now().replace(microsecond=0)
+    timestamp = generator.next()
+    fmt = "%Y-%m-%d %H:%M:%S.%f" if precision else "%Y-%m-%d %H:%M:%S"
+    parsed = datetime.datetime.strptime(timestamp, fmt)
+    assert before <= parsed <= datetime.datetime.now() + datetime.timedelta(seconds=1)
+    if precision:
+        assert len(timestamp.split(".")[1]) == precision
+
+
+def test_unique():
+    """
+    Test that timestamps from many threads are unique and increasing
+    """
+    generator = TimestampGenerator(3)
+    results = [[] for _ in range(4)]
+
+    def generate(result):
+        for _ in range(5000):
+            result.append(generator.next())
+
+    threads = [threading.Thread(target=generate, args=(result,)) for result in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    timestamps = [x for result in results for x in result]
+    assert len(set(timestamps)) == len(timestamps)
+    for result in results:
+        assert result == sorted(result)
+
+    # 20k timestamps in well under 20 seconds - the generator ran ahead of the clock
+    assert generator.skew > 0
+
+
+@pytest.mark.parametrize("col_type,db_type,expected", [
+    ("datetime", DBType.CENTRAL, (3, 300)),
+    ("DATETIME2(6)", DBType.CENTRAL, (6, 10 ** 6)),
+    ("datetime2(3)", DBType.CENTRAL, (3, 1000)),
+    ("datetime2", DBType.CENTRAL, (6, 10 ** 6)),
+    ("datetime", DBType.LOCAL, (6, 10 ** 6)),
+    ("datetime", DBType.RINGBUFFER, (6, 10 ** 6)),
+])
+def test_resolution(col_type, db_type, expected):
+    """
+    Test that the resolution matches what the column can store
+    """
+    assert get_resolution(Column("timestamp", col_type, "PRIMARY KEY"), db_type) == expected
+
+
+def test_burst():
+    """
+    Stress test - 10k timestamps/second stay unique & close to the clock at microsecond resolution
+    """
+    generator = TimestampGenerator(6)
+    timestamps = generate_burst(generator, 10000, 10000)
+    assert len(set(timestamps)) == len(timestamps)
+    assert generator.skew < 0.01
+
+
+def test_burst_sql_server_datetime():
+    """
+    Stress test - 10k timestamps/second at SQL Server datetime resolution must
+    still be unique once the column rounds them to 1/300 s
+    """
+    precision, ticks_per_second = get_resolution(Column("timestamp", "datetime", "PRIMARY KEY"), DBType.CENTRAL)
+    generator = TimestampGenerator(precision, ticks_per_second)
+    timestamps = generate_burst(generator, 10000, 10000)
+    stored = [to_sql_server_datetime(x) for x in timestamps]
+    assert len(set(stored)) == len(stored)
+    assert stored == sorted(stored)
+    # printed values are the ones SQL Server stores
+    assert {x.split(".")[1][-1] for x in timestamps} <= {"0", "3", "7"}
+
+    # 1 ms ticks collide once rounded
+    stored = [to_sql_server_datetime(x) for x in generate_burst(TimestampGenerator(3), 10000, 1000)]
+    assert len(set(stored)) < len(stored)
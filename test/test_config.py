@@ -4,7 +4,7 @@ from inspect import ismethod
 
 import pytest
 
-from library import TEST_CONFIG_DIR
+from library import CONFIG_DIR, TEST_CONFIG_DIR
 from library.config import ConfigurationHandler, SENSORCLASSES, BaseConfiguration
 from library.config.camera import CameraConfig
 from library.config.environment import EnvironmentConfig
@@ -103,6 +103,24 @@ class TestConfigurationHandler:
         assert ismethod(controller.cleanup)
 
 
+@pytest.mark.parametrize("config_path", [
+    os.path.join(CONFIG_DIR, "pigarage", "garage_door_camera.json"),
+    os.path.join(CONFIG_DIR, "pigarage", "garage_door_pushbullet.json"),
+    os.path.join(CONFIG_DIR, "pigarage", "garage_door_monitor.json"),
+    os.path.join(CONFIG_DIR, "pitest", "pitest_camera.json"),
+    os.path.join(CONFIG_DIR, "pitest", "pitest_pushbullet.json"),
+    os.path.join(CONFIG_DIR, "pitest", "pitest_gpio_monitor.json"),
+])
+def test_retention_configured(config_path):
+    """
+    Test that the shared door tables have a retention policy whichever controllers run -
+    nothing else keeps them from growing
+    """
+    config = BaseConfiguration(config_path)
+    assert config.db_tables
+    assert set(config.db_retention) == set(config.db_tables)
+
+
 class TestMQTT:
     mqtt_path = "pytest_mqtt.json"
     sensor_path = "pytest_environment.json"
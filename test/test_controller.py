@@ -1,16 +1,20 @@
 import json
 import logging
 import os
+import threading
 import time
 import timeit
 from typing import List
 
 import pytest
+from paho.mqtt.client import MQTTMessage
 
-from library import GarageDoorStates, GPIODriverCommands
+from library import GarageDoorStates, GPIODriverCommands, OverflowPolicies
 from library.communication.mqtt import MQTTClient
 from library.config import ConfigurationHandler, SENSORCLASSES, PubSubKeys, DatabaseKeys
+from library.config.gpio_driver import ConfigKeys as GPIODriverConfigKeys
 from library.config.mqtt import MQTTConfig
+from library.executor import BoundedExecutor
 from util import fix_mqtt_topic_subscribe_name
 
 try:
@@ -116,6 +120,8 @@ def setup_module():
             with sensor.db as db:
                 for table in reversed(list(db.tables.values())):
                     table.drop()
+            # Controllers keep their connection open - reconnect to recreate the tables
+            sensor.db.cleanup()
 
 
 def teardown_module():
@@ -186,6 +192,29 @@ def wait_n_seconds(n):
         now = timeit.default_timer()
 
 
+def test_mqtt_controllers_idle_cpu():
+    """
+    Test that MQTT-only controllers block instead of spinning while waiting for messages
+    """
+    sensors = [SENSORCLASSES.CAMERA, SENSORCLASSES.GPIO_DRIVER, SENSORCLASSES.MQTT_ENVIRONMENT]
+    controllers = [CONFIGURATION_HANDLER.get_sensor_controller(sensor) for sensor in sensors]
+    try:
+        for controller in controllers:
+            controller.start()
+
+        cpu_start = time.process_time()
+        time.sleep(1.0)
+        cpu_used = time.process_time() - cpu_start
+        assert cpu_used < 0.1, f"Idle MQTT controllers used {cpu_used:0.3f}s of CPU in 1s"
+    finally:
+        for controller in controllers:
+            controller.cleanup()
+
+    for controller in controllers:
+        controller.thread.join(MAX_WAIT_SECONDS)
+        assert not controller.thread.is_alive(), f"{controller} thread didn't stop!"
+
+
 class TestEnvironmentController:
 
     def test_thread(self, monkeypatch):
@@ -214,7 +243,7 @@ class TestEnvironmentController:
 
         i = 0
         delay_time = 0.001
-        while controller.thread.is_alive() or controller.sensor.humidity == -999.0:
+        while controller.alive or controller.sensor.humidity == -999.0:
             time.sleep(delay_time)
             i += 1
             if i > MAX_ENV_WAIT_SECONDS * (1.0 / delay_time):
@@ -311,9 +340,188 @@ class TestMqttEnvironmentController:
             entry = db.get_table(controller.db_table_name).get_latest_record()
             assert entry, "expected entry in database"
 
+    def test_ingest(self):
+        """
+        Test that readings are buffered, written in batches, and flushed on cleanup
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.MQTT_ENVIRONMENT)
+        """ @type: library.controllers.mqtt_environment.MqttEnvironmentController """
+        # batches are kept through connection failures
+        assert controller.ingest.transient_errors == controller.db.CONNECTION_ERRORS
+
+        with controller.db as db:
+            db.get_table(controller.db_table_name).delete_all_except_last_n_records(0)
+
+        # a duplicate timestamp fails the batch - the rest are still written
+        rows = [
+            ["2000-01-01 00:00:00.000", "pytest_ingest", 70.0, 40.0],
+            ["2000-01-01 00:00:00.000", "pytest_ingest", 71.0, 41.0],
+            ["2000-01-01 00:00:00.001", "pytest_ingest", 72.0, 42.0],
+        ]
+        controller.write_readings(rows)
+        with controller.db as db:
+            records = db.get_table(controller.db_table_name).get_all_records()
+            assert len(records) == 2
+            assert db.get_table("test_mqtt_metadata").get_record("pytest_ingest")
+
+        for i in range(3):
+            controller.handle_message("hass/pytest/env/ingest", {"temperature": i, "humidity": i, "id": f"ingest{i}"})
+            time.sleep(0.002)
+        controller.cleanup()
+
+        with controller.db as db:
+            records = db.get_table(controller.db_table_name).get_all_records()
+            assert len(records) == 5
+        metrics = controller.health()["ingest"]
+        assert metrics["received"] == 3
+        assert metrics["flushed"] == 3
+        controller.cleanup()
+
+    def test_known_ids(self, monkeypatch):
+        """
+        Test that the meta table is only queried once per connection, not per reading
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.MQTT_ENVIRONMENT)
+        """ @type: library.controllers.mqtt_environment.MqttEnvironmentController """
+
+        with controller.db as db:
+            db.get_table(controller.db_table_name).delete_all_except_last_n_records(0)
+            meta_table = db.get_table("test_mqtt_metadata")
+
+        lookups = []
+        get_record = meta_table.get_record
+        get_all_records = meta_table.get_all_records
+        monkeypatch.setattr(meta_table, "get_record", lambda *args: lookups.append(args) or get_record(*args))
+        monkeypatch.setattr(meta_table, "get_all_records", lambda: lookups.append(()) or get_all_records())
+
+        controller.write_readings([["2000-01-01 00:00:01.000", "pytest_known0", 70.0, 40.0]])
+        assert lookups == [()]
+        assert "pytest_known0" in controller.known_ids
+        assert meta_table.get_record("pytest_known0")
+        lookups.clear()
+
+        controller.write_readings([
+            ["2000-01-01 00:00:01.001", "pytest_known0", 70.0, 40.0],
+            ["2000-01-01 00:00:01.002", "pytest_known1", 70.0, 40.0],
+        ])
+        assert lookups == []
+        assert {"pytest_known0", "pytest_known1"} <= controller.known_ids
+
+        # a new connection reloads the ids
+        controller.db.cleanup()
+        controller.write_readings([["2000-01-01 00:00:01.003", "pytest_known1", 70.0, 40.0]])
+        assert {"pytest_known0", "pytest_known1"} <= controller.known_ids
+        controller.cleanup()
+
+    def test_burst(self, monkeypatch):
+        """
+        Stress test - 10k messages/second from several sensors must all be stored
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.MQTT_ENVIRONMENT)
+        """ @type: library.controllers.mqtt_environment.MqttEnvironmentController """
+        # per-message logging can't keep up with this rate
+        monkeypatch.setattr(controller.logger, "disabled", True)
+
+        with controller.db as db:
+            db.get_table(controller.db_table_name).delete_all_except_last_n_records(0)
+
+        rate = 10000
+        count = rate
+        start = time.monotonic()
+        for i in range(count):
+            # pace the messages - sleep whenever we're ahead of schedule
+            ahead = start + i / rate - time.monotonic()
+            if ahead > 0.001:
+                time.sleep(ahead)
+            controller.handle_message("hass/pytest/env/burst", {"temperature": i, "humidity": i, "id": f"burst{i % 4}"})
+        elapsed = time.monotonic() - start
+        controller.cleanup()
+
+        metrics = controller.health()["ingest"]
+        logging.info(f"{count / elapsed:0.0f} messages/s, {controller.ingest.report()}")
+        assert count / elapsed >= rate * 0.9, "Couldn't inject messages fast enough"
+        assert metrics["dropped"] == 0
+        assert metrics["failed"] == 0
+        # microsecond timestamps keep up with the readings instead of running ahead of the clock
+        assert controller.timestamps.skew < 1.0
+        with controller.db as db:
+            records = db.get_table(controller.db_table_name).get_all_records()
+            assert len(records) == count
+            assert sorted(x["temperature"] for x in records) == list(range(count))
+        controller.cleanup()
+
 
 class TestCameraController:
 
+    def test_capture_queue(self, monkeypatch):
+        """
+        Test that queued captures for different requests are all kept and only repeats are coalesced
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.CAMERA)
+        """ @type: library.controllers.camera.PiCameraController"""
+        gate = threading.Event()
+        captured = []
+
+        def capture_loop(delay=0, convo_id="", force=False):
+            gate.wait(MAX_WAIT_SECONDS)
+            captured.append(convo_id)
+
+        def get_capture_kwargs(topic, message_data):
+            return {PubSubKeys.DELAY: 0, PubSubKeys.FORCE: True, PubSubKeys.ID: message_data[PubSubKeys.ID]}
+
+        executor = BoundedExecutor(controller.name, workers=1, max_queue=2, overflow=OverflowPolicies.COALESCE)
+        monkeypatch.setattr(controller, "capture_loop", capture_loop)
+        monkeypatch.setattr(controller, "get_capture_kwargs", get_capture_kwargs)
+        monkeypatch.setattr(controller, "_executor", executor)
+        try:
+            for convo_id in ["first", "second", "third", "third"]:
+                msg = MQTTMessage(topic=b"pytest/camera/capture")
+                msg.payload = json.dumps({PubSubKeys.ID: convo_id}).encode("utf-8")
+                controller.on_message(None, None, msg)
+                # wait for the worker to pick up the first capture so the rest queue behind it
+                start = time.time()
+                while not executor.metrics()["active"] and time.time() - start < MAX_WAIT_SECONDS:
+                    time.sleep(0.01)
+
+            gate.set()
+            assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+            assert captured == ["first", "second", "third"]
+            assert executor.metrics()["coalesced"] == 1
+        finally:
+            gate.set()
+            executor.shutdown()
+
+    def test_on_message_returns(self, monkeypatch):
+        """
+        Test that slow capture lookups run on the executor, not the shared MQTT network thread
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.CAMERA)
+        """ @type: library.controllers.camera.PiCameraController"""
+        gate = threading.Event()
+        threads = []
+
+        def get_capture_kwargs(topic, message_data):
+            threads.append(threading.current_thread())
+            gate.wait(MAX_WAIT_SECONDS)
+            return None
+
+        executor = BoundedExecutor(controller.name, workers=1, max_queue=2, overflow=OverflowPolicies.COALESCE)
+        monkeypatch.setattr(controller, "get_capture_kwargs", get_capture_kwargs)
+        monkeypatch.setattr(controller, "_executor", executor)
+        try:
+            msg = MQTTMessage(topic=b"pytest/camera/capture")
+            msg.payload = json.dumps({PubSubKeys.ID: "first"}).encode("utf-8")
+            start = time.time()
+            controller.on_message(None, None, msg)
+            assert time.time() - start < 1.0
+
+            gate.set()
+            assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+            assert threads and threads[0] is not threading.current_thread()
+        finally:
+            gate.set()
+            executor.shutdown()
+
     @pytest.mark.usefixtures("mock_should_capture_from_command")
     def test_thread(self):
         """
@@ -542,13 +750,15 @@ class TestGPIODriverController:
             controller.cleanup()
 
     @pytest.mark.usefixtures("mock_gpiodriver_toggle", "mock_gpiodriver_write_on", "mock_gpiodriver_write_off")
-    def test_mqtt(self):
+    def test_mqtt(self, monkeypatch):
         global GPIO_TOGGLE_RECEIVED
         global GPIO_ON_RECEIVED
         global GPIO_OFF_RECEIVED
 
         controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.GPIO_DRIVER)
         """ @type: library.controllers.gpio_driver.GPIODriverController """
+        # ON then OFF would be collapsed inside the debounce window
+        monkeypatch.setitem(controller.config.config, GPIODriverConfigKeys.DEBOUNCE, 0.0)
 
         topics = [x.name for x in controller.config.mqtt_topic]
         client = get_mqtt_client(controller.config.mqtt_config, topics)
@@ -582,6 +792,47 @@ class TestGPIODriverController:
             client.disconnect()
             controller.cleanup()
 
+    def test_command_queue(self, monkeypatch):
+        """
+        Test that commands run one at a time, in order, with repeats and
+        superseded ON/OFF commands collapsed inside the debounce window
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.GPIO_DRIVER)
+        """ @type: library.controllers.gpio_driver.GPIODriverController """
+        toggle_delay = 0.1
+        monkeypatch.setitem(controller.config.config, GPIODriverConfigKeys.TOGGLE_DELAY, toggle_delay)
+        monkeypatch.setitem(controller.config.config, GPIODriverConfigKeys.DEBOUNCE, 10.0)
+
+        timeline = []
+        monkeypatch.setattr(GPIO, "output", lambda pin, state: timeline.append((state, time.monotonic())))
+
+        try:
+            assert controller.queue_command(GPIODriverCommands.TOGGLE)
+            assert not controller.queue_command(GPIODriverCommands.TOGGLE)
+            assert not controller.queue_command(GPIODriverCommands.TOGGLE)
+            assert controller.queue_command(GPIODriverCommands.ON)
+            assert controller.queue_command(GPIODriverCommands.OFF)
+            assert controller.queue_command(GPIODriverCommands.ON)
+            assert controller.executor.wait_until_idle(MAX_WAIT_SECONDS)
+
+            # One toggle pulse, then the last of ON/OFF/ON
+            states = [x[0] for x in timeline]
+            assert states == [GPIO.LOW, GPIO.HIGH, GPIO.LOW, GPIO.HIGH]
+            assert timeline[1][1] - timeline[0][1] >= toggle_delay
+            assert timeline[2][1] - timeline[1][1] >= toggle_delay
+
+            # Outside the window every command runs
+            timeline.clear()
+            monkeypatch.setitem(controller.config.config, GPIODriverConfigKeys.TOGGLE_DELAY, 0.0)
+            monkeypatch.setitem(controller.config.config, GPIODriverConfigKeys.DEBOUNCE, 0.0)
+            for command in [GPIODriverCommands.TOGGLE, GPIODriverCommands.TOGGLE, GPIODriverCommands.OFF]:
+                assert controller.queue_command(command)
+            assert controller.executor.wait_until_idle(MAX_WAIT_SECONDS)
+            states = [x[0] for x in timeline]
+            assert states == [GPIO.LOW, GPIO.HIGH, GPIO.LOW] * 2 + [GPIO.LOW]
+        finally:
+            controller.cleanup()
+
 
 class TestGPIOMonitorController:
 
@@ -633,6 +884,73 @@ class TestGPIOMonitorController:
         finally:
             controller.cleanup()
 
+    def test_retention(self, monkeypatch):
+        """
+        Test that the table's retention policy is scheduled while running and deletes old entries
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.GPIO_MONITOR)
+        """ @type: library.controllers.gpio_monitor.GPIOMonitorController"""
+        monkeypatch.setattr(controller.sensor, "read", mock_gpio_read)
+
+        policy = controller.config.db_retention[controller.db_table_name]
+        now = int(time.time())
+        with controller.db as db:
+            table = db.get_table(controller.db_table_name)
+            table.delete_all_except_last_n_records(0)
+            table.add_data_multiple([
+                [now - policy.max_age - 60, GarageDoorStates.OPEN, "old", 0, 0],
+                [now - 60, GarageDoorStates.CLOSED, "new", 0, 0],
+            ])
+
+        controller.start()
+        try:
+            assert [job.name for job in controller.retention_jobs] == [
+                f"{controller.name} retention: {controller.db_table_name}"
+            ]
+            assert controller.apply_retention(policy) == {"rolled_up": 0, "deleted": 1}
+            assert controller.get_entry_for_id("old") is None
+            assert controller.get_entry_for_id("new")
+
+            # the camera shares the table - it's only cleaned up once
+            camera = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.CAMERA)
+            camera.start_retention()
+            assert not camera.retention_jobs
+        finally:
+            controller.cleanup()
+        assert not controller.retention_jobs
+
+        # ...until the monitor stops
+        camera.start_retention()
+        try:
+            assert [job.name for job in camera.retention_jobs] == [f"{camera.name} retention: {camera.db_table_name}"]
+        finally:
+            camera.stop()
+        assert not camera.retention_jobs
+
+    def test_ringbuffer(self, monkeypatch, tmp_path):
+        """
+        Test that the monitor works on a ring buffer database
+        """
+        controller = CONFIGURATION_HANDLER.get_sensor_controller(SENSORCLASSES.GPIO_MONITOR)
+        """ @type: library.controllers.gpio_monitor.GPIOMonitorController"""
+        monkeypatch.setattr(controller.sensor, "read", mock_gpio_read)
+        db_config = dict(controller.config.config["db"], type="ringbuffer", path=str(tmp_path), capacity=3)
+        monkeypatch.setitem(controller.config.config, "db", db_config)
+        # controllers are shared between tests - make this one open a new database
+        monkeypatch.setattr(controller, "_db", None)
+
+        try:
+            from library.data.ringbuffer_database import Database
+            assert isinstance(controller.db, Database)
+            for _ in range(5):
+                convo_id = controller.add_entry_to_database()
+            assert controller.get_latest_db_entry(DatabaseKeys.ID) == convo_id
+            assert controller.get_entry_for_id(convo_id)
+            with controller.db as db:
+                assert len(db.get_table(controller.db_table_name).get_all_records()) == 3
+        finally:
+            controller.cleanup()
+
     def test_publish(self, monkeypatch):
         """
         Test that publish method works
@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+from library import OverflowPolicies
+from library.executor import BoundedExecutor
+
+MAX_WAIT_SECONDS = 5.0
+
+
+@pytest.fixture
+def gate():
+    """
+    Event which blocks the first job so later ones pile up in the queue
+    """
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def make_executor(overflow, gate, max_queue=2):
+    """
+    Get a single worker executor whose worker is stuck on a blocking job
+    """
+    executor = BoundedExecutor("pytest", workers=1, max_queue=max_queue, overflow=overflow)
+    started = threading.Event()
+
+    def block():
+        started.set()
+        gate.wait(MAX_WAIT_SECONDS)
+
+    executor.submit(block)
+    assert started.wait(MAX_WAIT_SECONDS)
+    return executor
+
+
+def test_drop_oldest(gate):
+    """
+    Test that a full queue drops its oldest job to make room
+    """
+    executor = make_executor(OverflowPolicies.DROP_OLDEST, gate)
+    ran = []
+    for i in range(4):
+        assert executor.submit(ran.append, i, key=i)
+    assert executor.queue_length == 2
+
+    gate.set()
+    assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+    assert ran == [2, 3]
+
+    metrics = executor.metrics()
+    assert metrics["dropped"] == 2
+    assert metrics["completed"] == 3
+    assert metrics["queue_length"] == 0
+    executor.shutdown()
+
+
+def test_coalesce(gate):
+    """
+    Test that a full queue replaces a queued job with the same key in place
+    and rejects jobs without a match
+    """
+    executor = make_executor(OverflowPolicies.COALESCE, gate)
+    ran = []
+    assert executor.submit(ran.append, "a1", key="a")
+    assert executor.submit(ran.append, "b1", key="b")
+    assert not executor.submit(ran.append, "a2", key="a")
+    assert not executor.submit(ran.append, "c1", key="c")
+
+    gate.set()
+    assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+    assert ran == ["a2", "b1"]
+
+    metrics = executor.metrics()
+    assert metrics["coalesced"] == 1
+    assert metrics["rejected"] == 1
+    executor.shutdown()
+
+
+def test_reject(gate):
+    """
+    Test that a full queue rejects new jobs
+    """
+    executor = make_executor(OverflowPolicies.REJECT, gate)
+    ran = []
+    results = [executor.submit(ran.append, i, key=i) for i in range(4)]
+    assert results == [True, True, False, False]
+
+    gate.set()
+    assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+    assert ran == [0, 1]
+    assert executor.metrics()["rejected"] == 2
+    executor.shutdown()
+
+
+def test_metrics_and_exceptions():
+    """
+    Test that failing jobs don't kill the worker and latency is recorded
+    """
+    executor = BoundedExecutor("pytest", workers=2, max_queue=4)
+
+    def fail():
+        raise ValueError("pytest")
+
+    ran = []
+    executor.submit(fail)
+    executor.submit(ran.append, 1)
+    assert executor.wait_until_idle(MAX_WAIT_SECONDS)
+    assert ran == [1]
+
+    metrics = executor.metrics()
+    assert metrics["failed"] == 1
+    assert metrics["completed"] == 2
+    assert metrics["mean_run_time"] >= 0.0
+    assert metrics["max_run_time"] >= metrics["mean_run_time"]
+
+    executor.shutdown()
+    assert not any(thread.is_alive() for thread in threading.enumerate() if thread.name.startswith("pytest-"))
+
+
+def test_shutdown_rejects(gate):
+    """
+    Test that jobs submitted after shutdown are rejected instead of restarting the workers,
+    and that a restart never leaves more than `workers` threads running jobs
+    """
+    executor = make_executor(OverflowPolicies.DROP_OLDEST, gate)
+    old_worker = executor._threads[0]
+    # the worker is stuck on its job - give up waiting for it
+    executor.shutdown(timeout=0.1)
+    assert old_worker.is_alive()
+
+    ran = []
+    assert not executor.submit(ran.append, 1)
+    assert executor.metrics()["rejected"] == 1
+
+    executor.start()
+    done = threading.Event()
+    assert executor.submit(lambda: ran.append(2) or done.set())
+    # a new worker runs it while the old one is still busy
+    assert done.wait(MAX_WAIT_SECONDS)
+    assert ran == [2]
+    assert old_worker.is_alive()
+
+    # the old worker finishes its job and exits instead of joining the new generation
+    gate.set()
+    old_worker.join(MAX_WAIT_SECONDS)
+    assert not old_worker.is_alive()
+    executor.shutdown()
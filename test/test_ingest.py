@@ -0,0 +1,173 @@
+import threading
+import time
+
+from library.data.ingest import IngestBuffer
+
+MAX_WAIT_SECONDS = 5.0
+
+
+class Recorder:
+    """
+    Flush method which records the batches it's given
+    """
+    def __init__(self):
+        self.batches = []
+        self.flushed = threading.Event()
+
+    def __call__(self, rows):
+        self.batches.append(list(rows))
+        self.flushed.set()
+
+
+def test_flush_on_size():
+    """
+    Test that a full batch is flushed without waiting for max_delay
+    """
+    recorder = Recorder()
+    buffer = IngestBuffer(recorder, batch_size=10, max_delay=60.0)
+    for i in range(9):
+        buffer.put(i)
+    assert not recorder.flushed.wait(0.1)
+
+    buffer.put(9)
+    assert recorder.flushed.wait(MAX_WAIT_SECONDS)
+    assert recorder.batches == [list(range(10))]
+    assert len(buffer) == 0
+
+    # close() flushes a partial batch
+    for i in range(10, 15):
+        buffer.put(i)
+    buffer.close()
+    assert recorder.batches[-1] == list(range(10, 15))
+    assert all(len(batch) <= 10 for batch in recorder.batches)
+
+
+def test_flush_on_time():
+    """
+    Test that a partial batch is flushed once its oldest row is max_delay old
+    """
+    recorder = Recorder()
+    buffer = IngestBuffer(recorder, batch_size=100, max_delay=0.1)
+    start = time.monotonic()
+    buffer.put("a")
+    buffer.put("b")
+
+    assert recorder.flushed.wait(MAX_WAIT_SECONDS)
+    assert time.monotonic() - start >= 0.1
+    assert recorder.batches == [["a", "b"]]
+    buffer.close()
+
+
+def test_bounded():
+    """
+    Test that the oldest rows are dropped once max_rows are waiting
+    """
+    gate = threading.Event()
+    recorder = Recorder()
+
+    def flush(rows):
+        gate.wait(MAX_WAIT_SECONDS)
+        recorder(rows)
+
+    buffer = IngestBuffer(flush, batch_size=2, max_delay=60.0, max_rows=3)
+    buffer.put(0)
+    buffer.put(1)
+    # wait for the flush thread to take the first batch and block
+    start = time.monotonic()
+    while len(buffer) and time.monotonic() - start < MAX_WAIT_SECONDS:
+        time.sleep(0.01)
+    for i in range(2, 7):
+        buffer.put(i)
+    assert len(buffer) == 3
+
+    gate.set()
+    buffer.close()
+    assert [row for batch in recorder.batches for row in batch] == [0, 1, 4, 5, 6]
+
+    metrics = buffer.metrics()
+    assert metrics["received"] == 7
+    assert metrics["flushed"] == 5
+    assert metrics["dropped"] == 2
+    assert metrics["waiting"] == 0
+
+
+def test_failed_flush():
+    """
+    Test that a failing flush is counted and doesn't stop later batches
+    """
+    calls = []
+
+    def flush(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise Exception("pytest")
+
+    buffer = IngestBuffer(flush, batch_size=2, max_delay=60.0)
+    for i in range(4):
+        buffer.put(i)
+    buffer.close()
+
+    metrics = buffer.metrics()
+    assert metrics["failed"] == 2
+    assert metrics["flushed"] == 2
+    assert metrics["rows_per_second"] > 0
+    assert "2 rows in 1 batches" in buffer.report()
+
+
+def test_transient_failure():
+    """
+    Test that batches failing with a transient error are retried in order instead of dropped
+    """
+    recorder = Recorder()
+    failures = [2]
+
+    def flush(rows):
+        if failures[0]:
+            failures[0] -= 1
+            raise ConnectionError("pytest")
+        recorder(rows)
+
+    buffer = IngestBuffer(
+        flush, batch_size=2, max_delay=60.0, transient_errors=(ConnectionError,), retry_delay=0.05
+    )
+    start = time.monotonic()
+    for i in range(4):
+        buffer.put(i)
+    assert recorder.flushed.wait(MAX_WAIT_SECONDS)
+    # backed off 0.05s then 0.1s
+    assert time.monotonic() - start >= 0.15
+    buffer.close()
+
+    assert [row for batch in recorder.batches for row in batch] == [0, 1, 2, 3]
+    metrics = buffer.metrics()
+    assert metrics["retries"] == 2
+    assert metrics["failed"] == 0
+    assert metrics["dropped"] == 0
+
+
+def test_transient_failure_bounded():
+    """
+    Test that rows held through an outage are still bounded, and dropped if it outlasts the buffer
+    """
+    def flush(rows):
+        raise ConnectionError("pytest")
+
+    buffer = IngestBuffer(
+        flush, batch_size=2, max_delay=60.0, max_rows=3, transient_errors=(ConnectionError,), retry_delay=60.0
+    )
+    buffer.put(0)
+    buffer.put(1)
+    start = time.monotonic()
+    while not buffer.retries and time.monotonic() - start < MAX_WAIT_SECONDS:
+        time.sleep(0.01)
+    assert len(buffer) == 2
+    for i in range(2, 5):
+        buffer.put(i)
+    assert len(buffer) == 3
+    assert list(buffer._rows) == [2, 3, 4]
+
+    buffer.close()
+    metrics = buffer.metrics()
+    assert metrics["dropped"] == 2
+    assert metrics["failed"] == 3
+    assert metrics["waiting"] == 0
@@ -1,6 +1,14 @@
+import json
+import time
+
 import pytest
+from paho.mqtt.client import MQTT_ERR_NO_CONN, MQTTMessage, MQTTMessageInfo, topic_matches_sub
 
-from library.communication.mqtt import get_mqtt_error_message
+from library.communication.mqtt import (
+    MQTTError, MQTTConnection, close_connections, get_mqtt_error_message, get_connection
+)
+from library.communication.outbox import Outbox
+from library.communication.router import TopicRouter
 
 
 @pytest.mark.parametrize(
@@ -14,3 +22,211 @@ def test_get_mqtt_error_message(rc, expect_response):
         assert get_mqtt_error_message(rc)
     else:
         assert not get_mqtt_error_message(rc)
+
+
+def test_get_connection():
+    """
+    Test that connections are shared per broker
+    """
+    connection = get_connection("localhost", 1883)
+    assert get_connection("localhost", 1883) is connection
+    assert get_connection("localhost", 1884) is not connection
+    close_connections()
+    assert get_connection("localhost", 1883) is not connection
+    close_connections()
+
+
+def test_connection_unreachable():
+    """
+    Test that publishing to an unreachable broker raises instead of hanging
+    """
+    connection = MQTTConnection("127.0.0.1", 1)
+    try:
+        with pytest.raises(MQTTError):
+            connection.publish("pytest/unreachable", {"state": "on"}, timeout=0.2)
+        assert not connection.connected
+    finally:
+        connection.close()
+
+
+def test_publish_many_unreachable():
+    """
+    Test that a batch publish to an unreachable broker raises instead of hanging
+    """
+    connection = MQTTConnection("127.0.0.1", 1)
+    messages = [(f"pytest/unreachable/{i}", {"state": i}, 2, False) for i in range(3)]
+    try:
+        with pytest.raises(MQTTError):
+            connection.publish_many(messages, timeout=0.2)
+    finally:
+        connection.close()
+
+
+def test_outbox_cap(tmp_path):
+    """
+    Test that the outbox drops the oldest messages once full
+    """
+    outbox = Outbox(str(tmp_path / "outbox.db"), max_size=5)
+    try:
+        outbox.put([(f"pytest/outbox/{i}", {"state": i}, 2, True) for i in range(8)])
+        assert len(outbox) == 5
+        assert outbox.dropped == 3
+        batch = outbox.peek(2)
+        assert [message[0] for _, message in batch] == ["pytest/outbox/3", "pytest/outbox/4"]
+        assert batch[0][1][1] == json.dumps({"state": 3})
+        outbox.remove([message_id for message_id, _ in batch])
+        assert len(outbox) == 3
+    finally:
+        outbox.close()
+
+
+def test_outbox_store_and_forward(tmp_path):
+    """
+    Test that messages are stored while the broker is down and drained in order once it's back
+    """
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    connection = MQTTConnection("127.0.0.1", 1, outbox=outbox, drain_rate=1000.0)
+    sent = []
+
+    def broker_down(messages, timeout=None):
+        raise MQTTError("broker down")
+
+    def broker_up(messages, timeout=None):
+        sent.extend(topic for topic, _, _, _ in messages)
+
+    try:
+        connection.send = broker_down
+        connection.publish_many([(f"pytest/outbox/{i}", str(i), 2, False) for i in range(3)])
+        assert len(outbox) == 3
+
+        # Messages published behind a backlog are queued too, so order is preserved
+        connection.send = broker_up
+        connection.publish("pytest/outbox/3", "3", qos=2, retain=False)
+        assert len(outbox) == 4
+
+        connection._connected.set()
+        connection.on_connect(None, None, None, 0)
+        start = time.time()
+        while len(outbox) and time.time() - start < 5:
+            time.sleep(0.01)
+        assert sent == [f"pytest/outbox/{i}" for i in range(4)]
+        assert not len(outbox)
+    finally:
+        connection._connected.clear()
+        connection.close()
+        outbox.close()
+
+
+def test_publish_disconnect_race(tmp_path):
+    """
+    Test that messages published as the session drops are stored instead of raising paho's RuntimeError
+    """
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    connection = MQTTConnection("127.0.0.1", 1, outbox=outbox)
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        info = MQTTMessageInfo(1)
+        info.rc = MQTT_ERR_NO_CONN
+        return info
+
+    try:
+        connection.client.publish = publish
+        connection._connected.set()
+        with pytest.raises(MQTTError):
+            connection.send([("pytest/race", "0", 2, False)], timeout=0.2)
+        connection.publish_many([(f"pytest/race/{i}", str(i), 2, False) for i in range(3)], timeout=0.2)
+        assert len(outbox) == 3
+    finally:
+        connection._connected.clear()
+        connection.close()
+        outbox.close()
+
+
+def test_drain_unexpected_error(tmp_path):
+    """
+    Test that the drain thread survives unexpected exceptions and drains on the next trigger
+    """
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    connection = MQTTConnection("127.0.0.1", 1, outbox=outbox, drain_rate=1000.0)
+    sent = []
+
+    def broken(messages, timeout=None):
+        raise RuntimeError("message is not queued")
+
+    def broker_up(messages, timeout=None):
+        sent.extend(topic for topic, _, _, _ in messages)
+
+    try:
+        connection.start()
+        outbox.put([(f"pytest/drain/{i}", str(i), 2, False) for i in range(3)])
+        connection.send = broken
+        connection._connected.set()
+        connection.on_connect(None, None, None, 0)
+        time.sleep(0.1)
+        assert connection._drain_thread.is_alive()
+        assert len(outbox) == 3
+
+        connection.send = broker_up
+        connection.on_connect(None, None, None, 0)
+        start = time.time()
+        while len(outbox) and time.time() - start < 5:
+            time.sleep(0.01)
+        assert sent == [f"pytest/drain/{i}" for i in range(3)]
+    finally:
+        connection._connected.clear()
+        connection.close()
+        outbox.close()
+
+
+SUBSCRIPTIONS = ["a/b", "a/+", "a/#", "#", "+/b", "+", "a/+/c", "$SYS/#", "a", "a/b/#"]
+
+
+@pytest.mark.parametrize("topic", ["a", "a/b", "a/c", "a/b/c", "a/b/c/d", "x/b", "x", "$SYS/x"])
+def test_topic_router(topic):
+    """
+    Test that the router matches the same subscriptions as paho
+    """
+    router = TopicRouter()
+    for subscription in SUBSCRIPTIONS:
+        router.add(subscription, subscription)
+    expected = [x for x in SUBSCRIPTIONS if topic_matches_sub(x, topic)]
+    assert sorted(router.match(topic)) == sorted(expected)
+
+
+def test_topic_router_remove():
+    """
+    Test that removed handlers stop matching and subscriptions are only dropped once unused
+    """
+    router = TopicRouter()
+    assert router.add("a/+/c", "first")
+    assert not router.add("a/+/c", "second")
+    assert router.add("a/#", "first")
+    assert router.match("a/b/c") == ["first", "second"]
+
+    assert not router.remove("a/+/c", "first")
+    assert router.match("a/b/c") == ["first", "second"]
+    assert router.remove("a/+/c", "second")
+    assert router.match("a/b/c") == ["first"]
+    assert router.subscriptions == ["a/#"]
+
+
+def test_connection_routing():
+    """
+    Test that a shared connection routes messages to each subscribed handler once
+    """
+    received = {"door": [], "env": []}
+    door_handler = lambda client, userdata, msg: received["door"].append(msg.topic)
+    env_handler = lambda client, userdata, msg: received["env"].append(msg.topic)
+
+    connection = MQTTConnection("127.0.0.1", 1)
+    try:
+        connection.subscribe(["home/door/state", "home/+/state"], door_handler)
+        connection.subscribe(["home/env/#"], env_handler)
+        for topic in ["home/door/state", "home/env/state", "home/other"]:
+            connection.on_message(None, None, MQTTMessage(topic=topic.encode("utf-8")))
+        assert received == {"door": ["home/door/state", "home/env/state"], "env": ["home/env/state"]}
+
+        connection.unsubscribe(["home/door/state", "home/+/state"], door_handler)
+        assert connection.router.subscriptions == ["home/env/#"]
+    finally:
+        connection.close()
@@ -0,0 +1,166 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from paho.mqtt.client import MQTTMessage
+
+from library import ControllerStates
+from library.controllers import BaseController, get_logger
+from library.communication.mqtt import close_connections
+from library.runtime import AsyncRuntime
+
+MAX_WAIT_SECONDS = 5.0
+PERIOD = 0.05
+
+
+class DummyController(BaseController):
+    """
+    Minimal controller which records loop() calls and messages
+    """
+
+    def __init__(self, period=None, subscriptions=(), retention=None):
+        mqtt_config = SimpleNamespace(
+            broker="127.0.0.1", port=1, outbox_path=None, outbox_size=10, outbox_rate=10.0
+        )
+        super().__init__(SimpleNamespace(
+            mqtt_config=mqtt_config, db_enabled=bool(retention), db_retention=retention or {},
+            db_type="local", db_server=None, db_path=None, db_database_name=""
+        ))
+        self.logger = get_logger(__name__, True, None)
+        self._period = period
+        self._subscriptions = list(subscriptions)
+        self.loops = 0
+        self.messages = []
+        self.retained = []
+
+    @property
+    def period(self):
+        return self._period
+
+    @property
+    def start_delay(self):
+        return 0
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    def start(self):
+        super().start()
+
+    def stop(self):
+        super().stop()
+
+    def loop(self):
+        self.loops += 1
+
+    def apply_retention(self, policy):
+        self.retained.append((policy, threading.current_thread()))
+        return {"rolled_up": 0, "deleted": 0}
+
+    def handle_message(self, topic, message_data):
+        self.messages.append((topic, message_data, threading.current_thread()))
+
+    def cleanup(self):
+        super().cleanup()
+
+
+def wait_for(condition, timeout=MAX_WAIT_SECONDS):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def make_message(topic, payload):
+    msg = MQTTMessage(topic=topic.encode("utf-8"))
+    msg.payload = payload
+    return msg
+
+
+def test_periodic():
+    """
+    Test that periodic controllers run on the event loop and are cleaned up on shutdown
+    """
+    controller = DummyController(period=PERIOD)
+    runtime = AsyncRuntime([controller], stop=lambda: controller.loops >= 5, check_interval=PERIOD)
+    runtime.run()
+
+    assert controller.loops >= 5
+    assert controller.status == ControllerStates.STOPPED
+    assert not runtime.tasks
+
+
+def test_retention():
+    """
+    Test that retention policies run on the event loop's executor and stop on shutdown
+    """
+    policy = SimpleNamespace(interval=PERIOD)
+    controller = DummyController(retention={"pytest_table": policy})
+    deadline = time.monotonic() + MAX_WAIT_SECONDS
+    runtime = AsyncRuntime(
+        [controller],
+        stop=lambda: len(controller.retained) >= 3 or time.monotonic() > deadline,
+        check_interval=PERIOD
+    )
+    runtime.run()
+
+    assert len(controller.retained) >= 3
+    assert all(x is policy for x, _ in controller.retained)
+    assert all(thread.name.startswith("io") for _, thread in controller.retained)
+    assert not controller.retention_jobs
+    assert not runtime.tasks
+
+
+def test_register():
+    """
+    Test that subscriptions are routed to one handler per controller over the shared session
+    """
+    first = DummyController(subscriptions=["pytest/runtime/#", "pytest/runtime/+/state"])
+    second = DummyController(subscriptions=["pytest/runtime/door/state"])
+    runtime = AsyncRuntime([first, second])
+    try:
+        runtime.register(first)
+        runtime.register(second)
+
+        router = runtime.connection.router
+        assert router.match("pytest/runtime/door/state") == [runtime.handlers[first], runtime.handlers[second]]
+        assert router.match("pytest/runtime/env") == [runtime.handlers[first]]
+        assert router.match("pytest/other") == []
+    finally:
+        close_connections()
+
+
+def test_dispatch():
+    """
+    Test that messages are decoded on the event loop and handled in the executor
+    """
+    subscriber = DummyController(subscriptions=["pytest/runtime/#"])
+    bystander = DummyController(subscriptions=["pytest/other"])
+    runtime = AsyncRuntime([subscriber, bystander], check_interval=PERIOD)
+    thread = threading.Thread(target=runtime.run)
+    thread.start()
+    try:
+        assert wait_for(lambda: subscriber.status == ControllerStates.RUNNING)
+        for msg in [
+            make_message("pytest/runtime/a", b'{"state": "open"}'),
+            make_message("pytest/runtime/b", b"not json"),
+            make_message("pytest/unrelated", b'{"state": "closed"}'),
+        ]:
+            runtime.loop.call_soon_threadsafe(runtime.connection.on_message, None, None, msg)
+
+        assert wait_for(lambda: subscriber.messages)
+        time.sleep(PERIOD)
+        assert [x[:2] for x in subscriber.messages] == [("pytest/runtime/a", {"state": "open"})]
+        assert subscriber.messages[0][2] is not thread
+        assert not bystander.messages
+
+        # Broker is unreachable - the runtime keeps retrying instead of dying
+        assert all(x["status"] == ControllerStates.RUNNING for x in runtime.health())
+    finally:
+        runtime.shutdown()
+        thread.join(MAX_WAIT_SECONDS)
+    assert not thread.is_alive()
+    assert subscriber.status == ControllerStates.STOPPED
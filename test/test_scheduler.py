@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from library.scheduler import Scheduler, get_scheduler
+
+PERIOD = 0.1
+MAX_JITTER = 0.05
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler(workers=2)
+    yield scheduler
+    scheduler.stop()
+
+
+def wait_for(condition, timeout=5.0):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_get_scheduler():
+    """
+    Test that all controllers share one scheduler
+    """
+    assert get_scheduler() is get_scheduler()
+
+
+def test_phase_locked(scheduler):
+    """
+    Test that slow callbacks don't push later deadlines back
+    """
+    times = []
+
+    def slow_callback():
+        times.append(time.monotonic())
+        time.sleep(PERIOD / 2)
+
+    job = scheduler.schedule(slow_callback, PERIOD, delay=0)
+    assert wait_for(lambda: len(times) >= 10)
+    job.cancel()
+
+    # Every run should land on a multiple of the period from the first run
+    for i, t in enumerate(times[:10]):
+        assert abs(t - times[0] - i * PERIOD) < MAX_JITTER, f"Run {i} drifted: {t - times[0]:0.3f}s"
+
+
+def test_skip_busy(scheduler):
+    """
+    Test that a job still running when its next deadline comes up is skipped, not stacked
+    """
+    release = threading.Event()
+    running = []
+
+    def blocking_callback():
+        running.append(1)
+        release.wait()
+
+    job = scheduler.schedule(blocking_callback, PERIOD / 5, delay=0)
+    assert wait_for(lambda: job.skipped >= 3)
+    assert len(running) == 1
+    release.set()
+    job.cancel()
+
+
+def test_cancel(scheduler):
+    """
+    Test that cancelled jobs stop running
+    """
+    calls = []
+    job = scheduler.schedule(lambda: calls.append(1), PERIOD / 5, delay=0)
+    assert wait_for(lambda: len(calls) >= 2)
+    job.cancel()
+    time.sleep(PERIOD / 2)
+    count = len(calls)
+    time.sleep(PERIOD)
+    assert len(calls) == count
+
+
+def test_exception(scheduler):
+    """
+    Test that an exception in one run doesn't stop the job
+    """
+    calls = []
+
+    def bad_callback():
+        calls.append(1)
+        raise Exception("bad callback")
+
+    job = scheduler.schedule(bad_callback, PERIOD / 5, delay=0)
+    assert wait_for(lambda: len(calls) >= 3)
+    job.cancel()
+
+
+def test_idle_cpu(scheduler):
+    """
+    Test that the scheduler sleeps between deadlines instead of polling
+    """
+    job = scheduler.schedule(lambda: None, 60.0)
+    cpu_start = time.process_time()
+    time.sleep(1.0)
+    assert time.process_time() - cpu_start < 0.05
+    job.cancel()
@@ -0,0 +1,170 @@
+import os
+import signal
+import time
+from threading import Thread, Event, Timer
+
+from library import ControllerStates
+from library.controllers import BaseController
+from library.supervisor import Supervisor
+
+IDLE_SECONDS = 10.0
+MAX_IDLE_CPU_SECONDS = 0.2
+MAX_WAIT_SECONDS = 5.0
+
+
+class DummyController(BaseController):
+    """
+    Minimal controller - its thread blocks until stopped or crashed
+    """
+
+    def __init__(self, label):
+        super().__init__(None)
+        self.label = label
+        self.starts = 0
+        self._crash = Event()
+        self._stop = Event()
+
+    def start(self):
+        super().start()
+        self._crash.clear()
+        self._stop.clear()
+        self.start_thread()
+        self.starts += 1
+
+    def stop(self):
+        super().stop()
+        self._stop.set()
+
+    def loop(self):
+        while not self._stop.wait(0.01):
+            if self._crash.is_set():
+                raise Exception(f"{self.label} crashed")
+
+    def crash(self):
+        self._crash.set()
+
+    def cleanup(self):
+        super().cleanup()
+
+    def __repr__(self) -> str:
+        return self.label
+
+
+def wait_for(condition, timeout=MAX_WAIT_SECONDS):
+    """
+    Wait until condition() is True or the timeout expires
+    @rtype: bool
+    """
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_idle_cpu():
+    """
+    Test that the supervisor doesn't burn CPU while waiting
+    """
+    class IdleController(DummyController):
+        def loop(self):
+            self._stop.wait()
+
+    controllers = [IdleController("idle0"), IdleController("idle1")]
+    start = time.time()
+    supervisor = Supervisor(controllers, stop=lambda: time.time() - start > IDLE_SECONDS)
+
+    cpu_start = time.process_time()
+    supervisor.run()
+    cpu_used = time.process_time() - cpu_start
+
+    assert time.time() - start >= IDLE_SECONDS
+    assert cpu_used < MAX_IDLE_CPU_SECONDS, f"Supervisor used {cpu_used:0.3f}s of CPU while idle"
+
+
+def test_restart_crashed_controller():
+    """
+    Test that a crashed controller is restarted and others are left alone
+    """
+    crashy = DummyController("crashy")
+    steady = DummyController("steady")
+    supervisor = Supervisor([crashy, steady], check_interval=0.05, min_backoff=0.1, max_backoff=1.0)
+    thread = Thread(target=supervisor.run)
+    thread.start()
+    try:
+        assert wait_for(lambda: crashy.starts and steady.starts)
+
+        crashy.crash()
+        assert wait_for(lambda: crashy.status == ControllerStates.FAILED or crashy.starts == 2)
+        assert wait_for(lambda: crashy.starts == 2), "Crashed controller was not restarted"
+        assert steady.starts == 1
+        assert steady.status == ControllerStates.RUNNING
+        assert supervisor.restarts[crashy] == 1
+        assert [x["restarts"] for x in supervisor.health()] == [1, 0]
+
+        # Crashing again right away should double the backoff
+        crashy.crash()
+        assert wait_for(lambda: crashy.starts == 3)
+        assert supervisor._backoff[crashy] == 0.4
+    finally:
+        supervisor.shutdown()
+        thread.join(MAX_WAIT_SECONDS)
+    assert not thread.is_alive()
+    assert not crashy.running
+
+
+def test_sigterm():
+    """
+    Test that SIGTERM shuts the supervisor down gracefully
+    """
+    controller = DummyController("dummy")
+    supervisor = Supervisor([controller], check_interval=MAX_WAIT_SECONDS * 2)
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    timer = Timer(0.25, os.kill, args=(os.getpid(), signal.SIGTERM))
+    timer.start()
+    start = time.time()
+    supervisor.run()
+
+    assert time.time() - start < MAX_WAIT_SECONDS
+    assert not controller.running
+    assert wait_for(lambda: not controller.alive)
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_lifecycle():
+    """
+    Test that controllers move through their states independently
+    """
+    first = DummyController("first")
+    second = DummyController("second")
+    assert first.status == ControllerStates.CREATED
+    try:
+        first.start()
+        second.start()
+        assert first.status == ControllerStates.RUNNING
+        assert first.running and second.running
+
+        # Stopping one controller leaves the other running
+        first.stop()
+        assert wait_for(lambda: first.status == ControllerStates.STOPPED)
+        assert not first.running
+        assert second.running and second.alive
+
+        # A stopped controller shouldn't be restarted by the supervisor
+        assert not Supervisor.is_dead(first)
+
+        # Crashed controllers are marked failed
+        second.crash()
+        assert wait_for(lambda: second.status == ControllerStates.FAILED)
+        assert Supervisor.is_dead(second)
+
+        # And can be restarted on their own
+        second.restart()
+        assert second.status == ControllerStates.RUNNING
+        assert second.alive
+        assert second.health() == {"name": "DummyController", "status": ControllerStates.RUNNING, "alive": True}
+    finally:
+        first.cleanup()
+        second.cleanup()
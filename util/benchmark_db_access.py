@@ -0,0 +1,105 @@
+"""
+Compare the per-call cost of opening a new Database (connect + table
+checks) for every access against reusing one kept-open Database the way
+controllers now do
+Usage: python -m util.benchmark_db_access --count 2000
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import timeit
+
+from library.data import Column
+from library.data.local_database import Database
+
+TABLE_NAME = "benchmark"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "integer", "PRIMARY KEY"),
+        Column("state", "text", "NOT NULL"),
+        Column("convo_id", "text", "NOT NULL"),
+        Column("captured", "integer", "NOT NULL"),
+        Column("notified", "integer", "NOT NULL"),
+    ]
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark database access")
+    parser.add_argument("--count", "-n", default=2000, type=int, help="Number of accesses")
+    parser.add_argument("--rows", "-r", default=100, type=int, help="Rows in the table")
+    return parser.parse_args()
+
+
+def run(name, method, count) -> float:
+    """
+    Time count calls to method and print a summary
+    @param name: name for the report
+    @type name: str
+    @param method: method to time
+    @type method: method
+    @param count: number of calls
+    @type count: int
+    @return: mean seconds per call
+    @rtype: float
+    """
+    latencies = []
+    for _ in range(count):
+        start = timeit.default_timer()
+        method()
+        latencies.append(timeit.default_timer() - start)
+
+    latencies.sort()
+    mean = statistics.mean(latencies)
+    print(
+        f"{name:<12} {count / sum(latencies):>10.1f} calls/s  "
+        f"mean {mean * 1e6:>8.1f}us  "
+        f"p50 {latencies[len(latencies) // 2] * 1e6:>8.1f}us  "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1e6:>8.1f}us"
+    )
+    return mean
+
+
+def main(count, rows):
+    """
+    Run the benchmark
+    @param count: number of accesses
+    @type count: int
+    @param rows: rows in the table
+    @type rows: int
+    """
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    with Database(TABLES, TABLE_NAME, path) as db:
+        db.get_table(TABLE_NAME).add_data_multiple(
+            [(i, "Open", str(i), 0, 0) for i in range(rows)]
+        )
+
+    def fresh():
+        with Database(TABLES, TABLE_NAME, path) as db:
+            db.get_table(TABLE_NAME).get_latest_record()
+
+    cached_db = Database(TABLES, TABLE_NAME, path)
+    cached_db.keep_open = True
+
+    def cached():
+        with cached_db as db:
+            db.get_table(TABLE_NAME).get_latest_record()
+
+    try:
+        fresh_mean = run("fresh", fresh, count)
+        cached_mean = run("cached", cached, count)
+        print(f"overhead removed: {(fresh_mean - cached_mean) * 1e6:.1f}us per call "
+              f"({fresh_mean / cached_mean:.1f}x faster)")
+    finally:
+        cached_db.cleanup()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -0,0 +1,105 @@
+"""
+Compare inserting buffered sensor readings into SQL Server with plain
+executemany (a round trip per row) against add_data_multiple's multi-row
+INSERTs, reporting rows/sec. Needs a SQL Server instance - see the README
+Usage: SQL_PASSWORD=... python -m util.benchmark_db_bulk_insert --server localhost,1433 --rows 20000
+"""
+import argparse
+import datetime
+import os
+import timeit
+
+from library.data import Column
+from library.data.central_database import Database
+from library.data.database import QueryKeys
+
+TABLE_NAME = "benchmark_bulk_insert"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "datetime2(3)", "PRIMARY KEY"),
+        Column("id", "varchar(50)", "NOT NULL"),
+        Column("temperature", "real", "NOT NULL"),
+        Column("humidity", "real", "NOT NULL"),
+    ]
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark bulk inserts into SQL Server")
+    parser.add_argument("--server", "-s", default="localhost,1433", help="Server address")
+    parser.add_argument("--database", "-d", default="tempdb", help="Database name")
+    parser.add_argument("--username", "-u", default="sa", help="Username - password is read from SQL_PASSWORD")
+    parser.add_argument("--rows", "-r", default=20000, type=int, help="Rows to insert")
+    return parser.parse_args()
+
+
+def get_rows(count, offset) -> list:
+    """
+    Make readings from four sensors, one per second
+    @param count: number of rows
+    @type count: int
+    @param offset: seconds after the start of 2024 of the first row
+    @type offset: int
+    @rtype: list[tuple]
+    """
+    start = datetime.datetime(2024, 1, 1)
+    return [
+        (start + datetime.timedelta(seconds=offset + i), f"sensor{i % 4}", 20.0 + i % 10, 50.0)
+        for i in range(count)
+    ]
+
+
+def run(name, insert, rows) -> float:
+    """
+    Insert the rows & report the rate
+    @param name: name for the report
+    @type name: str
+    @param insert: method inserting a list of rows
+    @type insert: method
+    @param rows: rows to insert
+    @type rows: list[tuple]
+    @return: rows per second
+    @rtype: float
+    """
+    start = timeit.default_timer()
+    insert(rows)
+    rate = len(rows) / (timeit.default_timer() - start)
+    print(f"{name:<14} {rate:>10.0f} rows/s")
+    return rate
+
+
+def main(server, database, username, rows):
+    """
+    Run the benchmark
+    @param server: server address
+    @type server: str
+    @param database: database name
+    @type database: str
+    @param username: username
+    @type username: str
+    @param rows: rows to insert
+    @type rows: int
+    """
+    db = Database(TABLES, server, database, username, os.environ.get("SQL_PASSWORD", ""))
+    print(f"{rows} rows")
+    with db:
+        table = db.get_table(TABLE_NAME)
+        print(f"{table.insert_chunk_size} rows per INSERT")
+
+        def executemany(data):
+            table.cursor.executemany(table.query(QueryKeys.INSERT), data)
+            table.connection.commit()
+
+        plain = run("executemany", executemany, get_rows(rows, 0))
+        bulk = run("multi-row", table.add_data_multiple, get_rows(rows, rows))
+        print(f"{bulk / plain:.1f}x faster")
+        table.drop()
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -0,0 +1,139 @@
+"""
+Compare concurrent writer/reader throughput on one sqlite file with the
+default rollback journal against WAL mode + synchronous=normal, the way
+several controllers share garage_door_monitor.sqlite3
+Usage: python -m util.benchmark_db_concurrency --writers 3 --readers 2 --seconds 5
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from library.data import Column
+from library.data.local_database import Database
+
+TABLE_NAME = "benchmark"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "integer", "PRIMARY KEY"),
+        Column("state", "text", "NOT NULL"),
+        Column("convo_id", "text", "NOT NULL"),
+        Column("captured", "integer", "NOT NULL"),
+        Column("notified", "integer", "NOT NULL"),
+    ]
+}
+MODES = {
+    "default": {"busy_timeout": 5000},
+    "wal": {"busy_timeout": 5000, "journal_mode": "wal", "synchronous": "normal"},
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark concurrent database access")
+    parser.add_argument("--writers", "-w", default=3, type=int, help="Writer threads")
+    parser.add_argument("--readers", "-r", default=2, type=int, help="Reader threads")
+    parser.add_argument("--seconds", "-s", default=5.0, type=float, help="Seconds per mode")
+    return parser.parse_args()
+
+
+def run(name, pragmas, writers, readers, seconds) -> dict:
+    """
+    Run writers & readers, each with its own connection, against a fresh file
+    @param name: name for the report
+    @type name: str
+    @param pragmas: PRAGMAs for every connection
+    @type pragmas: dict
+    @param writers: writer threads
+    @type writers: int
+    @param readers: reader threads
+    @type readers: int
+    @param seconds: how long to run
+    @type seconds: float
+    @return: writes, reads & errors per second
+    @rtype: dict
+    """
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    with Database(TABLES, TABLE_NAME, path, pragmas):
+        pass
+
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def write(offset):
+        db = Database(TABLES, TABLE_NAME, path, pragmas)
+        db.keep_open = True
+        i = 0
+        while not stop.is_set():
+            try:
+                with db:
+                    db.get_table(TABLE_NAME).add_data([offset + i, "Open", str(i), 0, 0])
+                count("writes")
+            except Exception:
+                count("errors")
+            i += 1
+        db.cleanup()
+
+    def read():
+        db = Database(TABLES, TABLE_NAME, path, pragmas)
+        db.keep_open = True
+        while not stop.is_set():
+            try:
+                with db:
+                    db.get_table(TABLE_NAME).get_latest_record()
+                count("reads")
+            except Exception:
+                count("errors")
+        db.cleanup()
+
+    threads = [threading.Thread(target=write, args=(n * 10 ** 9,)) for n in range(writers)]
+    threads += [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    rates = {key: value / seconds for key, value in counts.items()}
+    print(
+        f"{name:<8} writes {rates['writes']:>10.1f}/s  reads {rates['reads']:>10.1f}/s  "
+        f"errors {rates['errors']:>6.1f}/s"
+    )
+    return rates
+
+
+def main(writers, readers, seconds):
+    """
+    Run the benchmark
+    @param writers: writer threads
+    @type writers: int
+    @param readers: reader threads
+    @type readers: int
+    @param seconds: seconds per mode
+    @type seconds: float
+    """
+    print(f"{writers} writers, {readers} readers, {seconds}s per mode")
+    results = {name: run(name, pragmas, writers, readers, seconds) for name, pragmas in MODES.items()}
+    default, wal = results["default"], results["wal"]
+    for key in ["writes", "reads"]:
+        if default[key]:
+            print(f"{key:<8} {wal[key] / default[key]:>10.1f}x with wal")
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -0,0 +1,125 @@
+"""
+Compare loading environment history as DatabaseEntry records against
+exporting it straight into NumPy arrays, and saving/loading those as .npz
+Usage: python -m util.benchmark_db_export --days 365 --sensors 1
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import timeit
+import tracemalloc
+
+from library.data import Column
+from library.data.export import load_arrays, save_arrays
+from library.data.local_database import Database
+
+TABLE_NAME = "environment"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "datetime", "PRIMARY KEY"),
+        Column("id", "varchar(50)", "NOT NULL"),
+        Column("temperature", "real", "NOT NULL"),
+        Column("humidity", "real", "NOT NULL"),
+    ]
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark exporting environment history")
+    parser.add_argument("--days", "-d", default=365, type=int, help="Days of per-minute readings")
+    parser.add_argument("--sensors", "-s", default=1, type=int, help="Sensors reading every minute")
+    return parser.parse_args()
+
+
+def fill(db, days, sensors) -> int:
+    """
+    Fill the table with per-minute readings
+    @param db: database to fill
+    @type db: Database
+    @param days: days of readings
+    @type days: int
+    @param sensors: number of sensors
+    @type sensors: int
+    @return: number of rows
+    @rtype: int
+    """
+    start = datetime.datetime(2024, 1, 1)
+    minutes = days * 24 * 60
+    with db:
+        table = db.get_table(TABLE_NAME)
+        for offset in range(0, minutes, 10000):
+            rows = []
+            for minute in range(offset, min(offset + 10000, minutes)):
+                time = start + datetime.timedelta(minutes=minute)
+                for sensor in range(sensors):
+                    # each sensor a millisecond apart so timestamps stay unique
+                    stamp = time + datetime.timedelta(milliseconds=sensor)
+                    rows.append((stamp.isoformat(" ", "milliseconds"), f"sensor{sensor}", 24.0, 55.0))
+            table.add_data_multiple(rows)
+    return minutes * sensors
+
+
+def measure(name, method):
+    """
+    Time a method, then run it again to get its peak memory - tracing slows it down
+    @param name: name for the report
+    @type name: str
+    @param method: method to measure
+    @type method: method
+    @return: whatever the method returns
+    """
+    start = timeit.default_timer()
+    method()
+    elapsed = timeit.default_timer() - start
+    tracemalloc.start()
+    result = method()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} {elapsed:>8.2f}s  {peak / 1e6:>8.1f}MB peak")
+    return result
+
+
+def main(days, sensors):
+    """
+    Run the benchmark
+    @param days: days of per-minute readings
+    @type days: int
+    @param sensors: number of sensors
+    @type sensors: int
+    """
+    folder = tempfile.mkdtemp()
+    db = Database(TABLES, TABLE_NAME, os.path.join(folder, "benchmark.sqlite3"))
+    rows = fill(db, days, sensors)
+    print(f"{rows} rows")
+
+    with db:
+        table = db.get_table(TABLE_NAME)
+        records = measure("records", lambda: [x["temperature"] for x in table.get_all_records()])
+        arrays = measure("arrays", lambda: table.export_range(group_by="id"))
+        assert len(records) == rows
+        assert sum(len(x["temperature"]) for x in arrays.values()) == rows
+
+    path = os.path.join(folder, "environment.npz")
+    start = timeit.default_timer()
+    save_arrays(path, arrays)
+    saved = timeit.default_timer() - start
+    start = timeit.default_timer()
+    load_arrays(path)
+    loaded = timeit.default_timer() - start
+    size = os.path.getsize(path)
+    print(f"{'npz':<10} {saved:>8.2f}s to save, {loaded:.2f}s to load, {size / 1e6:.1f}MB on disk")
+
+    db.cleanup()
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
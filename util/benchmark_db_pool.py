@@ -0,0 +1,153 @@
+"""
+Compare connecting for every use against taking connections from a pool,
+with sqlite standing in for SQL Server and delays standing in for the TLS
+handshake & login and for the round trip of each table check over Wi-Fi
+Usage: python -m util.benchmark_db_pool --uses 50 --connect-ms 150 --round-trip-ms 10
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+from library.data import Column
+from library.data.local_database import Database, Table, connect_to_database
+from library.data.pool import ConnectionPool
+
+TABLE_NAME = "benchmark"
+TABLES = {
+    TABLE_NAME: [Column("timestamp", "integer", "PRIMARY KEY"), Column("value", "real", "NOT NULL")],
+    "benchmark_metadata": [Column("id", "text", "PRIMARY KEY"), Column("name", "text", "NOT NULL")],
+}
+
+
+class SlowTable(Table):
+    """
+    sqlite table whose existence check takes a network round trip
+    """
+    round_trip = 0.0
+    checks = 0
+
+    def does_table_exist(self, table_name: str) -> bool:
+        """
+        @param table_name: name of table
+        @type table_name: str
+        @rtype: bool
+        """
+        SlowTable.checks += 1
+        time.sleep(self.round_trip)
+        return super().does_table_exist(table_name)
+
+
+class SlowDatabase(Database):
+    """
+    sqlite database whose connects take as long as a remote login
+    """
+    TABLE_CLASS = SlowTable
+
+    def __init__(self, path, delay, pool=None):
+        """
+        @param path: path to the database file
+        @type path: str
+        @param delay: seconds each connect takes
+        @type delay: float
+        @param pool: (Optional) pool to take connections from - tables are only checked once with one
+        @type pool: ConnectionPool or None
+        """
+        super().__init__(TABLES, TABLE_NAME, path)
+        self.delay = delay
+        self.pool = pool
+        self.REUSE_TABLES = pool is not None
+
+    def open(self):
+        """
+        @return: new connection, after the delay
+        @rtype: sqlite3.Connection
+        """
+        time.sleep(self.delay)
+        return connect_to_database(self.path)
+
+    def connect(self):
+        """
+        Connect, or take a connection from the pool
+        """
+        self.connection = self.pool.acquire() if self.pool else self.open()
+        self.create_tables()
+
+    def release_connection(self, failed: bool):
+        """
+        Close the connection, or hand it back to the pool
+        @param failed: whether the connection failed
+        @type failed: bool
+        """
+        if self.pool:
+            self.pool.release(self.connection, discard=failed)
+        else:
+            self.connection.close()
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark database connection pooling")
+    parser.add_argument("--uses", "-u", default=50, type=int, help="Number of 'with db' blocks")
+    parser.add_argument("--connect-ms", "-c", default=150.0, type=float, help="Milliseconds per connect")
+    parser.add_argument("--round-trip-ms", "-r", default=10.0, type=float, help="Milliseconds per table check")
+    return parser.parse_args()
+
+
+def run(name, db, uses) -> float:
+    """
+    Open the database, add a row & close it again, uses times
+    @param name: name for the report
+    @type name: str
+    @param db: database to use
+    @type db: SlowDatabase
+    @param uses: number of times to use it
+    @type uses: int
+    @return: seconds per use
+    @rtype: float
+    """
+    SlowTable.checks = 0
+    start = timeit.default_timer()
+    for i in range(uses):
+        with db:
+            db.get_table(TABLE_NAME).add_data([i, float(i)])
+    elapsed = (timeit.default_timer() - start) / uses
+    print(f"{name:<10} {elapsed * 1000:>8.1f}ms per use, {SlowTable.checks} table checks")
+    with db:
+        for table in db.tables.values():
+            table.drop()
+    return elapsed
+
+
+def main(uses, connect_ms, round_trip_ms):
+    """
+    Run the benchmark
+    @param uses: number of 'with db' blocks
+    @type uses: int
+    @param connect_ms: milliseconds per connect
+    @type connect_ms: float
+    @param round_trip_ms: milliseconds per table check
+    @type round_trip_ms: float
+    """
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "benchmark.sqlite3")
+    delay = connect_ms / 1000
+    SlowTable.round_trip = round_trip_ms / 1000
+    print(f"{uses} uses, {connect_ms:0.0f}ms per connect, {round_trip_ms:0.0f}ms per table check")
+
+    direct = run("connect", SlowDatabase(path, delay), uses)
+    pool = ConnectionPool(lambda: SlowDatabase(path, delay).open())
+    pooled = run("pool", SlowDatabase(path, delay, pool), uses)
+    pool.close()
+    print(f"{direct / pooled:.1f}x faster with a pool ({pool.metrics()['created']} connects)")
+    shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
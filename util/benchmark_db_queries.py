@@ -0,0 +1,122 @@
+"""
+Compare per-query cost on a large table between the old f-string
+queries (values inlined, LIKE '%value%' on the primary key) and the
+cached parameterized statements with exact-match predicates
+Usage: python -m util.benchmark_db_queries --rows 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import timeit
+
+from library.data import Column
+from library.data.local_database import Database
+
+TABLE_NAME = "benchmark"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "integer", "PRIMARY KEY"),
+        Column("state", "text", "NOT NULL"),
+        Column("convo_id", "text", "NOT NULL", index=True),
+        Column("captured", "integer", "NOT NULL"),
+        Column("notified", "integer", "NOT NULL"),
+    ]
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark database queries")
+    parser.add_argument("--rows", "-r", default=1000000, type=int, help="Rows in the table")
+    parser.add_argument("--count", "-n", default=1000, type=int, help="Queries per cached statement")
+    parser.add_argument("--old-count", "-o", default=10, type=int, help="Queries per old statement")
+    return parser.parse_args()
+
+
+def run(name, method, count) -> float:
+    """
+    Time count calls to method and print a summary
+    @param name: name for the report
+    @type name: str
+    @param method: method to time
+    @type method: method
+    @param count: number of calls
+    @type count: int
+    @return: mean seconds per call
+    @rtype: float
+    """
+    latencies = []
+    for _ in range(count):
+        start = timeit.default_timer()
+        method()
+        latencies.append(timeit.default_timer() - start)
+
+    mean = statistics.mean(latencies)
+    print(f"{name:<28} mean {mean * 1e6:>12.1f}us  max {max(latencies) * 1e6:>12.1f}us  ({count} queries)")
+    return mean
+
+
+def main(rows, count, old_count):
+    """
+    Run the benchmark
+    @param rows: rows in the table
+    @type rows: int
+    @param count: queries per cached statement
+    @type count: int
+    @param old_count: queries per old statement - these scan the table so keep it small
+    @type old_count: int
+    """
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    db = Database(TABLES, TABLE_NAME, path)
+    try:
+        with db:
+            table = db.get_table(TABLE_NAME)
+            print(f"Filling {TABLE_NAME} with {rows} rows")
+            table.add_data_multiple((i, "Open", f"id{i}", 0, 0) for i in range(rows))
+            cursor = table.cursor
+            primary = table.primary_column_name
+
+            def key():
+                return random.randrange(rows)
+
+            # Old queries - values inlined into new SQL each call, LIKE on the primary key
+            def old_get():
+                cursor.execute(f"SELECT * FROM {TABLE_NAME} WHERE {primary} LIKE '%{key()}%'")
+                cursor.fetchone()
+
+            def old_update():
+                cursor.execute(f"UPDATE {TABLE_NAME} SET captured = 1 WHERE {primary} LIKE '%{key()}%'")
+
+            def old_get_entry_for_id():
+                convo_id = f"id{key()}"
+                cursor.execute(f"SELECT {table.columns_str} FROM {TABLE_NAME}")
+                matches = [x for x in cursor.fetchall() if x[2] == convo_id]
+                return matches[-1] if matches else None
+
+            results = [
+                ("get_record", run("old get_record", old_get, old_count),
+                 run("cached get_record", lambda: table.get_record(key()), count)),
+                ("update_record", run("old update_record", old_update, old_count),
+                 run("cached update_record", lambda: table.update_record(key(), "captured", 1), count)),
+                ("get_entry_for_id", run("old get_entry_for_id", old_get_entry_for_id, old_count),
+                 run("cached get_records_where",
+                     lambda: table.get_records_where("convo_id", f"id{key()}", limit=1), count)),
+            ]
+            db.connection.rollback()
+
+        print()
+        for name, old, new in results:
+            print(f"{name:<20} {old / new:>10.0f}x faster")
+    finally:
+        db.cleanup()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
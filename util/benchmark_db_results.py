@@ -0,0 +1,109 @@
+"""
+Compare the memory & time of turning a large query result into the old
+per-row DatabaseEntry objects (columns list + raw row + a dict built on
+first access) against a ResultSet of lazy row views
+Usage: python -m util.benchmark_db_results --rows 1000000
+"""
+import argparse
+import gc
+import json
+import timeit
+import tracemalloc
+from typing import List
+
+from library.data import Column, ResultSet, get_column_index
+
+COLUMNS = [
+    Column("timestamp", "datetime", "PRIMARY KEY"),
+    Column("id", "varchar(50)", "NOT NULL"),
+    Column("temperature", "real", "NOT NULL"),
+    Column("humidity", "real", "NOT NULL"),
+]
+
+
+class OldDatabaseEntry:
+    """
+    DatabaseEntry as it was - kept here for comparison
+    """
+    def __init__(self, columns: List[Column], entry):
+        super()
+        self.columns = columns
+        self.entry = entry
+        self._values = {}
+
+    @property
+    def values(self):
+        if not self._values:
+            for i in range(len(self.entry)):
+                self._values[self.columns[i].name] = self.entry[i]
+        return self._values
+
+    def __getitem__(self, item):
+        return self.values.get(item)
+
+    def __repr__(self) -> str:
+        return json.dumps(self._values)
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark query result sets")
+    parser.add_argument("--rows", "-r", default=1000000, type=int, help="Rows in the result")
+    return parser.parse_args()
+
+
+def run(name, convert, rows) -> tuple:
+    """
+    Convert the rows, read one value from each and report the time & memory used
+    @param name: name for the report
+    @type name: str
+    @param convert: method converting raw rows to entries
+    @type convert: method
+    @param rows: raw rows as a driver returns them
+    @type rows: list[tuple]
+    @return: (seconds, bytes)
+    @rtype: tuple
+    """
+    gc.collect()
+    start = timeit.default_timer()
+    entries = convert(rows)
+    total = sum(entry["temperature"] for entry in entries)
+    elapsed = timeit.default_timer() - start
+    assert total == sum(row[2] for row in rows)
+    del entries
+
+    # Separate pass for memory - tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    entries = convert(rows)
+    sum(entry["temperature"] for entry in entries)
+    # memory still held by the converted result, not counting the raw rows
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del entries
+
+    print(f"{name:<10} {elapsed:>8.2f}s  {size / 1e6:>10.1f}MB  ({size / len(rows):.0f} bytes/row)")
+    return elapsed, size
+
+
+def main(rows):
+    """
+    Run the benchmark
+    @param rows: rows in the result
+    @type rows: int
+    """
+    print(f"{rows} rows")
+    raw = [(f"2024-01-01 00:00:{i:09d}", f"sensor{i % 4}", float(i % 100), 50.0) for i in range(rows)]
+    index = get_column_index(COLUMNS)
+
+    old = run("old", lambda x: [OldDatabaseEntry(COLUMNS, row) for row in x], raw)
+    new = run("ResultSet", lambda x: ResultSet(COLUMNS, x, index), raw)
+    print(f"{old[0] / new[0]:.1f}x faster, {(old[1] - new[1]) / 1e6:.1f}MB less memory")
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -0,0 +1,96 @@
+"""
+Compare the door monitor's pattern - add a row, keep the last few, read the
+latest - on sqlite (default & WAL) against the ring buffer backend
+Usage: python -m util.benchmark_db_ringbuffer --rows 5000 --keep 10
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from library.data import Column
+from library.data import local_database, ringbuffer_database
+
+TABLE_NAME = "garage_door_monitor"
+TABLES = {
+    TABLE_NAME: [
+        Column("timestamp", "integer", "PRIMARY KEY"),
+        Column("state", "text", "NOT NULL"),
+        Column("convo_id", "text", "NOT NULL"),
+        Column("captured", "integer", "NOT NULL"),
+        Column("notified", "integer", "NOT NULL"),
+    ]
+}
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the ring buffer database")
+    parser.add_argument("--rows", "-r", default=5000, type=int, help="Rows to add")
+    parser.add_argument("--keep", "-k", default=10, type=int, help="Rows to keep")
+    return parser.parse_args()
+
+
+def run(name, db, rows, keep) -> float:
+    """
+    Add rows one at a time, trimming the table & reading the latest row after each
+    @param name: name for the report
+    @type name: str
+    @param db: database to use
+    @type db: library.data.database.BaseDatabase
+    @param rows: rows to add
+    @type rows: int
+    @param keep: rows to keep
+    @type keep: int
+    @return: rows per second
+    @rtype: float
+    """
+    db.keep_open = True
+    start = timeit.default_timer()
+    for i in range(rows):
+        with db:
+            table = db.get_table(TABLE_NAME)
+            table.add_data([i, "Open" if i % 2 else "Closed", f"{i:08d}", 0, 0])
+            table.delete_all_except_last_n_records(keep)
+            assert table.get_latest_record()["timestamp"] == i
+    elapsed = timeit.default_timer() - start
+    with db:
+        assert len(db.get_table(TABLE_NAME).get_all_records()) == keep
+    db.cleanup()
+    print(f"{name:<12} {rows / elapsed:>10.0f} rows/s")
+    return rows / elapsed
+
+
+def main(rows, keep):
+    """
+    Run the benchmark
+    @param rows: rows to add
+    @type rows: int
+    @param keep: rows to keep
+    @type keep: int
+    """
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "benchmark.sqlite3")
+    print(f"{rows} rows, keeping {keep}")
+    results = {
+        "sqlite": run("sqlite", local_database.Database(TABLES, TABLE_NAME, path), rows, keep),
+        "sqlite wal": run("sqlite wal", local_database.Database(
+            TABLES, TABLE_NAME, path.replace("benchmark", "benchmark_wal"),
+            {"journal_mode": "wal", "synchronous": "normal"}
+        ), rows, keep),
+        "ringbuffer": run("ringbuffer", ringbuffer_database.Database(
+            TABLES, TABLE_NAME, os.path.join(folder, "benchmark.ring"), keep * 10
+        ), rows, keep),
+    }
+    for name in ["sqlite", "sqlite wal"]:
+        print(f"ringbuffer {results['ringbuffer'] / results[name]:.1f}x {name}")
+    shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -0,0 +1,100 @@
+"""
+Compare publish latency of paho's publish.single (new connection per
+message) against the shared MQTTConnection, one message at a
+time and batched with publish_many
+Usage: python -m util.benchmark_mqtt_publish --broker localhost
+"""
+import argparse
+import statistics
+import timeit
+
+from paho.mqtt import publish
+
+from library.communication.mqtt import MQTTConnection
+
+
+def parse_args():
+    """
+    Set up an argument parser and return the parsed arguments
+    @return: Result of calling parse_args() on the argparse.ArgumentParser object
+    @rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark MQTT publishing")
+    parser.add_argument("--broker", "-b", default="localhost", type=str, help="Broker to publish to")
+    parser.add_argument("--port", "-p", default=1883, type=int, help="Broker port")
+    parser.add_argument("--count", "-n", default=200, type=int, help="Number of messages to publish")
+    parser.add_argument("--qos", "-q", default=2, type=int, help="QoS level")
+    parser.add_argument("--topic", "-t", default="benchmark/publish", type=str, help="Topic to publish to")
+    parser.add_argument("--fanout", "-f", default=4, type=int, help="Topics per publish_many batch")
+    return parser.parse_args()
+
+
+def run(name, method, count):
+    """
+    Time count calls to method and print a summary
+    @param name: name for the report
+    @type name: str
+    @param method: method taking the message index
+    @type method: method
+    @param count: number of messages to publish
+    @type count: int
+    """
+    latencies = []
+    start = timeit.default_timer()
+    for i in range(count):
+        publish_start = timeit.default_timer()
+        method(i)
+        latencies.append(timeit.default_timer() - publish_start)
+    total = timeit.default_timer() - start
+
+    latencies.sort()
+    print(
+        f"{name:<16} {count / total:>10.1f} msg/s  "
+        f"mean {statistics.mean(latencies) * 1000:>7.2f}ms  "
+        f"p50 {latencies[len(latencies) // 2] * 1000:>7.2f}ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:>7.2f}ms"
+    )
+
+
+def main(broker, port, count, qos, topic, fanout):
+    """
+    Run the benchmark
+    @param broker: broker to publish to
+    @type broker: str
+    @param port: broker port
+    @type port: int
+    @param count: number of messages to publish
+    @type count: int
+    @param qos: QoS level
+    @type qos: int
+    @param topic: topic to publish to
+    @type topic: str
+    @param fanout: topics per publish_many batch
+    @type fanout: int
+    """
+    run(
+        "publish.single",
+        lambda i: publish.single(topic, payload=str(i), qos=qos, retain=False, hostname=broker, port=port),
+        count
+    )
+
+    connection = MQTTConnection(broker, port)
+    try:
+        run(
+            "MQTTConnection",
+            lambda i: connection.publish(topic, payload=str(i), qos=qos, retain=False),
+            count
+        )
+        run(
+            f"publish_many x{fanout}",
+            lambda i: connection.publish_many(
+                [(f"{topic}/{j}", str(i), qos, False) for j in range(fanout)]
+            ),
+            count
+        )
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main(**parse_args().__dict__)
@@ -10,5 +10,5 @@ topics = [f"hass/env/00{x}" for x in range(6)]
 
 for topic in topics:
     print(f"clearing retained messages on: {host}:{port} - {topic}")
-    client.single(topic, msg, qos, retain, host, port, "retain_clear")
+    client.single(topic, msg, qos, retain, host, port)
 